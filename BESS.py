@@ -13,6 +13,7 @@ from queue import Queue
 from builtins import getattr
 import numpy as np
 from datetime import datetime, timedelta
+from Messages import bessAns
 
 class BESS(Component):
     '''
@@ -43,7 +44,7 @@ class BESS(Component):
                 qryMap[item] = 'NA'
         self.updateTime()
         self.request.set_identity(self.IDqueue.get())
-        self.request.send_pyobj({'Date': self.currTime, 'attr': qryMap})
+        self.request.send_capnp(bessAns({'Date': self.currTime, 'attr': qryMap}))
             
 # riaps:keep_request:end
 
@@ -1,7 +1,6 @@
 # riaps:keep_import:begin
 from riaps.run.comp import Component
 import spdlog
-from xlrd import open_workbook, xldate_as_tuple
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
 import threading
@@ -9,7 +8,8 @@ import zmq
 import time
 import yaml
 from queue import Queue
-import re
+from BuildingPlayback import ColumnStore, compilePlans, planColumns
+from Messages import buildingAns
 
 # riaps:keep_import:end
 
@@ -54,8 +54,12 @@ class BuildingInterfaceThread(threading.Thread):
                 self.Ts = auth_config['Ts']
             except:
                 self.Ts = 60
-            self.book = open_workbook('config/'+self.filename)
-            self.last_search = {}
+            try:
+                cachefile = auth_config['cache']
+            except:
+                cachefile = 'config/'+self.filename+'.cache.npz'
+            self.plans = compilePlans(self.item_sheet_map, self.sheet_format, self.logger)
+            self.store = ColumnStore('config/'+self.filename, planColumns(self.plans), cachefile, self.logger)
 
     def run(self):
         '''
@@ -126,7 +130,6 @@ class BuildingInterfaceThread(threading.Thread):
         '''
         resultlist = []
         results = {}
-        patrn = re.compile(r'[^\d.]+')
         
         
         if self.tStart is None:
@@ -136,50 +139,12 @@ class BuildingInterfaceThread(threading.Thread):
             self.logger.info(self.tStart)
         tStart_dt = datetime.strptime(self.tStart, self.fmt)
         for item in qty:
-#             find the appropriate sheets based on the mapping
-            sheetlist = []
-            #                 initialize search history tfor each quuuery item
-            if item not in self.last_search:
-                self.last_search[item] = {}
-            for key, sheetnames in self.item_sheet_map.items():
-                for sheetname in sheetnames:
-                    if key == item or item == 'all':
-                        if sheetname not in sheetlist:
-                            sheetlist.append(sheetname)
-#             open each sheet and get data
-            for sheetname in sheetlist:
-                sheet = self.book.sheet_by_name(sheetname)
-#                 initialize the specific sheet row search history index
-                if sheetname not in self.last_search[item]:
-                    self.last_search[item][sheetname] = 0
-#                 find the column names and its associated date column based on the item
-                col_date_map = {}
-                for cols in self.sheet_format[sheetname]:
-                    coldetails = cols.split('_')
-                    if item in coldetails[-1] or (item == 'all' and 'Date' not in coldetails[-1]):
-                        col_date_map[cols] = cols.replace(patrn.search(coldetails[-1]).group(0), 'Date')
-                        if col_date_map[cols] not in self.sheet_format[sheetname]:
-                            col_date_map[cols] = 'Date'
-#                 go through each row and fetch the values from the relevant columns
-                candt = sheet.nrows 
-                for row_idx in range(self.last_search[item][sheetname],sheet.nrows):
-            
-                    for data_col, date_col in  col_date_map.items():
-#                         match the time stamp with the current time step
-                        dt = sheet.cell_value(row_idx,int(self.sheet_format[sheetname][date_col]))
-                        try: 
-                            dt = xldate_as_tuple(dt, self.book.datemode)
-                            dt = datetime(*dt)
-                            dt = dt.replace(minute = 0, second = 0, microsecond = 0)
-                        except:
-                            pass
-                        else:
-                            if dt == tStart_dt:
-                                results['Date'] = self.tStart
-                                results[data_col] = sheet.cell_value(row_idx,int(self.sheet_format[sheetname][data_col]))
-                                if row_idx < candt:
-                                    candt = row_idx
-                                self.last_search[item][sheetname] = candt
+#             read the columns of the item (see compilePlan)
+            for step in self.plans.get(item, ()):
+                value = self.store.lookup(step.sheetname, step.dateCol, step.valueCol, tStart_dt)
+                if value is not None:
+                    results['Date'] = self.tStart
+                    results[step.label] = value
         if not results:
             results['Date'] = self.tStart
             results['HT_TotalPower'] = 0
@@ -240,7 +205,7 @@ class BuildingInterface(Component):
         msgtype, ans = recv
         if msgtype == 'qry':
             self.request.set_identity(self.identity.get())
-            self.request.send_pyobj(ans)
+            self.request.send_capnp(buildingAns(ans))
         elif msgtype == 'cmd':
             self.command.set_identity(self.identity.get())
             self.command.send_pyobj(ans)
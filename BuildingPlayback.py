@@ -0,0 +1,227 @@
+'''
+Columnar store of the BuildingInterface workbook
+
+The query items are resolved once, when the configuration is loaded, into plans: the
+sheet, the label, the value column and the date column of every value the item reads.
+
+The playback workbook is read once with xlrd. Every column of the plans is turned
+into two arrays, the hour of the cell as a date (hours since 1970, -1 if the cell is
+not a date) and its value as a number (NaN otherwise). A time step is then a binary
+search in the hours of the date column. The arrays are saved next to the workbook
+with the SHA-1 of the workbook, so the next runs load them instead of parsing the
+workbook again, until the workbook changes.
+'''
+import os
+import re
+import hashlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+import numpy as np
+from xlrd import open_workbook, xldate_as_tuple
+
+EPOCH = datetime(1970, 1, 1)
+NO_HOUR = -1
+ITEMS = ('TotalPower', 'Temp', 'HVAC', 'Lighting', 'all')
+
+# a value read by a query item
+PlanStep = namedtuple('PlanStep', ['sheetname', 'label', 'valueCol', 'dateCol'])
+
+
+def hourOf(dt):
+    '''
+    Hours since 1970 of a datetime, truncated to the hour
+    '''
+    return (dt - EPOCH) // timedelta(hours=1)
+
+
+def fileHash(path, blocksize=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def compilePlan(item, item_sheet_map, sheet_format):
+    '''
+    Columns read by a query item. The sheets of the item come from item_sheet_map
+    (every sheet for 'all'). A label of sheet_format is read if the item is part of
+    its last field ('all' reads every label that is not a date); its date column is
+    the label with the type replaced by 'Date' (HT_TotalPower -> HT_Date), or 'Date'
+    if the sheet has no such label.
+    :return: the plan and the problems found in the configuration
+    :rtype: (tuple, list)
+    '''
+    patrn = re.compile(r'[^\d.]+')
+    steps = []
+    problems = []
+    sheetlist = []
+    for key, sheetnames in item_sheet_map.items():
+        for sheetname in sheetnames or []:
+            if (key == item or item == 'all') and sheetname not in sheetlist:
+                sheetlist.append(sheetname)
+    for sheetname in sheetlist:
+        if sheetname not in sheet_format or not sheet_format[sheetname]:
+            problems.append('sheet %s of item %s has no sheet_format' % (sheetname, item))
+            continue
+        cols = sheet_format[sheetname]
+        for label in cols:
+            coldetails = str(label).split('_')
+            if not (item in coldetails[-1] or (item == 'all' and 'Date' not in coldetails[-1])):
+                continue
+            found = patrn.search(coldetails[-1])
+            if found is None:
+                problems.append('%s in sheet %s has no type' % (label, sheetname))
+                continue
+            date = str(label).replace(found.group(0), 'Date')
+            if date not in cols:
+                date = 'Date'
+            if date not in cols:
+                problems.append('%s in sheet %s has no date column' % (label, sheetname))
+                continue
+            try:
+                steps.append(PlanStep(sheetname, label, int(cols[label]), int(cols[date])))
+            except (TypeError, ValueError):
+                problems.append('%s in sheet %s has no valid column index' % (label, sheetname))
+    return tuple(steps), problems
+
+
+def compilePlans(item_sheet_map, sheet_format, logger=None):
+    '''
+    Plans of the query items, the known ones and the keys of item_sheet_map. The
+    configuration problems are logged as errors and the columns concerned are left out.
+    :rtype: dict
+    '''
+    plans = {}
+    problems = []
+    for item in list(ITEMS) + [key for key in item_sheet_map if key not in ITEMS]:
+        plans[item], found = compilePlan(item, item_sheet_map, sheet_format)
+        problems += [problem for problem in found if problem not in problems]
+    if logger is not None:
+        for problem in problems:
+            logger.error('excel configuration: %s' % problem)
+    return plans
+
+
+def planColumns(plans):
+    '''
+    (sheetname, col) of every column read by the plans
+    '''
+    return set((step.sheetname, col) for plan in plans.values() for step in plan
+               for col in (step.valueCol, step.dateCol))
+
+
+class ColumnStore():
+    '''
+    Hours and values of the workbook columns
+    columns : {(sheetname, col): (hours, values)}
+    '''
+    def __init__(self, filename, columns, cachefile=None, logger=None):
+        '''
+        :param filename: path of the workbook
+        :type filename: str
+        :param columns: the columns to read (sheetname, col), see planColumns
+        :type columns: iterable
+        :param cachefile: path of the cache, None for no cache
+        :type cachefile: str
+        :param logger: logger of the interface
+        '''
+        self.filename = filename
+        self.cachefile = cachefile
+        self.logger = logger
+        self.needed = sorted(set(columns))
+        self.columns = {}
+        self.indices = {}
+        self.digest = fileHash(filename)
+        if not self.loadCache():
+            self.ingest()
+            self.saveCache()
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    @staticmethod
+    def key(sheetname, col):
+        return '%s/%d' % (sheetname, col)
+
+    def loadCache(self):
+        '''
+        :return: True if the cache has every column of the current workbook
+        :rtype: bool
+        '''
+        if self.cachefile is None or not os.path.exists(self.cachefile):
+            return False
+        try:
+            with np.load(self.cachefile) as cache:
+                if str(cache['sha1']) != self.digest:
+                    self.log('%s changed, reading it again' % self.filename)
+                    return False
+                for sheetname, col in self.needed:
+                    key = self.key(sheetname, col)
+                    self.columns[(sheetname, col)] = (cache[key + '/hours'], cache[key + '/values'])
+        except (KeyError, OSError, ValueError) as e:
+            self.log('cache %s not used: %s' % (self.cachefile, str(e)))
+            self.columns = {}
+            return False
+        self.log('loaded %d columns from %s' % (len(self.columns), self.cachefile))
+        return True
+
+    def saveCache(self):
+        if self.cachefile is None:
+            return
+        arrays = {'sha1': np.array(self.digest)}
+        for (sheetname, col), (hours, values) in self.columns.items():
+            key = self.key(sheetname, col)
+            arrays[key + '/hours'] = hours
+            arrays[key + '/values'] = values
+        try:
+            # written under a temporary name so a concurrent reader never sees half a cache
+            tmp = self.cachefile + '.tmp.npz'
+            np.savez(tmp, **arrays)
+            os.replace(tmp, self.cachefile)
+        except OSError as e:
+            self.log('cache %s not written: %s' % (self.cachefile, str(e)))
+
+    def ingest(self):
+        '''
+        Read the columns of the plans from the workbook
+        '''
+        book = open_workbook(self.filename)
+        for sheetname, col in self.needed:
+            sheet = book.sheet_by_name(sheetname)
+            hours = np.full(sheet.nrows, NO_HOUR, dtype=np.int64)
+            values = np.full(sheet.nrows, np.nan)
+            for row_idx, cell in enumerate(sheet.col_values(col)):
+                try:
+                    hours[row_idx] = hourOf(datetime(*xldate_as_tuple(cell, book.datemode)))
+                except:
+                    pass
+                if isinstance(cell, float):
+                    values[row_idx] = cell
+            self.columns[(sheetname, col)] = (hours, values)
+        book.release_resources()
+        self.log('read %d columns from %s' % (len(self.columns), self.filename))
+
+    def index(self, sheetname, dateCol):
+        '''
+        Hours of a date column sorted, with the rows they come from
+        '''
+        if (sheetname, dateCol) not in self.indices:
+            hours = self.columns[(sheetname, dateCol)][0]
+            rows = np.flatnonzero(hours != NO_HOUR)
+            order = np.argsort(hours[rows], kind='stable')
+            self.indices[(sheetname, dateCol)] = (hours[rows][order], rows[order])
+        return self.indices[(sheetname, dateCol)]
+
+    def lookup(self, sheetname, dateCol, valueCol, dt):
+        '''
+        Value of valueCol on the last row whose date in dateCol is in the hour of dt
+        :return: the value, None if no row has that hour
+        '''
+        hours, rows = self.index(sheetname, dateCol)
+        hour = hourOf(dt)
+        i = np.searchsorted(hours, hour, side='right') - 1
+        if i < 0 or hours[i] != hour:
+            return None
+        return float(self.columns[(sheetname, valueCol)][1][rows[i]])
@@ -1,67 +1,150 @@
 from riaps.run.comp import Component
-import tensorflow as tf
-import pandas as pd
 import numpy as np
-from pandas.tseries.holiday import USFederalHolidayCalendar
+import threading
+import time
+from FeatureStore import FeatureStore, CalendarTable
+from InferenceServer import RequestBatch
+from LSTMInference import compileModel
 
 
 class BuildingPredictive(Component):
 
 # riaps:keep_constr:begin
-    def __init__(self,model_path):
+    def __init__(self,model_path,max_batch=1,max_wait=0.05):
+        '''
+        :param model_path: name of the model file in the models directory
+        :param max_batch: number of requests run through the model in one forward pass
+        :param max_wait: seconds a request waits for the others of its batch
+        '''
         super(BuildingPredictive, self).__init__()
-        self.predictor = buildingPredictor(self.logger, model_path)
+        self.started = time.time()
+        # the model is loaded in the background after activation (see handleActivate)
+        self.predictor = buildingPredictor(self.logger, model_path, load=False)
+        self.batch = RequestBatch(max_batch, max_wait)
+        self.loader = None
         
         self.logger.info("starting predictive model device with id %s " % str( id (self.predictor)) )
 # riaps:keep_constr:end
 
+    def handleActivate(self):
+        self.logger.info("activated %.2f s after start, loading the model" % (time.time() - self.started))
+        self.loader = threading.Thread(target=self.loadModel, daemon=True)
+        self.loader.start()
+
+    def loadModel(self):
+        '''
+        Import TensorFlow and load the model off the event loop. Until the model is
+        ready the requests are answered with the persistence forecast.
+        '''
+        try:
+            self.predictor.load()
+        except Exception as e:
+            self.logger.error("model not loaded, using the persistence forecast: %s" % str(e))
+            return
+        self.logger.info("model ready %.2f s after start (loaded in %.2f s)" % (time.time() - self.started, self.predictor.loadTime))
+
 # riaps:updateAndPredict:begin
     def on_updateAndPredict(self):
         msg = self.updateAndPredict.recv_pyobj()
         msg_id = self.updateAndPredict.get_identity()
         self.logger.info("received from manager: %s" % str(msg))
         
-        self.predictor.run(msg[0])
-        predicitonResult = self.predictor.prediction
-        self.logger.info("prediction for the next time step: %s" % str(predicitonResult))
-        predicitonResult = np.squeeze (predicitonResult)
-        predicitonResult = np.clip(predicitonResult, a_min=0, a_max=None)
-        predicitonResult_list = predicitonResult.tolist()
-        self.updateAndPredict.set_identity(msg_id)
-        self.updateAndPredict.send_pyobj(predicitonResult_list)
+        # a second request of the same site goes into the next batch
+        if msg_id in self.batch:
+            self.flush.halt()
+            self.predictBatch()
+        first = self.batch.add(msg_id, msg[0])
+        if self.batch.full():
+            self.flush.halt()
+            self.predictBatch()
+        elif first:
+            self.flush.setDelay(self.batch.maxWait)
+            self.flush.launch()
+
+    def on_flush(self):
+        now = self.flush.recv_pyobj()
+        self.flush.halt()
+        if len(self.batch) > 0:
+            self.predictBatch()
+
+    def predictBatch(self):
+        '''
+        Run the queued requests through the model and answer each site
+        '''
+        requests = self.batch.take()
+        predictions = self.predictor.runBatch(requests)
+        for (msg_id, msg), predicitonResult in zip(requests, predictions):
+            self.logger.info("prediction for the next time step: %s" % str(predicitonResult))
+            predicitonResult = np.squeeze (predicitonResult)
+            predicitonResult = np.clip(predicitonResult, a_min=0, a_max=None)
+            predicitonResult_list = predicitonResult.tolist()
+            self.updateAndPredict.set_identity(msg_id)
+            self.updateAndPredict.send_pyobj(predicitonResult_list)
+        self.logger.info("batch of %d requests, %s" % (len(requests), str(self.batch.stats())))
     
     def __destroy__(self):
        self.logger.info("exiting predictive device")
-       tf.keras.backend.clear_session()
+       self.predictor.close()
 # riaps:updateAndPredict:end
 
 
 
 
 class buildingPredictor():
-    def __init__(self,logger,model_path):
+    def __init__(self,logger,model_path,inference='numpy',load=True):
+        '''
+        :param logger: component logger
+        :param model_path: name of the model file in the models directory
+        :param inference: inference path {'numpy', 'function', 'predict'} (see LSTMInference)
+        :param load: load the model now, otherwise load() has to be called
+        '''
         self.historyStep = 48
         self.futureStep = 24
         self.logger = logger
         self.historyInput = None
         self.futureInput = None
-        self.ini = True
-        self.holiday_gen  = USFederalHolidayCalendar()
+        self.calendar = CalendarTable()
+        self.sites = {}
+        self.features = self.featuresOf(None)
         self.prediction = 0
         self.model_path = 'models/'+model_path
         self.avePower = 794.228479
         self.stdPower = 282.101284
         self.aveOAT   = 61.722562
         self.stdOAT   = 10.996571
+        self.inference = inference
+        self.model = None
+        self.network = None
+        self.ready = False
+        self.loadTime = 0
+        if load:
+            self.load()
+
+    def load(self):
         '''
-        try:
-            self.model = tf.keras.models.load_model(self.model_path)
-        except:
-            self.logger.info("Model does not exist at %s" % self.model_path )
+        Import TensorFlow and load the model
         '''
+        t0 = time.time()
+        import tensorflow as tf
         self.model = tf.keras.models.load_model(self.model_path,compile=False)
+        self.network = compileModel(self.model, self.inference, self.logger)
+        self.loadTime = time.time() - t0
+        self.ready = True
+
+    def close(self):
+        if self.model is not None:
+            import tensorflow as tf
+            tf.keras.backend.clear_session()
         
-    def UpdateInput(self,msg):
+    def featuresOf(self, site):
+        '''
+        Input windows of a site, created on its first request
+        '''
+        if site not in self.sites:
+            self.sites[site] = FeatureStore(self.historyStep, self.futureStep, 2, self.calendar)
+        return self.sites[site]
+
+    def UpdateInput(self,msg,site=None):
         newDate = msg['Date']
         try:
             newPower = (msg['HT_TotalPower'] - self.avePower )/self.stdPower
@@ -72,50 +155,10 @@ class buildingPredictor():
         except:
             newOAT = (0 - self.aveOAT)/self.stdOAT
         
-        newDate = pd.to_datetime(newDate)
-        oneHourDelta = pd.Timedelta('1 Hour')
-        oneDayDelta  = pd.Timedelta('1 Day')
-        
-        if self.ini == True:
-            dateList = []
-            for i in range (7*24):
-                dateItem = newDate - (6*24-i)*oneHourDelta
-                dateList.append(dateItem)
-            self.ini = False
-            
-            dateList = pd.to_datetime(dateList)
-            
-            dayOfWeekList = dateList.dayofweek.values
-            dayofWeekVector = pd.get_dummies(dayOfWeekList)
-            hourOfdayList = dateList.hour
-            hourOfdayVector = pd.get_dummies(hourOfdayList)
-            holidays = self.holiday_gen.holidays(start=dateList.min(), end=dateList.max())
-            holidayVector = pd.to_datetime(dateList.date).isin(holidays).astype(int)
-            holidayVector = holidayVector.reshape((168,1))
-
-            h = self.historyStep
-            f = self.futureStep
-            self.historyInput = np.c_[np.zeros((h,2)), dayofWeekVector[-f-h:-f],holidayVector[-f-h:-f],hourOfdayVector[-f-h:-f] ]
-            self.futureInput = np.c_[ dayofWeekVector[-f:],holidayVector[-f:],hourOfdayVector[-f:]]
-            
-            self.historyInput  = np.expand_dims(self.historyInput ,0)
-            self.futureInput  = np.expand_dims(self.futureInput ,0)
-
-
-        newHistoryInput = np.c_[newPower, newOAT, self.futureInput[0,0,:].reshape(1,32)]
-        self.historyInput = np.r_[self.historyInput[0,1:,:], newHistoryInput]
-        self.historyInput = np.expand_dims(self.historyInput,0)
-        
-        newPredictEndDate = newDate + oneDayDelta
-        holidays = self.holiday_gen.holidays(start=(newDate-2*oneDayDelta), end=(newDate+2*oneDayDelta))
-        newHoliday = pd.to_datetime([newPredictEndDate.date()]).isin(holidays).astype(int)
-        newDayOfWeek = np.zeros((1,7))
-        newHourofDay = np.zeros((1,24))
-        newDayOfWeek[0,newPredictEndDate.dayofweek] =1
-        newHourofDay[0,newPredictEndDate.hour]=1
-        newFutureInput = np.c_[newDayOfWeek,newHoliday,newHourofDay]
-        self.futureInput = np.r_[ self.futureInput[0,1:,:], newFutureInput ]
-        self.futureInput = np.expand_dims(self.futureInput,0)
+        self.features = self.featuresOf(site)
+        self.features.update(newDate, (newPower, newOAT))
+        self.historyInput = self.features.history
+        self.futureInput = self.features.future
         
     def updateModel(self):
         pass
@@ -124,15 +167,33 @@ class buildingPredictor():
         pass
     
     def predict(self):
-        self.prediction = self.model.predict([self.historyInput, self.futureInput])
+        if not self.ready:
+            self.prediction = self.features.persistence().reshape(1, -1)*self.stdPower + self.avePower
+            return
+        self.prediction = self.network([self.historyInput, self.futureInput])
         self.prediction = self.prediction*self.stdPower + self.avePower
         
     def run(self,msg):
         self.UpdateInput(msg)
         self.predict()
+
+    def runBatch(self, requests):
+        '''
+        Update the inputs of every site and predict them in one forward pass
+        :param requests: list of (site, msg)
+        :return: the predictions in the order of the requests
+        '''
+        for site, msg in requests:
+            self.UpdateInput(msg, site)
+        if not self.ready:
+            return np.array([self.sites[site].persistence() for site, msg in requests])*self.stdPower + self.avePower
+        history = np.concatenate([self.sites[site].history for site, msg in requests])
+        future = np.concatenate([self.sites[site].future for site, msg in requests])
+        prediction = self.network([history, future])
+        return prediction*self.stdPower + self.avePower
            
 if __name__ == '__main__':
-    testob = buildingPredictor(1, 'my_lstm_model.h5')
+    testob = buildingPredictor(None, 'my_lstm_model.h5')
     msg = {'Date':'2019-09-01 11:00:00', 'HT_TotalPower':1926, 'OutsideAirTemp':76}
     testob.UpdateInput(msg) 
     print(testob.prediction)
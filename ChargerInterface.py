@@ -1,18 +1,16 @@
 # riaps:keep_import:begin
 from riaps.run.comp import Component
 import spdlog
-from zeep import Client
 import zeep.helpers
-from zeep.wsse.username import UsernameToken
-import sqlite3
 from datetime import datetime, timedelta
 import threading
 import zmq
 import time
 import yaml
 from queue import Queue
-from dateutil.relativedelta import relativedelta
-import pandas as pd
+from ChargerPlayback import SQLitePlayback, CSVPlayback
+from ChargerRealtime import RealtimeFetcher
+from Messages import chargerAns
 
 # riaps:keep_import:end
 
@@ -47,7 +45,29 @@ class ChargerInterfaceThread(threading.Thread):
             self.username = auth_config['username']
             self.password = auth_config['password']
             self.wsdl_url = auth_config['wsdl_url']
-            self.client = Client(self.wsdl_url, wsse=UsernameToken(self.username, self.password))
+            try:
+                workers = auth_config['workers']
+            except:
+                workers = 8
+            try:
+                timeout = auth_config['timeout']
+            except:
+                timeout = 30
+            try:
+                wsdl_cache = auth_config['wsdl_cache']
+            except:
+                wsdl_cache = None
+            try:
+                idle = auth_config['idle']
+            except:
+                idle = 8
+            try:
+                max_failures = auth_config['max_failures']
+            except:
+                max_failures = 12
+            self.fetcher = RealtimeFetcher(self.wsdl_url, self.username, self.password, workers, timeout, wsdl_cache, self.logger,
+                                           idle, max_failures)
+            self.client = self.fetcher.client
         elif self.mode == 'playback':
             self.dbname = auth_config['dbname']
             try:
@@ -58,12 +78,13 @@ class ChargerInterfaceThread(threading.Thread):
                 self.Ts = auth_config['Ts']
             except:
                 self.Ts = 15
-            self.conn = None
-            self.cursor = None
+            try:
+                self.prefetch = auth_config['prefetch']
+            except:
+                self.prefetch = 96
+            # opened in the device thread on the first query
+            self.playback = None
         elif self.mode == 'playbackCSV':
-            self.sourcefile = pd.read_csv('config/'+auth_config['filename'], names = ['stationTime','rollingPowerAvg'])
-            self.sourcefile['stationTime'] = pd.to_datetime(self.sourcefile['stationTime'])
-            self.sourcefile.index = self.sourcefile['stationTime']
             try:
                 self.tStart = auth_config['tStart']
             except:
@@ -72,6 +93,7 @@ class ChargerInterfaceThread(threading.Thread):
                 self.Ts = auth_config['Ts']
             except:
                 self.Ts = 60
+            self.playback = CSVPlayback('config/'+auth_config['filename'], self.Ts, self.tStart, self.logger)
 #         return client
 
     def run(self):
@@ -103,9 +125,10 @@ class ChargerInterfaceThread(threading.Thread):
         terminate the thread
         '''
         self.terminated.set()
-        if self.mode == 'db':
-            try: self.cursor.close()
-            except: pass
+        if self.mode == 'playback' and self.playback is not None:
+            self.playback.close()
+        elif self.mode == 'realtime':
+            self.fetcher.close()
         self.logger.info('DeviceThread terminating')
         
     def get_plug(self):
@@ -266,52 +289,7 @@ class ChargerInterfaceThread(threading.Thread):
         :return: the session data as a list of dictionaries
         :rtype: list
         '''
-        usageSearchQuery = {}
-        sessionIDlist = []
-        resultlist = []
-        
-# look at an 8 hour widow from the current time stamp to get a list of running    sessions
-        tStart = datetime.now().replace(second = 0, microsecond = 0)
-        usageSearchQuery["toTimeStamp"] = tStart
-        
-        tEnd = tStart-timedelta(hours = 8)
-        usageSearchQuery["fromTimeStamp"] = tEnd
-        # Make api call to get the session IDs
-        try:
-            res = self.client.service.getChargingSessionData(usageSearchQuery)
-        except Exception as e:
-            self.logger.error("Unable to getChargingSessionData : %s" % e)
-            return resultlist
-        else:
-# loop over the results and store the session IDs
-            for d in res.ChargingSessionData:
-                    sessionIDlist.append(d.sessionID)
-# round up the starting time to the nearest 15 min interval and look at sessions that have begun since then
-            windowEnd = tStart
-            windowStart = tStart - timedelta(minutes= tStart.minute % 15, seconds = tStart.second,microseconds=tStart.microsecond)      
-            # Call the 15 min session api using the list of session IDs
-            for sessionID in sessionIDlist:
-                data = self.client.service.get15minChargingSessionData(sessionID=sessionID)
-                for d in data.fifteenminData:
-                    # check if the session time is within the window
-                    stationTime = datetime.strptime(datetime.strftime(d.stationTime,self.fmt),self.fmt)
-                    if windowStart <= stationTime and stationTime <= windowEnd:
-# store the results in a dictionary containing the queried values
-                        results = {'stationID': data.stationID, 'portNumber': data.portNumber, 'sessionID': data.sessionID, 'stationTime' : d.stationTime}
-                        for item in qty:
-                            if item == 'all':
-                                results['energyConsumed'] = d.energyConsumed
-                                results['peakPower'] = d.peakPower
-                                results['rollingPowerAvg'] = d.rollingPowerAvg
-                            else:
-                                try: value = getattr(d,item)
-                                except: 
-                                    self.logger.error("Queried quantity %s not found" % item)
-                                    results[item] = 'NA'
-                                else:
-                                    results[item] = value
-                        resultlist.append(results)
-            return resultlist
+        return self.fetcher.fetch(qty)
                     
             
     def handleQry(self, qty):
@@ -336,55 +314,11 @@ class ChargerInterfaceThread(threading.Thread):
         :return: the session data as a list of dictionaries
         :rtype: list
         '''
-        resultlist = []
-        self.conn = sqlite3.connect(self.dbname)
-        self.cursor = self.conn.cursor()
-        results = {}
-        
-        if self.tStart is None:
-            curr_time = datetime.strftime(datetime.now(), self.fmt)
-            time_frags = ('%%'+curr_time[5:],'%%'+curr_time[5:7]+'__'+curr_time[-8:]+'%%','%%'+curr_time[-8:],'%%'+curr_time[-8:-3]+'%%','%%'+curr_time[-8:-5]+'%%')
-            time_query = 'SELECT stationTime FROM fifteen_min_session WHERE (stationTime like ? or stationTime like ? or stationTime like ? or stationTime like ? or stationTime like ?) ORDER by stationTime'
-            self.cursor.execute(time_query,time_frags)
-            try:
-                self.tStart = self.cursor.fetchone()[0]
-            except:
-                self.tStart = '2020-01-02 00:00:00'
-            self.logger.info("returned time %s" % self.tStart)
-            dt = datetime.strptime(self.tStart,self.fmt)
-#             dt = dt - timedelta(minutes= dt.minute % self.Ts, seconds = dt.second,microseconds=dt.microsecond)
-            dt = dt + (datetime.min - dt) % timedelta(minutes = self.Ts)
-            self.tStart = datetime.strftime(dt,self.fmt)
-            self.logger.info(self.tStart)
-            
-            
-        windowStart = self.tStart
-        windowEnd = self.tStart
-        search_query = 'SELECT * FROM fifteen_min_session WHERE stationTime BETWEEN ? AND ? GROUP by stationID,stationTime'
-        self.cursor.execute(search_query,(windowStart, windowEnd))
-        for row in self.cursor.fetchall():
-            stationID, portNumber, sessionID, stationTime, energyConsumed, peakPower, rollingPowerAvg = row
-            results = {'stationID': stationID, 'portNumber': portNumber, 'sessionID': sessionID, 'stationTime': stationTime}
-            for item in qty:
-                if item == 'all':
-                    results['energyConsumed'] = energyConsumed
-                    results['peakPower'] = peakPower
-                    results['rollingPowerAvg'] = rollingPowerAvg
-                else:
-                    try: value = locals()[item]
-                    except: 
-                        self.logger.error("Queried quantity %s not found" % item)
-                        results[item] = 'NA'
-                    else:
-                        results[item] = value
-            resultlist.append(results)
-            
-        if len(resultlist) == 0:
-            results['stationTime']= self.tStart
-            results['rollingPowerAvg']= 0
-            resultlist.append(results)
-        self.tStart = datetime.strftime(datetime.strptime(self.tStart,self.fmt) + timedelta(minutes = self.Ts),self.fmt)
-        self.cursor.close()
+        if self.playback is None:
+            self.playback = SQLitePlayback(self.dbname, self.Ts, self.tStart, self.prefetch, self.logger)
+            self.logger.info(self.playback.tStart)
+        resultlist = self.playback.next(qty)
+        self.tStart = self.playback.tStart
         return resultlist
     
     def getPlaybackDataCSV(self):
@@ -394,25 +328,7 @@ class ChargerInterfaceThread(threading.Thread):
         :return: the session data as a list of dictionaries
         :rtype: list
         '''
-        resultlist = []
-        results = {}
-        
-        if self.tStart is None:
-            self.tStart = datetime.now()-relativedelta(years=1)
-            self.tStart = self.tStart.replace(minute = 0, second = 0, microsecond = 0)
-            self.tStart = datetime.strftime(self.tStart, self.fmt)
-            
-        try:
-            results = self.sourcefile.loc[self.tStart]
-            results = results.to_dict()
-            results['stationTime'] = datetime.strftime(results['stationTime'], self.fmt)
-        except KeyError:
-            results = {'stationTime': self.tStart, 'rollingPowerAvg' : 0}
-        
-        resultlist.append(results)
-        self.tStart = datetime.strftime(datetime.strptime(self.tStart,self.fmt) + timedelta(minutes = self.Ts),self.fmt)
-        
-        return resultlist
+        return self.playback.next()
             
         
         
@@ -466,7 +382,7 @@ class ChargerInterface(Component):
         msgtype, ans = recv
         if msgtype == 'qry':
             self.request.set_identity(self.identity.get())
-            self.request.send_pyobj(ans)
+            self.request.send_capnp(chargerAns(ans))
         elif msgtype == 'cmd':
             self.command.set_identity(self.identity.get())
             self.command.send_pyobj(ans)
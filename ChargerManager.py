@@ -3,6 +3,11 @@ from riaps.run.comp import Component
 import spdlog
 import random
 import time
+import yaml
+from VoteEngine import VoteEngine
+from ToleranceVote import votesOf
+from Messages import powerRequest, powerDispatchedOf, chargerAnsOf
+from HorizonDelta import HorizonEncoder, HorizonDecoder, HorizonFrame
 
 # riaps:keep_import:end
 
@@ -12,11 +17,17 @@ class ChargerManager(Component):
     '''
 
 # riaps:keep_constr:begin
-    def __init__(self,id, grptype):
+    def __init__(self,id, grptype, delta=0, keyframe=12, voteconfig='vote_config.yaml'):
         '''
         Constructor method
         :param id: identifier for the individual load
         :type id: str
+        :param delta: resolution (kW) of the delta-encoded predictions, 0 to send the whole horizon
+        :type delta: float
+        :param keyframe: the whole horizon is sent at least every keyframe requests in delta mode
+        :type keyframe: int
+        :param voteconfig: name of the yaml file of the tolerance of the votes in each group
+        :type voteconfig: str
         '''
         super(ChargerManager, self).__init__()
         self.chargingSessionList = []
@@ -25,19 +36,20 @@ class ChargerManager(Component):
         self.type = 'EV'
         self.msgTime = None
         self.grpType = grptype.split(',')
-        self.ready = False
-        self.myrfcID = None
         self.updatedData = None
-        self.voteLib = {}
         self.groups = {}
-        self.waitforData = 0
-        self.pendingVote = {}
+        self.horizon = HorizonEncoder(float(delta), int(keyframe)) if float(delta) > 0 else None
+        self.dispatchHorizon = HorizonDecoder()
+        with open("config/" + voteconfig, 'r') as stream:
+            self.tolerances = votesOf(yaml.safe_load(stream) or {}, self.grpType)
+        self.votes = VoteEngine(self.sendData, self.armVote, self.voteEvent)
 # riaps:keep_constr:end
 
     def handleActivate(self):
         for groupname in self.grpType:
             group = self.joinGroup(groupname, self.ID[:-1])
             self.groups[groupname] = group
+            self.votes.join(group, self.tolerances[groupname].agree)
             self.logger.info("joined group[%s]: %s" % (group.getGroupName(),str(group.getGroupId())))
 
 # riaps:keep_command:begin
@@ -54,12 +66,20 @@ class ChargerManager(Component):
     def on_dspPower(self):
         '''
         Message handler to receive dispatched power from Coordinator.
-        Message format (type, powerGranted)
+        The message holds the dispatch of every client, only the one of this manager is read.
+        Message format (type, powerGranted, client)
         type : type of load {'BU' - Builings, 'EV' - EV Chargers, 'BESS" - Battery Units}
-        powerGranted : list of power values for the time horizon.
+        powerGranted : list of power values for the time horizon, or its HorizonFrame in delta mode.
+        client : the client of the dispatch
         '''
-        ans = self.dspPower.recv_pyobj()
-        type, powerGranted = ans
+        ans = powerDispatchedOf(self.dspPower.recv_capnp(), self.ID[:-1])
+        if ans is None: return
+        type, powerGranted, client = ans
+        if isinstance(powerGranted, HorizonFrame):
+            powerGranted = self.dispatchHorizon.decode(powerGranted)
+            if powerGranted is None:
+                self.logger.info("dispatch frame out of sequence, waiting for a keyframe")
+                return
         if type == self.type:
             self.logger.info("received allocated power")
 # riaps:keep_control:end
@@ -73,7 +93,7 @@ class ChargerManager(Component):
         The data is then sent to the predictive device component.
         Message format : {'Date': str, 'aggregatedPower' : float}
         '''
-        msg = self.poller.recv_pyobj()
+        msg = chargerAnsOf(self.poller.recv_capnp())
         for gname, g in self.groups.items():
             self.logger.info('*********EVENT: Sensor Data Received, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
             self.sendEventData({'Event': 'SensorData', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : self.ID})
@@ -88,96 +108,50 @@ class ChargerManager(Component):
         # sending out for prediction only for each hour
         if(date[14:16] == '00' and date[17:19] == '00' ):
             print(date)
-            self.updatedData = {'Date': date , 'aggregatedPower':self.aggregatedPower }
-            # vote for consensus
-            self.tick.setDelay(1.0)
-            self.tick.launch()
+            self.updateAndPredict.send_pyobj({'Date': date , 'aggregatedPower':self.aggregatedPower })
 # riaps:keep_poller:end
 
-    def on_tick(self):
-        now = self.tick.recv_pyobj()
-        for gname, g in self.groups.items():
-            if self.ready:
-                self.myrfcID = g.requestVote_pyobj(self.updatedData) # Majority vote
-                self.logger.info('*********EVENT: Begun Voting, GROUP: %s, ID: %s, RFCID: %s*********' %(g.getGroupName(), self.ID, self.myrfcID))
-                self.sendEventData({'Event': 'VoteBegin', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : self.myrfcID})
-                self.tick.halt()
-            elif g.groupSize() <= 2:
-                self.tick.halt()
-                self.updateAndPredict.send_pyobj(self.updatedData)
-            else:
-                self.logger.info("no leader yet [%d]" % g.groupSize())
-                self.tick.setDelay(1.0)
-                self.tick.launch()
-                
     def on_votetrigger(self):
         now = self.votetrigger.recv_pyobj()
-        self.logger.info('on_votetrigger(): %s' % self.ID)
-        self.waitforData +=1
-        if self.waitforData > 3 and self.updatedData is None:
-            self.waitforData = 0
-            vote = False
-            for rfcId, msg in self.pendingVote.items():
-                for gname, g in self.groups.items():
-                    g.sendVote(rfcId,vote)
-            self.pendingVote = {}
-                    
-        elif self.updatedData is not None:
-            self.waitforData = 0
-            for rfcId, msg in self.pendingVote.items():
-                vote = abs(msg['aggregatedPower'] - self.updatedData['aggregatedPower'])/(self.updatedData['aggregatedPower']+1e-9) <= 0.05
-                for gname, g in self.groups.items():
-                    g.sendVote(rfcId,vote)
-            self.pendingVote = {}
-        else:
-            self.logger.info("waiting for device data")
-            self.votetrigger.setDelay(5.0)
+        self.votes.expire()
+
+    def armVote(self, delay):
+        '''
+        Launch the deadline timer of the votes, halt it if delay is None
+        '''
+        self.votetrigger.halt()
+        if delay is not None:
+            self.votetrigger.setDelay(delay)
             self.votetrigger.launch()
-                
-              
+
+    def voteEvent(self, event, group, who):
+        self.logger.info('*********EVENT: %s, GROUP: %s, ID: %s, FOR: %s*********' %(event, group.getGroupName(), self.ID, str(who)))
+        self.sendEventData({'Event': event, 'Group': group.getGroupName(), 'ID' : self.ID, 'For' : who if who is not None else self.ID})
+
+    def sendData(self, data):
+        '''
+        Send the request agreed on by the group to the Coordinator
+        '''
+        reqID, reqKind, reqTime, reqPower, currPower = data
+        if self.horizon is not None:
+            reqPower = self.horizon.encode(reqPower)
+        self.reqPower.send_capnp(powerRequest(reqID, reqKind, reqTime, reqPower, currPower))
+        self.logger.info("votes: %s" % str(self.votes.stats()))
+        self.logger.info("tolerance: %s" % str({gname: vote.stats() for gname, vote in self.tolerances.items()}))
+
     def handleVoteRequest(self,group,rfcId):
         assert (group in self.groups.values())
         msg = group.recv_pyobj()
-        vote = 'pending'
-        if self.updatedData is not None:
-            vote = abs(msg['aggregatedPower'] - self.updatedData['aggregatedPower'])/(self.updatedData['aggregatedPower']+1e-9) <= 0.05
-            group.sendVote(rfcId,vote)  
-        else:
-            self.pendingVote[rfcId] = msg
-            self.votetrigger.setDelay(5.0)
-            self.votetrigger.launch()   
-#         self.logger.info('handleVoteRequest[%s] = %s -->  %s' % (str(rfcId),str(msg['aggregatedPower']), str(vote)))
-        
+        self.votes.voteRequest(group, rfcId, msg)
+
     def handleVoteResult(self,group,rfcId,vote):
         assert (group in self.groups.values())
-#         self.logger.info('handleVoteResult[%s] = %s ' % (str(rfcId),str(vote)))
-        if rfcId   ==   self.myrfcID:
-            self.logger.info('*********EVENT: Voting Result, GROUP: %s, ID: %s, RFCID: %s*********' %(group.getGroupName(), self.ID, rfcId))
-            self.sendEventData({'Event': 'VoteEnd', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : rfcId})
-        self.voteLib[rfcId] = str(vote)
-        if len(self.voteLib) == group.groupSize()-1:
-            if group.isLeader(): 
-                if self.voteLib[self.myrfcID] == 'yes': 
-                    self.logger.info("verified result is correct")
-                    group.send_pyobj(self.myrfcID)
-                else:
-                    sent = False
-                    for key in [key for key in self.voteLib if not key == self.myrfcID and self.voteLib[key] == 'yes']:
-                        self.logger.info("asking other member to send data")
-                        group.send_pyobj(key)
-                        sent = True 
-                        break
-                    if not sent:
-                        group.send_pyobj(self.myrfcID)
-                        
+        self.votes.voteResult(group, rfcId, vote)
+
     def handleGroupMessage(self, group):
         assert (group in self.groups.values())
         msg = group.recv_pyobj()
-        if msg == self.myrfcID:
-            self.logger.info('*********EVENT: Send Consumption Data, GROUP: %s, ID: %s*********' %(group.getGroupName(), self.ID))
-            self.sendEventData({'Event': 'SendReqPower', 'Group': group.getGroupName(), 'ID' : self.ID, 'For' : self.ID})
-            self.updateAndPredict.send_pyobj(self.updatedData)
-        self.voteLib = {}
+        self.votes.groupMessage(group, msg)
 
 # riaps:keep_trigger:begin
     def on_trigger(self):
@@ -202,14 +176,14 @@ class ChargerManager(Component):
         reqTime : the current time step
         reqPower : the predicted power consumption for some future time horizon
         currPower : the power consumption at the current time step
+        The replicas vote on the request before it is sent.
         '''
         msg = self.updateAndPredict.recv_pyobj()
 #         self.logger.info("prediction for the next time step: %s" % str(msg))
         powerReq = (self.ID, self.type, self.msgTime, msg, self.aggregatedPower )
-        for gname,g in self.groups.items():
-            self.logger.info('*********EVENT: Send Consumption Data, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
-            self.sendEventData({'Event': 'SendReqPower', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : self.ID})
-        self.reqPower.send_pyobj(powerReq)
+        self.updatedData = powerReq
+        # vote for consensus
+        self.votes.update(self.updatedData)
         
 # riaps:keep_impl:begin
 
@@ -217,16 +191,16 @@ class ChargerManager(Component):
         assert (group in self.groups.values())
         self.logger.info('*********EVENT: Leader Elected, GROUP: %s, ID: %s*********' %(group.getGroupName(), self.ID))
         self.sendEventData({'Event': 'LeaderElected', 'Group': group.getGroupName(), 'ID' : self.ID, 'For' : leaderId})
-        self.ready = True
+        self.votes.leaderElected(group)
         
     def handleLeaderExited(self, group, leaderId):
         assert (group in self.groups.values())
         self.logger.info('*********EVENT: Leader Left, GROUP: %s, ID: %s, LeaderID: %s*********' %(group.getGroupName(), self.ID, leaderId))
         self.sendEventData({'Event': 'LeaderLeft', 'Group': group.getGroupName(), 'ID' : self.ID, 'For' : leaderId})
-        self.ready = False
+        self.votes.leaderExited(group)
         
     def handleMemberLeft(self,group,memberId):
-        assert (group in self.groups)
+        assert (group in self.groups.values())
         self.logger.info('*********EVENT: Member Left, GROUP: %s, ID: %s, MemberID: %s*********' %(group.getGroupName(), self.ID, memberId))
         self.sendEventData({'Event': 'MemberLeft', 'Group': group.getGroupName(), 'ID' : self.ID, 'For' : memberId})
 
@@ -0,0 +1,325 @@
+'''
+Playback engines of the ChargerInterface
+
+SQLitePlayback plays the fifteen_min_session table of a ChargePoint export one time
+step at a time. The database is opened once, read-only and immutable (the exports do
+not change during a run). An index on stationTime is created if it is missing, so a
+time window is an index range scan whatever the size of the export. The windows
+are read prefetch steps at a time with one range query, a forward cursor over the
+index, and served from memory. The statements are kept prepared by the connection
+(same SQL text, bound parameters).
+
+CSVPlayback plays a power profile (stationTime, rollingPowerAvg) from a csv file. The
+file is parsed once into an int64 array of epoch seconds and a float array of values.
+Time is an integer cursor, a time step is a binary search, and take(k) returns the
+next k steps in one call for fast-forward replays and backfills.
+'''
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pandas as pd
+
+INDEX_NAME = 'idx_fifteen_min_session_stationTime'
+COLUMNS = ('stationID', 'portNumber', 'sessionID', 'stationTime', 'energyConsumed', 'peakPower', 'rollingPowerAvg')
+# first time that contains the given hour 'HH:', in time order
+START_QUERY = 'SELECT stationTime FROM fifteen_min_session WHERE instr(stationTime, ?) > 0 ORDER BY stationTime LIMIT 1'
+WINDOW_QUERY = ('SELECT stationID, portNumber, sessionID, stationTime, energyConsumed, peakPower, rollingPowerAvg '
+                'FROM fifteen_min_session WHERE stationTime >= ? AND stationTime < ? '
+                'ORDER BY stationTime, stationID, sessionID, portNumber')
+
+
+class SQLitePlayback():
+    '''
+    Time step playback of the fifteen_min_session table
+    '''
+    def __init__(self, dbname, Ts=15, tStart=None, prefetch=96, logger=None):
+        '''
+        :param dbname: path of the database file
+        :type dbname: str
+        :param Ts: time step in minutes
+        :type Ts: int
+        :param tStart: first time step 'YYYY-MM-DD HH:MM:SS', if None the first time of the
+            database at the current hour of day
+        :type tStart: str
+        :param prefetch: number of time steps read with one query
+        :type prefetch: int
+        :param logger: logger of the interface
+        '''
+        self.fmt = '%Y-%m-%d %H:%M:%S'
+        self.dbname = dbname
+        self.Ts = Ts
+        self.prefetch = max(1, int(prefetch))
+        self.logger = logger
+        self.ensureIndex()
+        uri = 'file:%s?mode=ro&immutable=1' % os.path.abspath(dbname)
+        self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=16)
+        self.cursor = self.conn.cursor()
+        self.tStart = tStart if tStart is not None else self.firstTime()
+        self.windows = {}
+        self.windowStart = None
+        self.windowEnd = None
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def ensureIndex(self):
+        '''
+        Create the index on stationTime if the database does not have it yet. This is the
+        only write to the database; if it is not writable the playback still works without
+        the index.
+        '''
+        conn = sqlite3.connect(self.dbname)
+        try:
+            found = conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'fifteen_min_session' "
+                                 "AND sql LIKE '%(stationTime)%'").fetchone()
+            if found is None:
+                self.log('creating index %s in %s' % (INDEX_NAME, self.dbname))
+                conn.execute('CREATE INDEX IF NOT EXISTS %s ON fifteen_min_session(stationTime)' % INDEX_NAME)
+                conn.commit()
+        except sqlite3.OperationalError as e:
+            self.log('no index on stationTime in %s: %s' % (self.dbname, str(e)))
+        finally:
+            conn.close()
+
+    def firstTime(self):
+        '''
+        First time of the database at the current hour of day, aligned to the time step.
+        This is the time the pattern search of the original playback returned: all of its
+        patterns contain the hour 'HH:'.
+        '''
+        curr_time = datetime.strftime(datetime.now(), self.fmt)
+        self.cursor.execute(START_QUERY, (curr_time[-8:-5],))
+        try:
+            tStart = self.cursor.fetchone()[0]
+        except TypeError:
+            tStart = '2020-01-02 00:00:00'
+        self.log("returned time %s" % tStart)
+        dt = datetime.strptime(tStart, self.fmt)
+        dt = dt + (datetime.min - dt) % timedelta(minutes=self.Ts)
+        return datetime.strftime(dt, self.fmt)
+
+    def fetch(self, tStart):
+        '''
+        Read the rows of prefetch time steps from tStart
+        '''
+        start = datetime.strptime(tStart, self.fmt)
+        end = start + timedelta(minutes=self.Ts * self.prefetch)
+        self.windowEnd = datetime.strftime(end, self.fmt)
+        self.windows = {}
+        self.cursor.execute(WINDOW_QUERY, (tStart, self.windowEnd))
+        # one row per station and time step, the first session as the GROUP BY of the
+        # original query (it scans the primary key)
+        last = None
+        for row in self.cursor:
+            if (row[3], row[0]) != last:
+                self.windows.setdefault(row[3], []).append(row)
+                last = (row[3], row[0])
+
+    def rows(self, stationTime):
+        '''
+        Rows of the time step stationTime, one per station
+        '''
+        if self.windowEnd is None or not (self.windowStart <= stationTime < self.windowEnd):
+            self.windowStart = stationTime
+            self.fetch(stationTime)
+        return self.windows.get(stationTime, [])
+
+    def next(self, qty):
+        '''
+        Data of the current time step, then move to the next one
+        :param qty: list of quantities requested
+        :type qty: list
+        :return: the session data as a list of dictionaries
+        :rtype: list
+        '''
+        resultlist = []
+        results = {}
+        for row in self.rows(self.tStart):
+            values = dict(zip(COLUMNS, row))
+            results = {'stationID': values['stationID'], 'portNumber': values['portNumber'],
+                       'sessionID': values['sessionID'], 'stationTime': values['stationTime']}
+            for item in qty:
+                if item == 'all':
+                    results['energyConsumed'] = values['energyConsumed']
+                    results['peakPower'] = values['peakPower']
+                    results['rollingPowerAvg'] = values['rollingPowerAvg']
+                elif item in values:
+                    results[item] = values[item]
+                else:
+                    if self.logger is not None:
+                        self.logger.error("Queried quantity %s not found" % item)
+                    results[item] = 'NA'
+            resultlist.append(results)
+
+        if len(resultlist) == 0:
+            results['stationTime'] = self.tStart
+            results['rollingPowerAvg'] = 0
+            resultlist.append(results)
+        self.tStart = datetime.strftime(datetime.strptime(self.tStart, self.fmt) + timedelta(minutes=self.Ts), self.fmt)
+        return resultlist
+
+    def close(self):
+        try:
+            self.cursor.close()
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+
+
+class CSVPlayback():
+    '''
+    Time step playback of a csv power profile
+    epochs : times of the rows in epoch seconds, sorted
+    values : rollingPowerAvg of the rows
+    labels : times of the rows as 'YYYY-MM-DD HH:MM:SS'
+    '''
+    def __init__(self, filename, Ts=60, tStart=None, logger=None):
+        '''
+        :param filename: path of the csv file, rows of stationTime,rollingPowerAvg
+        :type filename: str
+        :param Ts: time step in minutes
+        :type Ts: int
+        :param tStart: first time step 'YYYY-MM-DD HH:MM:SS', if None the current hour a year ago
+        :type tStart: str
+        :param logger: logger of the interface
+        '''
+        self.fmt = '%Y-%m-%d %H:%M:%S'
+        self.logger = logger
+        sourcefile = pd.read_csv(filename, names=['stationTime', 'rollingPowerAvg'])
+        epochs = pd.to_datetime(sourcefile['stationTime']).to_numpy().astype('datetime64[s]').astype(np.int64)
+        values = sourcefile['rollingPowerAvg'].to_numpy(dtype=np.float64)
+        # sorted, the first row of a repeated time
+        epochs, first = np.unique(epochs, return_index=True)
+        self.epochs = epochs
+        self.values = values[first]
+        self.labels = np.char.replace(np.datetime_as_string(epochs.astype('datetime64[s]'), unit='s'), 'T', ' ')
+        self.step = int(Ts * 60)
+        if tStart is None:
+            tStart = datetime.now() - relativedelta(years=1)
+            tStart = datetime.strftime(tStart.replace(minute=0, second=0, microsecond=0), self.fmt)
+        self.t = self.epochOf(tStart)
+        if self.logger is not None:
+            self.logger.info('playing %d rows of %s from %s' % (len(self.epochs), filename, tStart))
+
+    @staticmethod
+    def epochOf(stamp):
+        return int(np.datetime64(datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S'), 's').astype(np.int64))
+
+    @staticmethod
+    def labelOf(epoch):
+        return str(np.datetime64(int(epoch), 's')).replace('T', ' ')
+
+    @property
+    def tStart(self):
+        return self.labelOf(self.t)
+
+    def take(self, k):
+        '''
+        The next k time steps, then move past them
+        :param k: number of time steps
+        :type k: int
+        :return: times in epoch seconds, rollingPowerAvg (0 where the file has no row)
+            and whether the file has a row for each time
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        '''
+        times = self.t + self.step * np.arange(k, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.epochs, times), len(self.epochs) - 1)
+        found = self.epochs[idx] == times
+        values = np.where(found, self.values[idx], 0.0)
+        self.t += self.step * k
+        return times, values, found
+
+    def next(self):
+        '''
+        Data of the current time step, then move to the next one
+        :return: the session data as a list of one dictionary
+        :rtype: list
+        '''
+        i = np.searchsorted(self.epochs, self.t)
+        if i < len(self.epochs) and self.epochs[i] == self.t:
+            results = {'stationTime': str(self.labels[i]), 'rollingPowerAvg': float(self.values[i])}
+        else:
+            results = {'stationTime': self.tStart, 'rollingPowerAvg': 0}
+        self.t += self.step
+        return [results]
+
+
+def benchmarkCSV(filename='config/EV_power_profile_1hour.csv'):
+    '''
+    Time steps per second of the original pandas playback and of CSVPlayback
+    '''
+    import time
+    fmt = '%Y-%m-%d %H:%M:%S'
+    sourcefile = pd.read_csv(filename, names=['stationTime', 'rollingPowerAvg'])
+    sourcefile['stationTime'] = pd.to_datetime(sourcefile['stationTime'])
+    sourcefile.index = sourcefile['stationTime']
+    steps = 2000
+    tStart = '2019-01-01 00:00:00'
+    t0 = time.perf_counter()
+    for step in range(steps):
+        results = sourcefile.loc[tStart].to_dict()
+        results['stationTime'] = datetime.strftime(results['stationTime'], fmt)
+        tStart = datetime.strftime(datetime.strptime(tStart, fmt) + timedelta(minutes=60), fmt)
+    print('csv original: %.0f steps/s' % (steps / (time.perf_counter() - t0)))
+    playback = CSVPlayback(filename, 60, '2019-01-01 00:00:00')
+    t0 = time.perf_counter()
+    for step in range(steps):
+        playback.next()
+    print('csv next: %.0f steps/s' % (steps / (time.perf_counter() - t0)))
+    playback = CSVPlayback(filename, 60, '2019-01-01 00:00:00')
+    t0 = time.perf_counter()
+    times, values, found = playback.take(len(playback.epochs))
+    print('csv take: %.0f steps/s' % (len(times) / (time.perf_counter() - t0)))
+
+
+if __name__ == '__main__':
+    # per step latency of the original query (new connection, no index) and of the
+    # playback engine on a synthetic multi-year 5 minute export, then the csv playback
+    import sys
+    import tempfile
+    import time
+    import random
+    benchmarkCSV()
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    path = os.path.join(tempfile.mkdtemp(), 'playback.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE fifteen_min_session(stationID text, portNumber integer, sessionID integer, stationTime text, '
+                 'energyConsumed numeric, peakPower numeric, rollingPowerAvg numeric, '
+                 'PRIMARY KEY (stationID, sessionID, portNumber, stationTime))')
+    t = datetime(2019, 1, 1)
+    rows = []
+    for step in range(years * 365 * 288):
+        stamp = datetime.strftime(t + timedelta(minutes=5 * step), '%Y-%m-%d %H:%M:%S')
+        for station in range(4):
+            rows.append(('1:%d' % station, 1, step // 36, stamp, 0.5, 6.0, random.uniform(0, 6)))
+    conn.executemany('INSERT INTO fifteen_min_session VALUES (?,?,?,?,?,?,?)', rows)
+    conn.commit()
+    conn.close()
+    print('%d rows over %d years' % (len(rows), years))
+
+    def original(tStart):
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM fifteen_min_session WHERE stationTime BETWEEN ? AND ? GROUP by stationID,stationTime',
+                       (tStart, tStart))
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+    steps = 200
+    tStart = '2020-06-01 00:00:00'
+    t0 = time.perf_counter()
+    stamp = tStart
+    for step in range(steps):
+        original(stamp)
+        stamp = datetime.strftime(datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S') + timedelta(minutes=5), '%Y-%m-%d %H:%M:%S')
+    print('original: %.3f ms per step' % (1e3 * (time.perf_counter() - t0) / steps))
+    playback = SQLitePlayback(path, 5, tStart)
+    t0 = time.perf_counter()
+    for step in range(steps):
+        playback.next(['all'])
+    print('playback: %.3f ms per step' % (1e3 * (time.perf_counter() - t0) / steps))
+    playback.close()
@@ -0,0 +1,270 @@
+'''
+Realtime fetch engine of the ChargerInterface
+
+A realtime query asks getChargingSessionData for the charging sessions, then
+get15minChargingSessionData for each of them. The per-session calls are issued
+concurrently from a bounded thread pool over one HTTP session, so the query takes
+about one round trip however many sessions are active. The connections are kept
+alive and pooled per host, and the parsed WSDL is cached on disk by zeep.
+
+SessionTracker keeps the sessions between polls. The first poll looks at the last 8
+hours, the next ones only at the time since the previous poll, so a poll only finds
+the new sessions. The 15 minute data is fetched for the running sessions only. The
+get15minChargingSessionData call has no time range, so every poll still downloads
+the whole history of each running session, and only the parsing stops at the start
+of the window. A session is evicted once it has ended and has no interval left in
+the current window. A session that is not seen to end is given up once it has had
+no interval for the idle limit (8 hours by default), and a session whose data
+cannot be fetched after a number of polls in a row.
+'''
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from zeep import Client
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+from zeep.wsse.username import UsernameToken
+
+
+class TrackedSession():
+    '''
+    A charging session seen by the polls
+    '''
+    def __init__(self, sessionID, seen):
+        self.sessionID = sessionID
+        self.seen = seen
+        self.endTime = None
+        self.lastSeen = None
+        self.data = None
+        self.fetched = None
+        self.failures = 0
+
+    @property
+    def final(self):
+        '''
+        True once the data was fetched after the end of the session
+        '''
+        return self.endTime is not None and self.lastSeen is not None and self.data is not None and self.fetched >= self.endTime
+
+
+def naive(dt):
+    return dt.replace(tzinfo=None, microsecond=0)
+
+
+class SessionTracker():
+    '''
+    Sessions known to the realtime polls
+    sessions : {sessionID: TrackedSession}, in the order they were found
+    evicted : {sessionID: time of eviction}, so the overlap of the next polls does not find them again
+    '''
+    def __init__(self, history=timedelta(hours=8), overlap=timedelta(minutes=15), idle=None, maxFailures=12):
+        '''
+        :param history: time the first poll looks back at
+        :type history: timedelta
+        :param overlap: margin of the next polls before the previous poll
+        :type overlap: timedelta
+        :param idle: time without an interval after which a session is given up, history if None
+        :type idle: timedelta
+        :param maxFailures: failed fetches in a row after which a session is given up
+        :type maxFailures: int
+        '''
+        self.history = history
+        self.overlap = overlap
+        self.idle = idle if idle is not None else history
+        self.maxFailures = maxFailures
+        self.sessions = {}
+        self.evicted = {}
+        self.lastPoll = None
+
+    def searchFrom(self, now):
+        '''
+        Start of the session search of a poll
+        '''
+        if self.lastPoll is None:
+            return now - self.history
+        return min(self.lastPoll - self.overlap, now)
+
+    def discover(self, sessions, now):
+        '''
+        Add the sessions found by a poll and note their end
+        :param sessions: the ChargingSessionData of getChargingSessionData
+        '''
+        for d in sessions:
+            if d.sessionID in self.evicted:
+                continue
+            session = self.sessions.get(d.sessionID)
+            if session is None:
+                session = self.sessions[d.sessionID] = TrackedSession(d.sessionID, now)
+            endTime = getattr(d, 'endTime', None)
+            if isinstance(endTime, datetime):
+                session.endTime = naive(endTime)
+        self.lastPoll = now
+
+    def pending(self):
+        '''
+        The sessions whose data has to be fetched
+        '''
+        return [sessionID for sessionID, session in self.sessions.items() if not session.final]
+
+    def update(self, sessionID, data, now):
+        '''
+        Keep the 15 minute data of a session
+        '''
+        session = self.sessions[sessionID]
+        session.data = data
+        session.fetched = now
+        session.failures = 0
+        if data.fifteenminData:
+            session.lastSeen = naive(data.fifteenminData[-1].stationTime)
+
+    def failed(self, sessionID):
+        '''
+        Count a failed fetch of the data of a session
+        '''
+        self.sessions[sessionID].failures += 1
+
+    def evict(self, windowStart):
+        '''
+        Drop the sessions that have ended, once they have no interval in the current window,
+        and give up the sessions idle for longer than the idle limit or failing to be fetched
+        :return: the sessions given up
+        :rtype: list
+        '''
+        stale = []
+        for sessionID, session in list(self.sessions.items()):
+            last = session.lastSeen or session.seen
+            if session.failures >= self.maxFailures or last < windowStart - self.idle:
+                stale.append(sessionID)
+            elif last >= windowStart or not session.final:
+                continue
+            del self.sessions[sessionID]
+            self.evicted[sessionID] = windowStart
+        self.evicted = {sessionID: t for sessionID, t in self.evicted.items() if t >= windowStart - self.history}
+        return stale
+
+
+class RealtimeFetcher():
+    '''
+    Charging session data of the ChargePoint SOAP API
+    tracker : the sessions between polls
+    '''
+    def __init__(self, wsdl_url, username, password, workers=8, timeout=30, wsdl_cache=None, logger=None,
+                 idle=8, max_failures=12):
+        '''
+        :param wsdl_url: url of the ChargePoint WSDL
+        :type wsdl_url: str
+        :param username: API username
+        :param password: API password
+        :param workers: largest number of calls in flight
+        :type workers: int
+        :param timeout: timeout of a call in seconds
+        :type timeout: float
+        :param wsdl_cache: path of the WSDL cache, None for the zeep default
+        :type wsdl_cache: str
+        :param logger: logger of the interface
+        :param idle: hours without an interval after which a session that is not seen to end is given up
+        :type idle: float
+        :param max_failures: failed fetches in a row after which a session is given up
+        :type max_failures: int
+        '''
+        self.fmt = '%Y-%m-%d %H:%M:%S'
+        self.logger = logger
+        self.workers = max(1, int(workers))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        cache = SqliteCache(path=wsdl_cache, timeout=86400) if wsdl_cache is not None else SqliteCache(timeout=86400)
+        transport = Transport(session=self.session, cache=cache, timeout=timeout, operation_timeout=timeout)
+        self.client = Client(wsdl_url, wsse=UsernameToken(username, password), transport=transport)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.tracker = SessionTracker(idle=timedelta(hours=idle), maxFailures=max_failures)
+        self.calls = 0
+
+    def sessionData(self, sessionID):
+        '''
+        15 minute data of a session
+        :return: the data, None if the call failed
+        '''
+        try:
+            return self.client.service.get15minChargingSessionData(sessionID=sessionID)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("Unable to get15minChargingSessionData of %s : %s" % (str(sessionID), e))
+            return None
+
+    def resultsOf(self, data, windowStart, windowEnd, qty):
+        '''
+        The 15 minute data of a session in the window, as dictionaries of the queried values.
+        The intervals are in time order, so the parsing stops at the start of the window.
+        '''
+        resultlist = []
+        for d in reversed(data.fifteenminData or []):
+            # check if the session time is within the window
+            stationTime = naive(d.stationTime)
+            if stationTime < windowStart:
+                break
+            if stationTime <= windowEnd:
+                results = {'stationID': data.stationID, 'portNumber': data.portNumber, 'sessionID': data.sessionID, 'stationTime': d.stationTime}
+                for item in qty:
+                    if item == 'all':
+                        results['energyConsumed'] = d.energyConsumed
+                        results['peakPower'] = d.peakPower
+                        results['rollingPowerAvg'] = d.rollingPowerAvg
+                    else:
+                        try: value = getattr(d, item)
+                        except:
+                            if self.logger is not None:
+                                self.logger.error("Queried quantity %s not found" % item)
+                            results[item] = 'NA'
+                        else:
+                            results[item] = value
+                resultlist.append(results)
+        resultlist.reverse()
+        return resultlist
+
+    def fetch(self, qty, now=None):
+        '''
+        Charging session information of the current 15 minute window
+        :param qty: list of quantities requested
+        :type qty: list
+        :param now: the current time, datetime.now() if None
+        :type now: datetime
+        :return: the session data as a list of dictionaries
+        :rtype: list
+        '''
+        resultlist = []
+        # the first poll looks at the last 8 hours, the next ones at the time since the previous poll
+        tStart = (now or datetime.now()).replace(second=0, microsecond=0)
+        usageSearchQuery = {'toTimeStamp': tStart, 'fromTimeStamp': self.tracker.searchFrom(tStart)}
+        try:
+            res = self.client.service.getChargingSessionData(usageSearchQuery)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error("Unable to getChargingSessionData : %s" % e)
+            return resultlist
+        sessions = res.ChargingSessionData if res is not None and res.ChargingSessionData is not None else []
+        self.tracker.discover(sessions, tStart)
+        # round up the starting time to the nearest 15 min interval and look at sessions that have begun since then
+        windowEnd = tStart
+        windowStart = tStart - timedelta(minutes=tStart.minute % 15)
+        pending = self.tracker.pending()
+        fetched = self.pool.map(self.sessionData, pending)
+        self.calls += len(pending)
+        for sessionID, data in zip(pending, fetched):
+            if data is not None:
+                self.tracker.update(sessionID, data, tStart)
+            else:
+                self.tracker.failed(sessionID)
+        for session in self.tracker.sessions.values():
+            if session.data is not None:
+                resultlist += self.resultsOf(session.data, windowStart, windowEnd, qty)
+        stale = self.tracker.evict(windowStart)
+        if len(stale) > 0 and self.logger is not None:
+            self.logger.info("Sessions %s given up: idle or failing to be fetched" % str(stale))
+        return resultlist
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.session.close()
@@ -7,13 +7,18 @@ from array import array
 import pulp as plp
 from pulp.constants import LpMinimize
 from pulp.apis.cplex_api import CPLEX_PY
-import docplex.mp.model as cpx
-from math import exp
 import yaml
 from datetime import datetime
 import numpy as np
 import random
 import time
+from DispatchEngine import buildProblem, makeEngine, DispatchSolution
+from RequestAggregator import RequestAggregator
+from DualDispatch import SharingDispatch, LocalDispatch
+from DispatchCache import DispatchCache
+from LogData import series
+from Messages import powerRequestOf, powerDispatched, gridPowerOf, logData
+from HorizonDelta import HorizonEncoder, HorizonDecoder, HorizonFrame
 
 # riaps:keep_import:end
 
@@ -33,12 +38,32 @@ class Coordinator(Component):
         :type configfile: str   
         '''
         super(Coordinator, self).__init__()
+        self.logger.info('the coordinator component starts')
+        _config = "config/" + configfile
+        with open(_config, 'r') as stream:
+            try:
+                table_config= yaml.safe_load(stream)
+            except yaml.YAMLError as exc:
+                print(exc)
+        self.configure(table_config)
+        self.grpType = grptype.split(',')
+        self.ready = False
+        self.ID = id
+        self.groups = {}
+        
+# riaps:keep_constr:end
+
+    def configure(self, table_config):
+        '''
+        Dispatch state and settings of the configuration file
+        :param table_config: contents of the configuration file
+        :type table_config: dict
+        '''
         self.futureTimeStep = 24
         self.Psupply = [1000]*24
         self.purchasedPower = [1000]*24
         self.reqMap = {}
         self.dspMap = {}
-        self.logger.info('the coordinator component starts')
         
         #commands from GUI
         self.microgridMode = 0
@@ -51,7 +76,7 @@ class Coordinator(Component):
         self.Pbuilding = 0
         self.Pev = 0
         self.Pbattery = 0
-        self.SoCbattery = 0
+        self.SoCbattery = {}
         
         self.Pred_building= 0
         self.Disp_building = 0
@@ -60,21 +85,71 @@ class Coordinator(Component):
         self.Disp_battery = 0       
         
         self.gridPower24ahead = 0
+        self.totalDispatch = np.zeros(self.futureTimeStep)
         
         self.Ts = 60 * 60
-        _config = "config/" + configfile
-        with open(_config, 'r') as stream:
-            try:
-                table_config= yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
         self.table_struct = table_config['table_struct']
-        self.grpType = grptype.split(',')
-        self.ready = False
-        self.ID = id
-        self.groups = {}
-        
-# riaps:keep_constr:end
+        # dispatch engine {'numpy', 'cplex'}
+        try:
+            self.engine = makeEngine(table_config['dispatch_engine'])
+        except KeyError:
+            self.engine = makeEngine('numpy')
+        # quorum (fraction of the known managers) and deadline (sec) for starting a dispatch,
+        # and the number of missed rounds after which a manager is forgotten
+        quorum, deadline, expiry = 1.0, 60.0, 3
+        try: quorum = float(table_config['dispatch_quorum'])
+        except KeyError: pass
+        try: deadline = float(table_config['dispatch_deadline'])
+        except KeyError: pass
+        try: expiry = int(table_config['dispatch_expiry'])
+        except KeyError: pass
+        self.requests = RequestAggregator(self.futureTimeStep, quorum, deadline, expiry)
+        # cache of dispatch solutions: number of entries (0 disables it), lifetime (sec)
+        # and resolution (kW) of the request fingerprint
+        size, ttl, quantum = 64, 24 * 3600, 1.0
+        try: size = int(table_config['dispatch_cache_size'])
+        except KeyError: pass
+        try: ttl = table_config['dispatch_cache_ttl']
+        except KeyError: pass
+        try: quantum = float(table_config['dispatch_cache_quantum'])
+        except KeyError: pass
+        self.cache = DispatchCache(size, ttl, quantum)
+        self.reqMap = self.requests.reqMap
+        # requests of the round being dispatched
+        self.roundRequests = RequestAggregator(self.futureTimeStep)
+        # dispatch mode {'central', 'dual'}: in dual mode the leader decomposes the dispatch
+        # over the members of the coordinator group (see DualDispatch)
+        self.dispatchMode = 'central'
+        try: self.dispatchMode = table_config['dispatch_mode']
+        except KeyError: pass
+        # penalty floor for each microgrid mode, iteration limit and timeout (sec) of an iteration
+        self.dualRhoFloor = [0.05, 1.0]
+        self.dualMaxIter = 1000
+        self.dualTimeout = 2.0
+        try: self.dualRhoFloor = list(table_config['dual_rho_floor'])
+        except KeyError: pass
+        try: self.dualMaxIter = int(table_config['dual_maxiter'])
+        except KeyError: pass
+        try: self.dualTimeout = float(table_config['dual_timeout'])
+        except KeyError: pass
+        self.peers = set()
+        self.pending = set()
+        self.sharing = None
+        self.sharingGroup = None
+        self.sharingStart = 0
+        self.localProblem = None
+        self.localDispatch = LocalDispatch()
+        # delta encoding of the dispatched power: resolution (kW, 0 sends the whole horizon)
+        # and number of frames between two keyframes (see HorizonDelta)
+        self.dispatchDelta = 0.0
+        self.dispatchKeyframe = 12
+        try: self.dispatchDelta = float(table_config['dispatch_delta'])
+        except KeyError: pass
+        try: self.dispatchKeyframe = int(table_config['dispatch_keyframe'])
+        except KeyError: pass
+        # {client: HorizonEncoder} of the dispatch, {reqID: HorizonDecoder} of the requests
+        self.dispatchHorizons = {}
+        self.requestHorizons = {}
 
     def handleActivate(self):
         for groupname in self.grpType:
@@ -96,85 +171,234 @@ class Coordinator(Component):
         reqID : ID of the individual unit requesting power
         reqKind : type of load {'BU' - Builings, 'EV' - EV Chargers, 'BESS" - Battery Units}
         reqTime : the current time step
-        reqPower : the predicted power consumption for some future time horizon
+        reqPower : the predicted power consumption for some future time horizon, or its HorizonFrame in delta mode
         currPower : the power consumption at the current time step
         '''
-        qry = self.reqPower.recv_pyobj()
+        qry = powerRequestOf(self.reqPower.recv_capnp())
 #         self.logger.info("received query : %s" % str(qry))
         (reqID,reqKind,reqTime,reqPower,currPower) = qry         
         reqClient= reqID[:-1]
+        if isinstance(reqPower, HorizonFrame):
+            # delta mode of the manager
+            reqPower = self.requestHorizons.setdefault(reqID, HorizonDecoder()).decode(reqPower)
+            if reqPower is None:
+                self.logger.info("request frame of %s out of sequence, waiting for a keyframe" % reqID)
+                return
         for gname, g in self.groups.items():
             self.logger.info('*********EVENT: Received Consumption Data, GROUP: %s, ID: %s, SenderID: %s*********' %(g.getGroupName(), self.ID, reqID))
             self.sendEventData({'Event': 'ReqPower', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : reqID})
             
         if reqClient in self.reqMap:
             self.logger.info("!!!!!! %s already exists!!!!!!" % reqID)
-        self.reqMap[reqClient] = (reqKind, reqPower, reqTime, currPower)
-        
-        assert len(self.reqMap) <= 3
-        
-        print(self.reqMap)
-        print(len(self.reqMap))
-        
-        if len(self.reqMap) == 3:
-            sumReqPower = 0
-            #purchase power for 24 time steps later
-            for reqClient, request in self.reqMap.items():
-                if (request[0] == 'BU') or (request[0] == 'EV'):
-                    sumReqPower = request[1][-1] + sumReqPower
-                    
-            self.purchasedPower.append(sumReqPower)
-            self.purchasedPower.pop(0)
-            print(self.purchasedPower)
-            
-            for gname, g in self.groups.items():
-                if g.isLeader() or g.groupSize() <= 2:
-                    self.logger.info('*********EVENT: Begin Optimization, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
-                    self.sendEventData({'Event': 'Optimzation', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : self.ID})
-                    self.predictiveDispatchQP()
-                    for client, values in self.dspMap.items():
-                        self.dspPower.send_pyobj(self.dspMap[client])
-                        self.logger.info('*********EVENT: Sent Dispatched Power, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
-                        self.sendEventData({'Event': 'SendPower', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : client})
-                    self.reqMap = {}
-                elif not g.isLeader():
-                    self.logger.info("not a leader %s" % self.ID)
-                    self.reqMap = {}
-                    
-                else:
-                    self.logger.info("group not ready")
-                    self.tick.setDelay(5.0)
-                    self.tick.launch()
+        first = self.requests.add(reqClient, reqKind, reqPower, reqTime, currPower)
+        self.logger.info("%d requests, %d managers known" % (len(self.reqMap), len(self.requests.known())))
+
+        if self.requests.ready():
+            self.tick.halt()
+            self.dispatch()
+        elif first:
+            # dispatch with the requests received so far once the deadline passes
+            self.tick.setDelay(self.requests.deadline)
+            self.tick.launch()
 # riaps:keep_query:end
 
     def on_tick(self):
         now = self.tick.recv_pyobj()
+        self.tick.halt()
+        if len(self.reqMap) > 0:
+            self.logger.info("dispatch deadline with %d of %d known managers" % (len(self.reqMap), len(self.requests.known())))
+            self.dispatch()
+
+    def dispatch(self):
+        '''
+        Purchase power for the end of the horizon and, on the leader, run the optimization
+        for the requests of this round and send the dispatched power to the managers.
+        In dual mode the leader decomposes the optimization over the other coordinators
+        and the round is sent once the iterations are over (see finishSharing). The
+        requests received in the meantime wait for the next round.
+        '''
+        if self.sharing is not None:
+            self.logger.info("dual dispatch in progress, %d requests wait" % len(self.reqMap))
+            return
+        self.roundRequests = self.requests.take()
+        #purchase power for 24 time steps later
+        self.purchasedPower.append(float(self.roundRequests.loadSum()[-1]))
+        self.purchasedPower.pop(0)
+
         for gname, g in self.groups.items():
+            # snapshot of the round for the local problems of the decomposed dispatch
+            self.localProblem = self.roundProblem()
             if g.isLeader() or g.groupSize() <= 2:
-                self.tick.halt()
                 self.logger.info('*********EVENT: Begin Optimization, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
                 self.sendEventData({'Event': 'Optimzation', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : self.ID})
-                self.predictiveDispatchQP()
-                for client, values in self.dspMap.items():
-                    self.dspPower.send_pyobj(self.dspMap[client])
-                    self.logger.info('*********EVENT: Sent Dispatched Power, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
-                    self.sendEventData({'Event': 'SendPower', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : client})
-                    
-                self.reqMap = {}
-            elif not g.isLeader():
-                self.logger.info("not a leader %s" % self.ID)
-                        
+                if self.cachedDispatch(self.localProblem):
+                    pass
+                elif self.dispatchMode == 'dual' and g.isLeader() and len(self.peers) > 0:
+                    self.startSharing(g, self.localProblem)
+                    return
+                else:
+                    self.predictiveDispatchQP(self.localProblem)
+                self.sendDispatch(g)
             else:
-                self.logger.info("group not ready")
-                self.tick.setDelay(5.0)
-                self.tick.launch()
-        
+                self.logger.info("not a leader %s" % self.ID)
+            break
+
+    def sendDispatch(self, g):
+        '''
+        Send the dispatched power to the managers, in one message indexed by client:
+        every manager receives the round once and reads only its own dispatch
+        '''
+        frames = {}
+        for client, values in self.dspMap.items():
+            reqKind, powerGranted = values
+            if self.dispatchDelta > 0:
+                if client not in self.dispatchHorizons:
+                    self.dispatchHorizons[client] = HorizonEncoder(self.dispatchDelta, self.dispatchKeyframe)
+                powerGranted = self.dispatchHorizons[client].encode(powerGranted)
+            frames[client] = (reqKind, powerGranted)
+        self.dspPower.send_capnp(powerDispatched(frames))
+        self.logger.info('*********EVENT: Sent Dispatched Power, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
+        for client in frames:
+            self.sendEventData({'Event': 'SendPower', 'Group': g.getGroupName(), 'ID' : self.ID, 'For' : client})
+
+    def startSharing(self, g, problem):
+        '''
+        Start the decomposed dispatch of the round: the clients are spread over this
+        coordinator and the peers that announced themselves in the group.
+        '''
+        mode = min(int(self.microgridMode), len(self.dualRhoFloor) - 1)
+        self.sharing = SharingDispatch(problem, float(self.dualRhoFloor[mode]), maxIter=self.dualMaxIter)
+        self.sharing.assign(sorted(self.peers) + [self.ID])
+        self.sharingGroup = g
+        self.sharingStart = time.time()
+        self.localDispatch.reset()
+        self.logger.info('dual dispatch over %s' % str(sorted(set(self.sharing.assignment.values()))))
+        self.runSharing()
+
+    def runSharing(self):
+        '''
+        Run iterations of the decomposed dispatch until the answers of other coordinators
+        are needed or the iterations are over.
+        The outgoing message format is ('prices', start, iteration, v, rho, assignment)
+        start : start of the horizon of the round
+        iteration : iteration number
+        v : correction xbar - zbar + u of each time step
+        rho : penalty of each time step
+        assignment : {client: ID of the coordinator solving its local problem}
+        '''
+        s = self.sharing
+        while not s.done:
+            self.pending = set(owner for owner in s.assignment.values() if owner != self.ID)
+            if len(self.pending) > 0:
+                self.sharingGroup.send_pyobj(('prices', s.problem.start, s.iteration, s.v.tolist(), s.rho.tolist(), s.assignment))
+            s.solveLocal(self.localDispatch, s.clientsOf(self.ID))
+            if len(self.pending) > 0:
+                self.dualtick.setDelay(self.dualTimeout)
+                self.dualtick.launch()
+                return
+            s.update()
+        self.finishSharing()
+
+    def collectLocal(self, start, iteration, peer, local):
+        '''
+        Collect the local solutions of a peer for the current iteration. Clients the peer
+        could not solve are solved by the leader.
+        '''
+        s = self.sharing
+        if s is None or s.done or start != s.problem.start or iteration != s.iteration or peer not in self.pending:
+            return
+        self.pending.discard(peer)
+        s.collect({client: values for client, values in local.items() if s.assignment.get(client) == peer})
+        missing = [client for client in s.clientsOf(peer) if client not in local]
+        if len(missing) > 0:
+            s.solveLocal(self.localDispatch, missing)
+        if len(self.pending) == 0:
+            self.dualtick.halt()
+            s.update()
+            self.runSharing()
+
+    def on_dualtick(self):
+        '''
+        Timeout of an iteration of the decomposed dispatch: the leader takes over the
+        clients of the coordinators that did not answer.
+        '''
+        now = self.dualtick.recv_pyobj()
+        self.dualtick.halt()
+        s = self.sharing
+        if s is None or s.done or len(self.pending) == 0:
+            return
+        self.logger.info('dual dispatch iteration %d: no answer from %s' % (s.iteration, str(sorted(self.pending))))
+        for peer in self.pending:
+            self.peers.discard(peer)
+            clients = s.clientsOf(peer)
+            for client in clients:
+                s.assignment[client] = self.ID
+            s.solveLocal(self.localDispatch, clients)
+        self.pending = set()
+        s.update()
+        self.runSharing()
+
+    def finishSharing(self):
+        '''
+        Store and send the result of the decomposed dispatch. If the iterations did not
+        converge to a dispatch that meets the constraints the round is dispatched by the
+        central engine. The requests received during the iterations are dispatched next.
+        '''
+        s = self.sharing
+        x = s.dispatch()
+        self.logger.info('dual dispatch %s after %d iterations, violation %.3g kW' % (s.status, s.iteration, s.problem.violation(x)))
+        if s.status == 'optimal' and s.problem.feasible(x):
+            solution = DispatchSolution(x, s.problem.objective(x), s.status, s.iteration, time.time() - self.sharingStart)
+            self.cache.put(self.cache.key(s.problem, self.settings()), s.problem, self.settings(), solution)
+            self.storeDispatch(s.problem, x, s.status, solution.objective, solution.solveTime, 'dual')
+        else:
+            self.predictiveDispatchQP(s.problem)
+        self.sendDispatch(self.sharingGroup)
+        self.sharing = None
+        if self.requests.ready():
+            self.tick.halt()
+            self.dispatch()
+        elif len(self.reqMap) > 0:
+            # the deadline of the next round starts now
+            self.tick.halt()
+            self.tick.setDelay(self.requests.deadline)
+            self.tick.launch()
+
+    def handleGroupMessage(self, group):
+        '''
+        Messages of the decomposed dispatch
+        ('hello', ID) : a coordinator announces itself
+        ('prices', start, iteration, v, rho, assignment) : the leader asks for local solutions
+        ('local', start, iteration, ID, {client: dispatched power}) : local solutions of a coordinator
+        '''
+        assert (group in self.groups.values())
+        msg = group.recv_pyobj()
+        if msg[0] == 'hello':
+            if msg[1] != self.ID and msg[1] not in self.peers:
+                self.peers.add(msg[1])
+                group.send_pyobj(('hello', self.ID))
+        elif msg[0] == 'prices':
+            (start, iteration, v, rho, assignment) = msg[1:]
+            clients = [client for client, owner in assignment.items() if owner == self.ID]
+            if len(clients) == 0:
+                return
+            local = {}
+            problem = self.localProblem
+            if problem is not None and problem.start == start:
+                if iteration == 0:
+                    self.localDispatch.reset()
+                local = self.localDispatch.solve(problem, [client for client in clients if client in problem.clients], v, rho)
+            group.send_pyobj(('local', start, iteration, self.ID, local))
+        elif msg[0] == 'local':
+            self.collectLocal(*msg[1:])
+
                 
     def handleLeaderElected(self, group, leaderId):
         assert (group in self.groups.values())
         self.logger.info('*********EVENT: Leader Elected, GROUP: %s, ID: %s*********' %(group.getGroupName(), self.ID))
         self.sendEventData({'Event': 'LeaderElected', 'Group': group.getGroupName(), 'ID' : self.ID, 'For' : leaderId})
         self.ready = True
+        group.send_pyobj(('hello', self.ID))
         
     def handleLeaderExited(self, group, leaderId):
         assert (group in self.groups.values())
@@ -198,7 +422,7 @@ class Coordinator(Component):
         4. weight for building in the optimization algorithm (default to 1)
         5. weight for EV in the optimization algorithm (default to 1)     
         '''
-        ts, val = self.power.recv_pyobj()
+        ts, val = gridPowerOf(self.power.recv_capnp())
         self.logger.info('grid commands received at %s : %s' % (str(ts), str(val)))
         for gname, g in self.groups.items():
             self.logger.info('*********EVENT: Received Grid Data, GROUP: %s, ID: %s*********' %(g.getGroupName(), self.ID))
@@ -231,80 +455,12 @@ class Coordinator(Component):
         pass
         
         
-    def predictiveDispatchQP(self):
-        ''' Run an optimization algorithm on the entire prediction horizon.
-            The optimization problem is formulated as a Linear Programming problem
-            of the form: min_x(i,j) Sum_i,j 0.5 * (Power_Requested(i,j) - x(i,j))^2, where
-            i = {1,2,... number of loads}, j = {1,2,... K} prediction horizon
-            The constraints are given by Sum_i(x(i,j) <= b_j) for all j, where
-            A =I in this case,
-            b_j = Power available from the grid for all j
-            x(i,j) >= 0
-            x(i,j)) <= Power_Requested(i,j)
-            :returns: the dispatch solution
-            :rtype: dict
+    def roundProblem(self):
         '''
-#         initialize the LP        
-        optModel = cpx.Model(name='power_allocation')
-            
-#         define the decision variables
-        set_I = range(1,len(self.reqMap)+1)
-        set_J = range(1, self.futureTimeStep + 1)
-        clientMap = {}
-        weightMap = {}
-#         lower bound is zero for total shedding  (except bess)      
-        l = {(i,j): 0 for i in set_I for j in set_J}
-#         initialize dict to store upper limit
-        u = {(i,j): 0 for i in set_I for j in set_J}
-
-        idx = 1
-        for client in self.reqMap.keys():
-            clientMap[idx] = client
-            if self.reqMap[client][0] == 'BU':
-                keyBU = client
-#               weightMap[idx] = 1            
-                for j in set_J:
-#                   # grid-connected mode optimiza over the next 24 hours
-                    if (self.microgridMode==0):
-                        weightMap[idx,j] = exp(-(j-1)/8) * self.weightBuilding
-                    # islanded mode optimiza over the next 4 hours
-                    elif (self.microgridMode==1):
-                        weightMap[idx,j] = exp(-(j-1)/1.5) * self.weightBuilding
-                    #upper bound is the power requested
-                    u[idx,j]= self.reqMap[clientMap[idx]][1][j-1]                      
-            elif self.reqMap[client][0] == 'EV':
-                keyEV = client
-#               weightMap[idx] = 1
-                for j in set_J:
-                    # grid-connected mode optimiza over the next 24 hours
-                    if (self.microgridMode==0):
-                        weightMap[idx,j] = exp(-(j-1)/8) * self.weightEv
-                    # islanded mode optimiza over the next 4 hours
-                    elif (self.microgridMode==1):
-                        weightMap[idx,j] = exp(-(j-1)/1.5) * self.weightEv
-#         upper bound is the power requested
-                    u[idx,j]= self.reqMap[clientMap[idx]][1][j-1]               
-            elif self.reqMap[client][0] == 'BESS':
-                keyBatt = client
-                weightMap[idx] = 1
-#         the bounds    are the power rating (signs indicate charging/ discharging)
-                for j in set_J:
-                    l[idx,j] = -1 * float(self.reqMap[client][1]['Rbess'])
-                    u[idx,j] = float(self.reqMap[client][1]['Rbess'])
-            else:
-                weightMap[idx] = 1
-            
-            idx += 1
-
-            
-        
-        x_vars  = {(i,j):
-                   optModel.continuous_var( lb=l[i,j], 
-                                             ub=u[i,j], 
-                                             name="x_{0}_{1}".format(i,j)) 
-                   for i in set_I for j in set_J}
-#define the constraints
-        # Less than equal constraints for grid power
+        Dispatch problem of the requests of this round
+        :rtype: DispatchProblem
+        '''
+#         the grid power available for each time step
         if self.microgridMode == 0:
             # grid-connceted mode with power purchase 1 day ahead
             if self.gridPowerMode == 0:
@@ -315,62 +471,119 @@ class Coordinator(Component):
         # islanded mode  grid power is zero
         elif self.microgridMode == 1:
             self.Psupply = [0]*24
-        
-        b  = {j: self.Psupply[j-1] for j in set_J}
-        constraints = {j : optModel.add_constraint(
-            ct=optModel.sum(x_vars[i,j] for i in set_I) <= b[j],
-            ctname="constraint_{0}".format(j))
-            for j in set_J}
-        
-#         add battery SoC constraints
-        for idx, client in clientMap.items():
-            if self.reqMap[client][0] == 'BESS':
-                for j in set_J:
-                    constraints[list(set_J)[-1]+j] = optModel.add_constraint(
-                        ct=optModel.sum(x_vars[idx,k]/float(self.reqMap[client][1]['Cbattery']) for k in range(1,j+1)) + float(self.reqMap[client][1]['SoC']) <= self.reqMap[client][1]['SoCu'],
-                        ctname="constraint_bessu_{0}".format(j))
-                    
-                    constraints[2*list(set_J)[-1]+j] = optModel.add_constraint(
-                        ct=optModel.sum(x_vars[idx,k]/float(self.reqMap[client][1]['Cbattery']) for k in range(1,j+1)) + float(self.reqMap[client][1]['SoC']) >= self.reqMap[client][1]['SoCl'],
-                        ctname="constraint_bessl_{0}".format(j))
-                
-                constraints[3*list(set_J)[-1]+1] = optModel.add_constraint(
-                        ct=optModel.sum(x_vars[idx,j]/float(self.reqMap[client][1]['Cbattery']) for j in set_J) + float(self.reqMap[client][1]['SoC']) == self.reqMap[client][1]['SoCend'],
-                        ctname="constraint_besseq_{0}".format(j))
-#         define the objective function
-        objective = optModel.sum(0.5*(weightMap[i,j]*(self.reqMap[clientMap[i]][1][j-1] - x_vars[i,j])**2) 
-                              for i in (k for k in set_I if self.reqMap[clientMap[k]][0] != 'BESS') 
-                              for j in set_J)
-        optModel.minimize(objective)
-        
-#         solve the model
-        optModel.solve()
-        
+
+        return buildProblem(self.roundRequests.reqMap, self.Psupply, self.microgridMode,
+                            self.weightBuilding, self.weightEv, self.futureTimeStep, self.Ts)
+
+    def predictiveDispatchQP(self, problem=None):
+        ''' Run an optimization algorithm on the entire prediction horizon.
+            The optimization problem is formulated as a Quadratic Programming problem
+            of the form: min_x(i,j) Sum_i,j 0.5 * w(i,j) * (Power_Requested(i,j) - x(i,j))^2, where
+            i = {1,2,... number of loads}, j = {1,2,... K} prediction horizon
+            The constraints are given by Sum_i(x(i,j) <= b_j) for all j, where
+            A =I in this case,
+            b_j = Power available from the grid for all j
+            x(i,j) >= 0
+            x(i,j)) <= Power_Requested(i,j)
+            and the battery SoC bounds over the horizon (see DispatchEngine).
+            The problem is solved by the configured dispatch engine, which keeps its model
+            between rounds and warm-starts from the previous dispatch.
+            :param problem: dispatch problem of the round, built from the requests if not given
+            :type problem: DispatchProblem
+        '''
+        if problem is None:
+            problem = self.roundProblem()
+        # a close solution of an earlier round is a better start than the previous round
+        x0, y0 = self.cache.nearest(problem, self.settings())
+        solution = self.engine.solve(problem, x0, y0)
+        if solution.status == 'optimal':
+            self.cache.put(self.cache.key(problem, self.settings()), problem, self.settings(), solution)
+        elif solution.status == 'inaccurate':
+            # the constraints are met within the tolerance, the dispatch is sent but not cached
+            self.logger.info('%s engine inaccurate after %d iterations, violation %.3g kW' %
+                             (self.engine.name, solution.iterations, problem.violation(solution.x)))
+        else:
+            self.logger.warn('%s engine %s after %d iterations, violation %.3g kW' %
+                             (self.engine.name, solution.status, solution.iterations, problem.violation(solution.x)))
+            solution = self.fallbackDispatch(problem)
+        self.storeDispatch(problem, solution.x, solution.status, solution.objective, solution.solveTime, self.engine.name)
+
+    def fallbackDispatch(self, problem):
+        '''
+        Dispatch of a round the engine did not solve. The round is solved by the cplex
+        reference engine if it is available, else with the end of horizon SoC of the
+        batteries relaxed (see DispatchProblem.relaxed). The loads are shed in the steps
+        where the result still exceeds the supply. These dispatches are not cached.
+        :rtype: DispatchSolution
+        '''
+        if self.engine.name != 'cplex':
+            try:
+                solution = makeEngine('cplex', persistent=False).solve(problem)
+            except (ImportError, RuntimeError) as e:
+                self.logger.warn('reference engine: %s' % str(e))
+            else:
+                if solution.status == 'optimal':
+                    return solution
+        relaxed = problem.relaxed()
+        solution = self.engine.solve(relaxed)
+        x = relaxed.withinSupply(solution.x)
+        self.logger.warn('dispatch with the end SoC relaxed: %s, violation %.3g kW' % (solution.status, relaxed.violation(x)))
+        return DispatchSolution(x, problem.objective(x), 'relaxed', solution.iterations, solution.solveTime)
+
+    def settings(self):
+        '''
+        Grid settings received from the GUI
+        '''
+        return (self.microgridMode, self.gridPowerMode, self.gridPower, self.weightBuilding, self.weightEv)
+
+    def cachedDispatch(self, problem):
+        '''
+        Dispatch the round from the cache of solutions
+        :return: True on a hit
+        :rtype: bool
+        '''
+        solution = self.cache.get(self.cache.key(problem, self.settings()), problem)
+        self.logger.info('dispatch cache: %s' % str(self.cache.stats()))
+        if solution is None:
+            return False
+        self.storeDispatch(problem, solution.x, solution.status, solution.objective, solution.solveTime, 'cache')
+        return True
+
+    def storeDispatch(self, problem, x, status, objective, solveTime, name):
+        '''
+        Store the dispatch x of the problem and send the log of the round
+        '''
 #         print objective function value
-        self.logger.info('status: %s' % optModel.solve_details.status)
-        self.logger.info('objective value: %f' % optModel.objective_value)
-        self.optVal = optModel.objective_value
-        
+        self.logger.info('status: %s' % status)
+        self.logger.info('objective value: %f' % objective)
+        self.logger.info('%s engine solve time: %.1f ms' % (name, 1e3 * solveTime))
+        self.optVal = objective
+
 #         store the results
-        for idx, client in clientMap.items():
-            keylist = [(idx,j) for j in set_J]
-            #self.dspMap[client] = (self.reqMap[client][0], array('f',[x_vars[k].solution_value for k in keylist]))
-            self.dspMap[client] =  (self.reqMap[client][0], [x_vars[k].solution_value for k in keylist])
+        self.dspMap = {}
+        for idx, client in enumerate(problem.clients):
+            self.dspMap[client] = (problem.kinds[idx], x[idx].tolist())
         self.logger.info('dispatch results: %s' % str(self.dspMap))
-        
-        initialSoC = float(self.reqMap[keyBatt][1]['SoC'])
-        FinalSoC = sum(self.dspMap[keyBatt][1])/1000 + initialSoC
-        self.logger.info('initial %s and predicted final SoC %s' % (str(initialSoC),str(FinalSoC)))
-        
-        self.SoCbattery = initialSoC
-        self.Pbuilding = self.reqMap [keyBU][3]
-        self.Pev = self.reqMap [keyEV][3]
-        self.Pbattery = self.reqMap [keyBatt][3]
-        self.Pred_building = self.reqMap [keyBU][1]
-        self.Disp_building =  self.dspMap[keyBU][1]
-        self.Pred_ev = self.reqMap [keyEV][1]
-        self.Disp_ev = self.dspMap [keyEV][1]
-        self.Disp_battery = self.dspMap[keyBatt][1]
+
+#         totals of each type of load
+        kinds = np.array(problem.kinds)
+        self.totalDispatch = x.sum(axis=0)
+        self.SoCbattery = {}
+        for batt in problem.bess:
+            client = problem.clients[batt['row']]
+            initialSoC = batt['SoC']
+            FinalSoC = sum(self.dspMap[client][1])/batt['Cbattery'] + initialSoC
+            self.logger.info('%s initial %s and predicted final SoC %s' % (client, str(initialSoC),str(FinalSoC)))
+            self.SoCbattery[client] = initialSoC
+
+        self.Pbuilding = self.roundRequests.currSum.get('BU', 0.0)
+        self.Pev = self.roundRequests.currSum.get('EV', 0.0)
+        self.Pbattery = self.roundRequests.currSum.get('BESS', 0.0)
+        self.Pred_building = self.roundRequests.predSum.get('BU', np.zeros(self.futureTimeStep)).tolist()
+        self.Disp_building = x[kinds == 'BU'].sum(axis=0).tolist()
+        self.Pred_ev = self.roundRequests.predSum.get('EV', np.zeros(self.futureTimeStep)).tolist()
+        self.Disp_ev = x[kinds == 'EV'].sum(axis=0).tolist()
+        self.Disp_battery = x[kinds == 'BESS'].sum(axis=0).tolist()
         self.gridPower24ahead = self.Psupply
         
         #self.writeDownTestValues()
@@ -471,30 +684,29 @@ class Coordinator(Component):
     def log(self):
             '''
             Send message to logger
-            The log data sent to the logger needs to be a list of tuples.
-            Each tuple is of the format (tags, measurement, timestamps, values)
+            The log data sent to the logger is a list of series (see LogData).
+            Each series is of the format (tags, measurement, field, start, step, values)
             tags : dictionary containing the tag column names and their values
             measurement : name of the measurement (table in InfluxDB) where the values will be stored
-            timestamps : list of timestamps corresponding to each value
-            values: list of dictionaries where each dictionary is {column_name : value}
+            field : column name of the values
+            start : timestamp of the first value
+            step : seconds between the values
+            values: the values packed as float64
             '''
             datastream = []
             # write actual power
-            for id, details in self.reqMap.items():
+            for id, details in self.roundRequests.reqMap.items():
                 tags = {}
                 curr_stamp = datetime.strptime(details[2], '%Y-%m-%d %H:%M:%S')
                 curr_stamp = curr_stamp.timestamp()
                 try : tagl = len(self.table_struct['ActualPower']['tags'])
                 except: pass
                 else:
-                    self.logger.info('tagl = %d' % tagl)
                     if tagl == 2:
                         tags[self.table_struct['ActualPower']['tags'][0]] = details[0]
                         tags[self.table_struct['ActualPower']['tags'][1]] = id
-                        self.logger.info(str(tags))
-                values = [{self.table_struct['ActualPower']['value']: float(details[3])}]
-                stamps = [(curr_stamp + i * self.Ts) for i in range(len(values))]
-                datastream.append((tags,self.table_struct['ActualPower']['measurement'],stamps,values))
+                datastream.append(series(tags, self.table_struct['ActualPower']['measurement'], self.table_struct['ActualPower']['value'],
+                                         curr_stamp, self.Ts, [float(details[3])]))
                 
             # write predicted power
                 if details[0] != 'BESS':
@@ -505,9 +717,8 @@ class Coordinator(Component):
                         if tagl == 2:
                             tags[self.table_struct['PredictedPower']['tags'][0]] = details[0]
                             tags[self.table_struct['PredictedPower']['tags'][1]] = id
-                    values = [{self.table_struct['PredictedPower']['value']: float(details[1][i])} for i in range(len(details[1]))]
-                    stamps = [(curr_stamp + i * self.Ts) for i in range(len(values))]
-                    datastream.append((tags,self.table_struct['PredictedPower']['measurement'],stamps,values))
+                    datastream.append(series(tags, self.table_struct['PredictedPower']['measurement'], self.table_struct['PredictedPower']['value'],
+                                             curr_stamp, self.Ts, details[1]))
                 
                 
             # write dispatched power
@@ -518,39 +729,28 @@ class Coordinator(Component):
                     if tagl == 2:
                         tags[self.table_struct['DispatchedPower']['tags'][0]] = details[0]
                         tags[self.table_struct['DispatchedPower']['tags'][1]] = id
-                values = [{self.table_struct['DispatchedPower']['value']: float(self.dspMap[id][1][i])} for i in range(len(self.dspMap[id][1]))]
-                stamps = [(curr_stamp + i * self.Ts) for i in range(len(values))]
-                datastream.append((tags,self.table_struct['DispatchedPower']['measurement'],stamps,values))
+                datastream.append(series(tags, self.table_struct['DispatchedPower']['measurement'], self.table_struct['DispatchedPower']['value'],
+                                         curr_stamp, self.Ts, self.dspMap[id][1]))
                 
             # write battery SoC
                 if details[0] == 'BESS':
                     tags = {}
-                    values = [{self.table_struct['SoC']['value']: float(self.SoCbattery)}]
                     try : tagl = len(self.table_struct['SoC']['tags'])
                     except: pass
                     else:
                         if tagl == 1:
                             tags[self.table_struct['SoC']['tags'][0]] = id
-                    stamps = [(curr_stamp + i * self.Ts) for i in range(len(values))]
-                    datastream.append((tags,self.table_struct['SoC']['measurement'],stamps,values))
+                    datastream.append(series(tags, self.table_struct['SoC']['measurement'], self.table_struct['SoC']['value'],
+                                             curr_stamp, self.Ts, [float(self.SoCbattery[id])]))
                         
         # write grid power
-            tags = {}
-            values = [{self.table_struct['Grid']['value'] : float(self.gridPower24ahead[i])} for i in range(len(self.gridPower24ahead))]
-            stamps = [(curr_stamp + i * self.Ts) for i in range(len(values))]
-            datastream.append((tags,self.table_struct['Grid']['measurement'],stamps,values))
-            
-            total_dsp = np.zeros(24)
+            datastream.append(series({}, self.table_struct['Grid']['measurement'], self.table_struct['Grid']['value'],
+                                     curr_stamp, self.Ts, self.gridPower24ahead))
             
-            for client, data in self.dspMap.items():
-#                 if data[0] == "BU" or data[0] == "EV":
-                total_dsp += np.array(data[1])
+            total_dsp = self.totalDispatch
                 
-            tags = {}
-            values = [{self.table_struct['AggregatePower']['value'] : float(total_dsp[i])} for i in range(len(total_dsp))]
-            stamps = [(curr_stamp + i * self.Ts) for i in range(len(values))]
-            datastream.append((tags,self.table_struct['AggregatePower']['measurement'],stamps,values))
+            datastream.append(series({}, self.table_struct['AggregatePower']['measurement'], self.table_struct['AggregatePower']['value'],
+                                     curr_stamp, self.Ts, total_dsp))
 
-#             msg = (tag,meas,stamps,values)
-            self.logData.send_pyobj(datastream)
+            self.logData.send_capnp(logData(datastream))
 # riaps:keep_impl:end
\ No newline at end of file
@@ -0,0 +1,87 @@
+'''
+Bytes sent with and without the delta mode of the horizons (see HorizonDelta)
+
+The fast-forward simulation (Simulator.py) runs for a number of rounds. Every predicted
+horizon of a load and every dispatched horizon is encoded as it is sent today, in a
+PowerRequest or PowerDispatched message with the whole horizon, and as a frame of its
+stream. The frames are decoded again to find the largest error of the rebuilt values.
+
+Run it from the application folder:
+    python DeltaSizes.py [resolution] [keyframe] [rounds]
+'''
+import sys
+import logging
+import yaml
+import numpy as np
+from Simulator import Simulator
+from Messages import powerRequest, powerDispatched
+from HorizonDelta import HorizonEncoder, HorizonDecoder
+
+
+class DeltaSizes():
+    '''
+    Sizes of the horizons of a simulation
+    streams : {(direction, client): (HorizonEncoder, HorizonDecoder)}
+    sizes : bytes of the messages {'full', 'delta'}
+    error : largest error of a rebuilt value (kW)
+    '''
+    def __init__(self, resolution=0.1, keyframe=12):
+        self.resolution = resolution
+        self.keyframe = keyframe
+        self.streams = {}
+        self.sizes = {'full': 0, 'delta': 0}
+        self.error = 0.0
+
+    def send(self, key, values, full, encode):
+        '''
+        Encode a horizon as a frame of its stream and rebuild it
+        :param full: the message with the whole horizon
+        :param encode: encode(frame) the message with the frame
+        '''
+        if key not in self.streams:
+            self.streams[key] = (HorizonEncoder(self.resolution, self.keyframe), HorizonDecoder())
+        encoder, decoder = self.streams[key]
+        frame = encoder.encode(values)
+        self.sizes['full'] += len(full)
+        self.sizes['delta'] += len(encode(frame))
+        rebuilt = decoder.decode(frame)
+        self.error = max(self.error, float(np.max(np.abs(np.asarray(rebuilt) - np.asarray(values, dtype=float)))))
+
+    def run(self, sim, rounds):
+        '''
+        Send the horizons of rounds of the simulation
+        :type sim: Simulator
+        '''
+        predicted = sim.coordinator.table_struct['PredictedPower']['measurement']
+        for i in range(rounds):
+            dspMap = sim.step()
+            if len(dspMap) == 0:
+                continue
+            for tags, measurement, field, start, step, packed in sim.sink.datastreams[-1]:
+                if measurement == predicted:
+                    reqID, reqKind = tags.get('ID'), tags.get('type')
+                    values = np.frombuffer(packed).tolist()
+                    self.send(('request', reqID), values, powerRequest(reqID, reqKind, '', values, 0.0),
+                              lambda frame: powerRequest(reqID, reqKind, '', frame, 0.0))
+            for client, (reqKind, powerGranted) in dspMap.items():
+                self.send(('dispatch', client), powerGranted, powerDispatched({client: (reqKind, powerGranted)}),
+                          lambda frame: powerDispatched({client: (reqKind, frame)}))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    resolution = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    keyframe = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 168
+    with open('config/sim_config.yaml', 'r') as stream:
+        sim_config = yaml.safe_load(stream)
+    sim_config['models'] = False
+    sim = Simulator(sim_config)
+    sizes = DeltaSizes(resolution, keyframe)
+    sizes.run(sim, rounds)
+    print('%d horizons over %d rounds, resolution %g kW, keyframe every %d frames'
+          % (len(sizes.streams), sim.clock.rounds, resolution, keyframe))
+    print('full: %d bytes, delta: %d bytes (%.1f%%), largest error %.3g kW'
+          % (sizes.sizes['full'], sizes.sizes['delta'], 100.0 * sizes.sizes['delta'] / max(1, sizes.sizes['full']), sizes.error))
+    for key, (encoder, decoder) in sizes.streams.items():
+        print(key, encoder.stats(), decoder.stats())
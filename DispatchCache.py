@@ -0,0 +1,166 @@
+'''
+Cache of dispatch solutions for the Coordinator component
+
+Playback runs replay the same periods of the building and charger data, so the
+dispatch problems of many rounds are identical or nearly identical to earlier ones.
+The cache keeps the solutions of the last rounds (least recently used first out,
+entries older than ttl seconds are dropped). The key is a fingerprint of the
+problem quantized to quantum kW (the batteries by their energy Cbattery*SoC)
+together with the grid settings received from the GUI.
+
+A hit is used as is once it has been clipped to the bounds of the new problem and
+checked against its constraints. Otherwise the closest cached solution with the same
+clients and settings, if its data is within near of the power scale, is returned as
+a warm start for the dispatch engine.
+'''
+import time
+from collections import OrderedDict
+import numpy as np
+from DispatchEngine import DispatchSolution
+
+
+class DispatchCache():
+    '''
+    LRU/TTL cache of dispatch solutions
+    entries : {key: (stamp, structure, settings, data, solution)}
+    '''
+    def __init__(self, size=64, ttl=24 * 3600, quantum=1.0, near=0.05, tol=1e-6, clock=time.time):
+        '''
+        :param size: maximum number of cached solutions, 0 disables the cache
+        :type size: int
+        :param ttl: seconds a solution is kept, None to keep it until evicted
+        :type ttl: float
+        :param quantum: resolution of the fingerprint in kW (kWh for the batteries)
+        :type quantum: float
+        :param near: largest distance of a warm start, relative to the power scale
+        :type near: float
+        :param tol: largest constraint violation of a hit, relative to the power scale
+        :type tol: float
+        :param clock: time of the entries in seconds, a virtual clock in simulations
+        '''
+        self.size = size
+        self.ttl = ttl
+        self.quantum = quantum
+        self.near = near
+        self.tol = tol
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.warm = 0
+
+    def data(self, problem):
+        '''
+        Data of the problem that changes between rounds: targets, bounds, supply and
+        the energy stored in the batteries
+        '''
+        energy = [batt['Cbattery'] * batt['SoC'] for batt in problem.bess]
+        return np.concatenate([problem.target.ravel(), problem.lb.ravel(), problem.ub.ravel(),
+                               problem.supply.ravel(), np.asarray(energy, dtype=float)])
+
+    def key(self, problem, settings):
+        '''
+        Fingerprint of the problem and the grid settings
+        :param problem: the dispatch problem
+        :type problem: DispatchProblem
+        :param settings: (microgridMode, gridPowerMode, gridPower, weightBuilding, weightEv)
+        :type settings: tuple
+        '''
+        quantized = np.round(self.data(problem) / self.quantum).astype(np.int64)
+        return (problem.structure, tuple(settings), quantized.tobytes())
+
+    def expire(self):
+        if self.ttl is None:
+            return
+        now = self.clock()
+        for key in [key for key, entry in self.entries.items() if now - entry[0] > self.ttl]:
+            del self.entries[key]
+
+    def get(self, key, problem):
+        '''
+        Cached solution of the problem
+        :return: the solution or None on a miss
+        :rtype: DispatchSolution
+        '''
+        if self.size <= 0:
+            return None
+        t0 = time.perf_counter()
+        self.expire()
+        entry = self.entries.get(key)
+        if entry is not None:
+            x = np.clip(entry[4].x, problem.lb, problem.ub)
+            if problem.violation(x) <= self.tol * problem.scale():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return DispatchSolution(x, problem.objective(x), 'cached', 0, time.perf_counter() - t0, entry[4].y)
+        self.misses += 1
+        return None
+
+    def nearest(self, problem, settings):
+        '''
+        Closest cached solution with the same clients and settings
+        :return: (x0, y0) to warm start the engine, (None, None) if there is none within near
+        :rtype: tuple
+        '''
+        best, dist = None, self.near * problem.scale()
+        data = self.data(problem)
+        for stamp, structure, cached, values, solution in self.entries.values():
+            if structure != problem.structure or cached != tuple(settings):
+                continue
+            d = float(np.max(np.abs(values - data)))
+            if d <= dist:
+                best, dist = solution, d
+        if best is None:
+            return None, None
+        self.warm += 1
+        return best.x, best.y
+
+    def put(self, key, problem, settings, solution):
+        '''
+        Store the solution of the problem
+        '''
+        if self.size <= 0:
+            return
+        self.entries[key] = (self.clock(), problem.structure, tuple(settings), self.data(problem), solution)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        '''
+        Hit, miss and warm start counters
+        :rtype: dict
+        '''
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'warm': self.warm, 'entries': len(self.entries),
+                'hitRate': self.hits / total if total > 0 else 0.0}
+
+
+if __name__ == '__main__':
+    # replay of the same day twice, the second pass with small noise on the predictions
+    from DispatchEngine import buildProblem, makeEngine
+    rng = np.random.default_rng(0)
+    profile = 800 + 400 * np.sin(np.arange(48) * np.pi / 12)
+    ev = 150 + 100 * np.cos(np.arange(48) * np.pi / 12)
+    settings = (0, 1, 1000, 1, 1)
+    cache = DispatchCache()
+    engine = makeEngine('numpy')
+    for noise in (0.0, 0.0, 0.2):
+        total, iters = 0.0, 0
+        for step in range(24):
+            stamp = '2019-08-16 %02d:00:00' % step
+            reqMap = {'BU1': ('BU', list(profile[step:step + 24] + rng.uniform(-noise, noise, 24)), stamp, 900.0),
+                      'EV1': ('EV', list(ev[step:step + 24]), stamp, 50.0),
+                      'BESS1': ('BESS', {'Rbess': 500, 'Cbattery': 1000, 'SoCl': 0.2, 'SoCu': 0.9,
+                                         'SoCend': 0.5, 'SoC': 0.5}, stamp, 0.0)}
+            problem = buildProblem(reqMap, [1000] * 24, 0, 1, 1)
+            key = cache.key(problem, settings)
+            sol = cache.get(key, problem)
+            if sol is None:
+                x0, y0 = cache.nearest(problem, settings)
+                sol = engine.solve(problem, x0, y0)
+                cache.put(key, problem, settings, sol)
+            total += sol.solveTime
+            iters += sol.iterations
+        print('noise %.1f kW: %.2f ms per round, %.0f iterations per round, %s' %
+              (noise, 1e3 * total / 24, iters / 24, str(cache.stats())))
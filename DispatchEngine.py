@@ -0,0 +1,658 @@
+'''
+Dispatch engines for the Coordinator component
+
+The predictive dispatch solved by the Coordinator every round is the weighted,
+box-constrained quadratic program
+    min_x Sum_i,j 0.5 * w(i,j) * (r(i,j) - x(i,j))^2
+    s.t.  l(i,j) <= x(i,j) <= u(i,j)
+          Sum_i x(i,j) <= b_j                                   for all j
+          SoCl <= SoC + Sum_k<=j x(bess,k)/Cbattery <= SoCu     for all j, for each BESS
+          SoC + Sum_j x(bess,j)/Cbattery == SoCend              for each BESS
+where i = {1,2,... number of loads} and j = {1,2,... K} is the prediction horizon.
+
+DispatchProblem holds the problem as numpy arrays and the engines solve it:
+    NumpyDispatchEngine : operator splitting (ADMM) solver with an active-set polish, numpy only
+    CplexDispatchEngine : the docplex model the Coordinator used originally, kept as the reference
+'''
+import time
+from datetime import datetime
+import numpy as np
+try:
+    import docplex.mp.model as cpx
+except ImportError:
+    cpx = None
+
+# largest constraint violation of a dispatch, relative to the power scale of the problem
+FEASIBILITY_TOL = 1e-7
+
+
+def horizonWeights(microgridMode, horizon):
+    '''
+    Discount applied to the objective over the prediction horizon
+    :param microgridMode: 0 - grid connected mode; 1 - islanded mode
+    :type microgridMode: int
+    :param horizon: number of future time steps
+    :type horizon: int
+    :return: the weight of each time step
+    :rtype: numpy.ndarray
+    '''
+    # grid-connected mode optimizes over the next 24 hours
+    if microgridMode == 0:
+        tau = 8.0
+    # islanded mode optimizes over the next 4 hours
+    elif microgridMode == 1:
+        tau = 1.5
+    else:
+        raise ValueError('unknown microgrid mode %s' % str(microgridMode))
+    return np.exp(-np.arange(horizon) / tau)
+
+
+class DispatchProblem():
+    '''
+    Array form of the predictive dispatch problem.
+    Row i of the (nLoads, horizon) arrays belongs to clients[i].
+    bess is a list of dictionaries {'row', 'Cbattery', 'SoC', 'SoCl', 'SoCu', 'SoCend'},
+    one for each battery, where row is the index of the battery in clients.
+    start is the timestamp of the first step and Ts the step length, both in seconds.
+    '''
+    def __init__(self, clients, kinds, target, weight, lb, ub, supply, bess=None, start=None, Ts=3600):
+        self.clients = list(clients)
+        self.kinds = list(kinds)
+        self.target = np.asarray(target, dtype=float)
+        self.weight = np.asarray(weight, dtype=float)
+        self.lb = np.asarray(lb, dtype=float)
+        self.ub = np.asarray(ub, dtype=float)
+        self.supply = np.asarray(supply, dtype=float)
+        self.bess = bess if bess is not None else []
+        self.start = start
+        self.Ts = Ts
+
+    @property
+    def structure(self):
+        '''
+        Key of the problem structure: the variables and constraints only depend on it,
+        rounds with the same key differ in bounds, coefficients and right-hand sides.
+        '''
+        return (tuple(self.clients), tuple(self.kinds), self.horizon)
+
+    @property
+    def nLoads(self):
+        return self.target.shape[0]
+
+    @property
+    def horizon(self):
+        return self.target.shape[1]
+
+    def scale(self):
+        '''
+        Power scale of the problem (kW), the largest bound or supply value
+        '''
+        return max(1.0, float(np.max(np.abs(self.lb))), float(np.max(np.abs(self.ub))), float(np.max(np.abs(self.supply))))
+
+    def objective(self, x):
+        '''
+        Evaluate the objective function at the dispatch x
+        '''
+        return float(np.sum(0.5 * self.weight * (self.target - x)**2))
+
+    def violation(self, x):
+        '''
+        Largest constraint violation of the dispatch x in kW (SoC rows are scaled by Cbattery)
+        '''
+        viol = max(0.0, float(np.max(self.lb - x)), float(np.max(x - self.ub)))
+        viol = max(viol, float(np.max(x.sum(axis=0) - self.supply)))
+        for batt in self.bess:
+            energy = np.cumsum(x[batt['row']])
+            C = batt['Cbattery']
+            viol = max(viol, float(np.max(C * (batt['SoCl'] - batt['SoC']) - energy)),
+                       float(np.max(energy - C * (batt['SoCu'] - batt['SoC']))),
+                       abs(energy[-1] - C * (batt['SoCend'] - batt['SoC'])))
+        return viol
+
+    def feasible(self, x, tol=FEASIBILITY_TOL):
+        '''
+        True if the dispatch x meets the constraints within tol of the power scale
+        '''
+        return self.violation(x) <= tol * self.scale()
+
+    def relaxed(self):
+        '''
+        The problem with the end of horizon SoC of each battery set to its current SoC,
+        and the SoC bounds widened to hold it. Shedding the loads with the batteries
+        idle is feasible whenever the supply is not negative.
+        :rtype: DispatchProblem
+        '''
+        bess = []
+        for batt in self.bess:
+            batt = dict(batt)
+            batt['SoCl'] = min(batt['SoCl'], batt['SoC'])
+            batt['SoCu'] = max(batt['SoCu'], batt['SoC'])
+            batt['SoCend'] = batt['SoC']
+            bess.append(batt)
+        return DispatchProblem(self.clients, self.kinds, self.target, self.weight, self.lb, self.ub,
+                               self.supply, bess, self.start, self.Ts)
+
+    def withinSupply(self, x):
+        '''
+        The dispatch x with the loads shed in the steps where it exceeds the supply,
+        and the charging of the batteries reduced where shedding is not enough
+        :rtype: numpy.ndarray
+        '''
+        x = np.array(x, dtype=float)
+        loads = np.array([kind != 'BESS' for kind in self.kinds], dtype=bool)
+        excess = x.sum(axis=0) - self.supply
+        for j in np.nonzero(excess > 0)[0]:
+            for rows in (loads, ~loads):
+                held = np.maximum(x[rows, j], 0.0)
+                total = held.sum()
+                if total > 0 and excess[j] > 0:
+                    cut = min(1.0, excess[j] / total)
+                    x[rows, j] -= cut * held
+                    excess[j] -= cut * total
+        return x
+
+
+def buildProblem(reqMap, supply, microgridMode, weightBuilding, weightEv, horizon=24, Ts=3600):
+    '''
+    Build the dispatch problem from the power requests received by the Coordinator.
+    The clients are sorted so that the structure is the same in every round.
+    :param reqMap: {client: (reqKind, reqPower, reqTime, currPower)}
+    :type reqMap: dict
+    :param supply: power available from the grid for each time step
+    :type supply: list
+    :param microgridMode: 0 - grid connected mode; 1 - islanded mode
+    :type microgridMode: int
+    :param weightBuilding: weight for buildings in the objective
+    :type weightBuilding: float
+    :param weightEv: weight for EV chargers in the objective
+    :type weightEv: float
+    :param horizon: number of future time steps
+    :type horizon: int
+    :param Ts: length of a time step in seconds
+    :type Ts: int
+    :return: the dispatch problem
+    :rtype: DispatchProblem
+    '''
+    n = len(reqMap)
+    clients = sorted(reqMap)
+    decay = horizonWeights(microgridMode, horizon)
+    target = np.zeros((n, horizon))
+    weight = np.zeros((n, horizon))
+    lb = np.zeros((n, horizon))
+    ub = np.zeros((n, horizon))
+    bess = []
+    kinds = []
+    start = None
+    for idx, client in enumerate(clients):
+        request = reqMap[client]
+        kind = request[0]
+        try:
+            stamp = datetime.strptime(request[2], '%Y-%m-%d %H:%M:%S').timestamp()
+        except (TypeError, ValueError):
+            pass
+        else:
+            start = stamp if start is None else max(start, stamp)
+        kinds.append(kind)
+        if kind == 'BU' or kind == 'EV':
+            # lower bound is zero for total shedding, upper bound is the power requested
+            target[idx] = request[1][:horizon]
+            ub[idx] = target[idx]
+            weight[idx] = decay * (weightBuilding if kind == 'BU' else weightEv)
+        elif kind == 'BESS':
+            # the bounds are the power rating (signs indicate charging/ discharging)
+            attr = request[1]
+            lb[idx] = -float(attr['Rbess'])
+            ub[idx] = float(attr['Rbess'])
+            bess.append({'row': idx,
+                         'Cbattery': float(attr['Cbattery']),
+                         'SoC': float(attr['SoC']),
+                         'SoCl': float(attr['SoCl']),
+                         'SoCu': float(attr['SoCu']),
+                         'SoCend': float(attr['SoCend'])})
+    return DispatchProblem(clients, kinds, target, weight, lb, ub, supply[:horizon], bess, start, Ts)
+
+
+class DispatchSolution():
+    '''
+    Result of a dispatch engine
+    x : dispatched power, array of shape (nLoads, horizon)
+    '''
+    def __init__(self, x, objective, status, iterations=0, solveTime=0.0, y=None):
+        self.x = x
+        self.y = y
+        self.objective = objective
+        self.status = status
+        self.iterations = iterations
+        self.solveTime = solveTime
+
+
+class DispatchEngine():
+    '''
+    Base class of the dispatch engines
+    '''
+    name = None
+
+    def solve(self, problem, x0=None, y0=None):
+        '''
+        Solve the dispatch problem
+        :param problem: the dispatch problem
+        :type problem: DispatchProblem
+        :param x0: optional starting point for the dispatch, engines may ignore it
+        :param y0: optional starting point for the multipliers, engines may ignore it
+        :rtype: DispatchSolution
+        '''
+        raise NotImplementedError
+
+    def reset(self):
+        '''
+        Drop any state kept between rounds
+        '''
+        pass
+
+
+class NumpyDispatchEngine(DispatchEngine):
+    '''
+    Solves the dispatch problem in the form
+        min 0.5 x'Px + q'x  s.t.  l <= Ax <= u
+    with the operator splitting iteration used by OSQP. Every polishEvery iterations,
+    and once the iteration converges, the active constraints are identified and the
+    equality constrained problem on them is solved to polish the solution. A polished
+    point that is feasible and whose multipliers have the right signs is optimal, so
+    the iteration stops as soon as the active set is found. Power values are scaled
+    to O(1).
+
+    The model is persistent: A is built once per client set and horizon, and the
+    inverse of the matrix of the x update is kept until the weights or rho change.
+    Later rounds only patch P, q, l and u, and start from the previous solution
+    and multipliers shifted by the number of steps the horizon moved.
+    '''
+    name = 'numpy'
+
+    def __init__(self, rho=0.1, sigma=1e-6, alpha=1.6, epsAbs=1e-5, epsRel=1e-5, maxIter=4000, checkEvery=10,
+                 polishEvery=50, persistent=True):
+        self.rho = rho
+        self.sigma = sigma
+        self.alpha = alpha
+        self.epsAbs = epsAbs
+        self.epsRel = epsRel
+        self.maxIter = maxIter
+        self.checkEvery = checkEvery
+        self.polishEvery = polishEvery
+        self.persistent = persistent
+        self.model = None
+
+    def reset(self):
+        self.model = None
+
+    def build(self, problem):
+        '''
+        Build the constraint matrix of the problem structure. The variables are the rows
+        of the dispatch flattened in order, x(i,j) -> x[i*K+j]. The rows are the boxes,
+        the supply constraint of every time step and for each battery the cumulative
+        energy of every step followed by the end energy. eq marks the equality rows.
+        '''
+        n, K = problem.nLoads, problem.horizon
+        N = n * K
+        nb = len(problem.bess)
+        A = np.zeros((N + K + nb * (K + 1), N))
+        A[:N] = np.eye(N)
+        for i in range(n):
+            A[N:N + K, i * K:(i + 1) * K] = np.eye(K)
+        cumsum = np.tril(np.ones((K, K)))
+        row = N + K
+        for batt in problem.bess:
+            i = batt['row']
+            A[row:row + K, i * K:(i + 1) * K] = cumsum
+            A[row + K, i * K:(i + 1) * K] = 1.0
+            row += K + 1
+        eq = np.zeros(A.shape[0], dtype=bool)
+        eq[N + K + K::K + 1] = True
+        return {'structure': problem.structure, 'A': A, 'eq': eq, 'P': None, 'rho': self.rho,
+                'Minv': None, 'x': None, 'y': None, 'start': None}
+
+    def data(self, problem, scale):
+        '''
+        Cost and bounds of a round: (P, q, l, u)
+        '''
+        n, K = problem.nLoads, problem.horizon
+        N = n * K
+        M = N + K + len(problem.bess) * (K + 1)
+        P = problem.weight.ravel()
+        q = -(problem.weight * problem.target).ravel() / scale
+        l = np.empty(M)
+        u = np.empty(M)
+        # box constraints
+        l[:N] = problem.lb.ravel() / scale
+        u[:N] = problem.ub.ravel() / scale
+        # supply constraint for every time step
+        l[N:N + K] = -np.inf
+        u[N:N + K] = problem.supply / scale
+        # cumulative energy of each battery (SoC bounds times Cbattery) and its end value
+        row = N + K
+        for batt in problem.bess:
+            C, s0 = batt['Cbattery'], batt['SoC']
+            l[row:row + K] = C * (batt['SoCl'] - s0) / scale
+            u[row:row + K] = C * (batt['SoCu'] - s0) / scale
+            l[row + K] = u[row + K] = C * (batt['SoCend'] - s0) / scale
+            row += K + 1
+        return P, q, l, u
+
+    def factor(self, P, A, rhoVec):
+        '''
+        Inverse of the matrix P + sigma*I + A' diag(rho) A used in the x update
+        '''
+        M = A.T @ (rhoVec[:, None] * A)
+        M[np.diag_indices_from(M)] += P + self.sigma
+        return np.linalg.inv(M)
+
+    def shift(self, problem, x, y, steps):
+        '''
+        Move the previous solution and multipliers forward by steps time steps,
+        the new tail repeats the last value.
+        '''
+        K = problem.horizon
+        steps = min(max(steps, 0), K - 1)
+        if steps == 0:
+            return x, y
+        def roll(block):
+            block = block.reshape(-1, K)
+            return np.concatenate([block[:, steps:], np.repeat(block[:, -1:], steps, axis=1)], axis=1).ravel()
+        N = problem.nLoads * K
+        x = roll(x)
+        y = y.copy()
+        y[:N] = roll(y[:N])
+        y[N:N + K] = roll(y[N:N + K])
+        row = N + K
+        for _ in problem.bess:
+            y[row:row + K] = roll(y[row:row + K])
+            row += K + 1
+        return x, y
+
+    def solve(self, problem, x0=None, y0=None):
+        '''
+        Solve the dispatch problem.
+        :param x0: optional starting point for the dispatch, array (nLoads, horizon)
+        :param y0: optional starting point for the multipliers
+        :rtype: DispatchSolution
+        '''
+        t0 = time.perf_counter()
+        scale = problem.scale()
+        model = self.model
+        if model is None or model['structure'] != problem.structure or not self.persistent:
+            model = self.build(problem)
+        P, q, l, u = self.data(problem, scale)
+        # warm start from the previous round, stored unscaled
+        if x0 is None and model['x'] is not None:
+            steps = 0
+            if problem.start is not None and model['start'] is not None:
+                steps = int(round((problem.start - model['start']) / problem.Ts))
+            x0, y0 = self.shift(problem, model['x'], model['y'], steps)
+        if x0 is not None:
+            x0 = np.ravel(x0) / scale
+        if y0 is not None:
+            y0 = np.ravel(y0) / scale
+        # the factorization is reused while the weights and rho stay the same
+        if model['P'] is None or not np.array_equal(model['P'], P):
+            model['P'] = P
+            model['Minv'] = None
+        x, z, y, iters, status = self.iterate(model, q, l, u, x0, y0)
+        model['x'], model['y'], model['start'] = x * scale, y * scale, problem.start
+        if self.persistent:
+            self.model = model
+        dispatch = (x * scale).reshape(problem.nLoads, problem.horizon)
+        return DispatchSolution(dispatch, problem.objective(dispatch), status, iters, time.perf_counter() - t0, y * scale)
+
+    def iterate(self, model, q, l, u, x0=None, y0=None):
+        '''
+        ADMM iterations, returns (x, z, y, iterations, status). The status is
+            optimal : the polished point is optimal, or the residuals are met and the
+                      point meets the constraints within FEASIBILITY_TOL
+            inaccurate : maxIter reached with a point that meets the constraints
+            max_iter : maxIter reached with a point that does not
+        The adapted rho and its factorization are stored in the model.
+        '''
+        A, eq, P = model['A'], model['eq'], model['P']
+        N = A.shape[1]
+        x = np.zeros(N) if x0 is None else np.array(x0, dtype=float)
+        z = np.clip(A @ x, l, u)
+        y = np.zeros(A.shape[0]) if y0 is None or len(y0) != A.shape[0] else np.array(y0, dtype=float)
+        rho = model['rho']
+        rhoVec = np.where(eq, 1e3 * rho, rho)
+        if model['Minv'] is None:
+            model['Minv'] = self.factor(P, A, rhoVec)
+        Minv = model['Minv']
+        alpha, sigma = self.alpha, self.sigma
+        status = 'max_iter'
+        it = 0
+        for it in range(1, self.maxIter + 1):
+            xt = Minv @ (sigma * x - q + A.T @ (rhoVec * z - y))
+            zt = A @ xt
+            x = alpha * xt + (1 - alpha) * x
+            zr = alpha * zt + (1 - alpha) * z
+            znew = np.clip(zr + y / rhoVec, l, u)
+            y = y + rhoVec * (zr - znew)
+            z = znew
+            if it % self.checkEvery:
+                continue
+            Ax, Px, Aty = A @ x, P * x, A.T @ y
+            rPrim = np.max(np.abs(Ax - z))
+            rDual = np.max(np.abs(Px + q + Aty))
+            nPrim = max(np.max(np.abs(Ax)), np.max(np.abs(z)), 1e-12)
+            nDual = max(np.max(np.abs(Px)), np.max(np.abs(Aty)), np.max(np.abs(q)), 1e-12)
+            converged = rPrim <= self.epsAbs + self.epsRel * nPrim and rDual <= self.epsAbs + self.epsRel * nDual
+            if converged or it % self.polishEvery == 0:
+                polished, optimal = self.polish(P, q, A, l, u, x, y)
+                if optimal:
+                    return polished, z, y, it, 'optimal'
+                # the residuals are met, but the point is used only if it meets the constraints
+                if converged and self.violation(A, l, u, x) <= FEASIBILITY_TOL:
+                    return x, z, y, it, 'optimal'
+            # rebalance the primal and dual residuals
+            ratio = np.sqrt((rPrim / nPrim) / (rDual / nDual + 1e-30))
+            if ratio > 5 or ratio < 0.2:
+                rho = min(max(rho * ratio, 1e-6), 1e6)
+                rhoVec = np.where(eq, 1e3 * rho, rho)
+                Minv = model['Minv'] = self.factor(P, A, rhoVec)
+                model['rho'] = rho
+        polished, optimal = self.polish(P, q, A, l, u, x, y)
+        if optimal:
+            return polished, z, y, it, 'optimal'
+        if self.violation(A, l, u, x) <= FEASIBILITY_TOL:
+            status = 'inaccurate'
+        return x, z, y, it, status
+
+    def violation(self, A, l, u, x):
+        '''
+        Largest constraint violation of the scaled point x
+        '''
+        Ax = A @ x
+        return max(0.0, float(np.max(l - Ax)), float(np.max(Ax - u)))
+
+    def polish(self, P, q, A, l, u, x, y, delta=1e-10, prox=1e-6):
+        '''
+        Solve the equality constrained problem on the active constraints of the ADMM
+        solution. Variables without a cost (the batteries) get a proximal term around
+        the ADMM point so the system stays nonsingular. The polished point is kept only
+        if it is feasible and its multipliers have the right signs.
+        :return: (x, True if the polished point is optimal)
+        '''
+        Ax = A @ x
+        lowAct = (y < -1e-9) | (np.abs(Ax - l) < 1e-7)
+        upAct = ((y > 1e-9) | (np.abs(Ax - u) < 1e-7)) & ~lowAct
+        act = lowAct | upAct
+        N, m = A.shape[1], int(act.sum())
+        D = P + np.where(P > 0, 0.0, prox)
+        Aa = A[act]
+        T = np.zeros((N + m, N + m))
+        T[:N, :N] = np.diag(D)
+        T[:N, N:] = Aa.T
+        T[N:, :N] = Aa
+        R = T.copy()
+        R[np.diag_indices(N + m)] += np.concatenate([np.full(N, delta), np.full(m, -delta)])
+        rhs = np.concatenate([-q + (D - P) * x, np.where(lowAct[act], l[act], u[act])])
+        try:
+            # iterative refinement from the ADMM point removes the effect of the regularization;
+            # multipliers that are not unique (degenerate active sets) stay close to the ADMM ones
+            # it stops once the residual is at round-off level, further steps only drift along them
+            sol = np.concatenate([x, y[act]])
+            for _ in range(6):
+                res = rhs - T @ sol
+                if np.max(np.abs(res)) <= 1e-9:
+                    break
+                sol = sol + np.linalg.solve(R, res)
+        except np.linalg.LinAlgError:
+            return x, False
+        cand, ya = sol[:N], sol[N:]
+        Ac = A @ cand
+        viol = max(np.max(l - Ac), np.max(Ac - u))
+        # the multipliers of lower bounds are nonpositive and of upper bounds nonnegative
+        signs = np.all(ya[lowAct[act] & (u[act] - l[act] > 1e-12)] <= 1e-6) and np.all(ya[upAct[act]] >= -1e-6)
+        if viol <= 1e-7 and signs:
+            return cand, True
+        return x, False
+
+
+class CplexDispatchEngine(DispatchEngine):
+    '''
+    Reference engine: the docplex model solved by CPLEX. The model is built once per
+    client set and horizon. Later rounds set the variable bounds, the right-hand sides
+    and the objective on the existing model, so CPLEX starts from its previous basis.
+    The SoC constraints are written in energy, Sum_k<=j x(bess,k) <= Cbattery*(SoCu - SoC),
+    so only their right-hand sides change between rounds.
+    '''
+    name = 'cplex'
+
+    def __init__(self, persistent=True):
+        if cpx is None:
+            raise ImportError('docplex is required for the cplex dispatch engine')
+        self.persistent = persistent
+        self.model = None
+
+    def reset(self):
+        self.model = None
+
+    def build(self, problem):
+        '''
+        Create the variables and constraints of the problem structure
+        '''
+        optModel = cpx.Model(name='power_allocation')
+        set_I = range(problem.nLoads)
+        set_J = range(problem.horizon)
+        x_vars = [optModel.continuous_var(name="x_{0}_{1}".format(i + 1, j + 1)) for i in set_I for j in set_J]
+        K = problem.horizon
+        # less than equal constraints for grid power
+        supplyCts = [optModel.add_constraint(ct=optModel.sum(x_vars[i * K + j] for i in set_I) <= 0,
+                                             ctname="constraint_{0}".format(j + 1))
+                     for j in set_J]
+        # battery SoC constraints
+        bessCts = []
+        for batt in problem.bess:
+            idx = batt['row']
+            upper, lower = [], []
+            for j in set_J:
+                energy = optModel.sum(x_vars[idx * K + k] for k in range(j + 1))
+                upper.append(optModel.add_constraint(ct=energy <= 0, ctname="constraint_bessu_{0}_{1}".format(idx + 1, j + 1)))
+                lower.append(optModel.add_constraint(ct=energy >= 0, ctname="constraint_bessl_{0}_{1}".format(idx + 1, j + 1)))
+            end = optModel.add_constraint(ct=optModel.sum(x_vars[idx * K + j] for j in set_J) == 0,
+                                          ctname="constraint_besseq_{0}".format(idx + 1))
+            bessCts.append((upper, lower, end))
+        return {'structure': problem.structure, 'optModel': optModel, 'x_vars': x_vars,
+                'supplyCts': supplyCts, 'bessCts': bessCts, 'weight': None, 'quad': None}
+
+    def solve(self, problem, x0=None, y0=None):
+        # CPLEX starts from the basis of the previous round, x0 and y0 are not used
+        t0 = time.perf_counter()
+        model = self.model
+        if model is None or model['structure'] != problem.structure or not self.persistent:
+            model = self.build(problem)
+        optModel, x_vars = model['optModel'], model['x_vars']
+        # patch the bounds and right-hand sides of this round
+        optModel.change_var_lower_bounds(x_vars, problem.lb.ravel().tolist())
+        optModel.change_var_upper_bounds(x_vars, problem.ub.ravel().tolist())
+        for ct, b in zip(model['supplyCts'], problem.supply):
+            ct.rhs = float(b)
+        for batt, (upper, lower, end) in zip(problem.bess, model['bessCts']):
+            C, s0 = batt['Cbattery'], batt['SoC']
+            for ct in upper:
+                ct.rhs = C * (batt['SoCu'] - s0)
+            for ct in lower:
+                ct.rhs = C * (batt['SoCl'] - s0)
+            end.rhs = C * (batt['SoCend'] - s0)
+        # objective Sum 0.5*w*x^2 - w*r*x, the quadratic part only changes with the weights
+        weight = problem.weight.ravel()
+        if model['weight'] is None or not np.array_equal(model['weight'], weight):
+            model['weight'] = weight
+            model['quad'] = optModel.sum(0.5 * w * v * v for v, w in zip(x_vars, weight) if w > 0)
+        linear = optModel.scal_prod(x_vars, (-weight * problem.target.ravel()).tolist())
+        optModel.minimize(model['quad'] + linear)
+        optModel.solve()
+        status = str(optModel.solve_details.status)
+        if optModel.solution is None:
+            self.model = None
+            raise RuntimeError('dispatch model not solved: %s' % status)
+        if self.persistent:
+            self.model = model
+        x = np.array([v.solution_value for v in x_vars]).reshape(problem.nLoads, problem.horizon)
+        return DispatchSolution(x, problem.objective(x), status, 0, time.perf_counter() - t0)
+
+
+ENGINES = {NumpyDispatchEngine.name: NumpyDispatchEngine,
+           CplexDispatchEngine.name: CplexDispatchEngine}
+
+
+def makeEngine(name, **kwargs):
+    '''
+    Create a dispatch engine by name {'numpy', 'cplex'}
+    '''
+    try:
+        engine = ENGINES[name]
+    except KeyError:
+        raise ValueError('unknown dispatch engine %s' % str(name))
+    return engine(**kwargs)
+
+
+if __name__ == '__main__':
+    # compare the numpy engine against the cplex reference on random rounds
+    rng = np.random.default_rng(0)
+    for mode in (0, 1):
+        for trial in range(5):
+            reqMap = {'BU1': ('BU', list(rng.uniform(500, 1500, 24)), '2019-08-16 00:00:00', 900.0),
+                      'EV1': ('EV', list(rng.uniform(0, 300, 24)), '2019-08-16 00:00:00', 50.0),
+                      'BESS1': ('BESS', {'Rbess': 500, 'Cbattery': 1000, 'SoCl': 0.2, 'SoCu': 0.9,
+                                         'SoCend': 0.5, 'SoC': rng.uniform(0.3, 0.8)},
+                                '2019-08-16 00:00:00', 0.0)}
+            supply = [0] * 24 if mode == 1 else list(rng.uniform(800, 1800, 24))
+            problem = buildProblem(reqMap, supply, mode, 1, 1)
+            sol = makeEngine('numpy', persistent=False).solve(problem)
+            try:
+                ref = makeEngine('cplex', persistent=False).solve(problem)
+            except RuntimeError as e:
+                print('mode %d: %s, numpy status %s' % (mode, str(e), sol.status))
+                continue
+            loads = [i for i, k in enumerate(problem.kinds) if k != 'BESS']
+            print('mode %d: cplex %.4f (%.1f ms) numpy %.4f (%.1f ms, %d it, %s) max load diff %.2e viol %.2e' %
+                  (mode, ref.objective, 1e3 * ref.solveTime, sol.objective, 1e3 * sol.solveTime, sol.iterations,
+                   sol.status, np.max(np.abs(ref.x[loads] - sol.x[loads])), problem.violation(sol.x)))
+
+    # consecutive hourly rounds: cold start against the persistent, warm-started engines
+    profile = 800 + 400 * np.sin(np.arange(48) * np.pi / 12)
+    ev = 150 + 100 * np.cos(np.arange(48) * np.pi / 12)
+    engines = {'numpy cold': makeEngine('numpy', persistent=False), 'numpy warm': makeEngine('numpy')}
+    if cpx is not None:
+        engines.update({'cplex cold': makeEngine('cplex', persistent=False), 'cplex warm': makeEngine('cplex')})
+    totals = {name: [0.0, 0] for name in engines}
+    soc = 0.5
+    for step in range(24):
+        stamp = datetime(2019, 8, 16, step).strftime('%Y-%m-%d %H:%M:%S')
+        reqMap = {'BU1': ('BU', list(profile[step:step + 24] * rng.uniform(0.98, 1.02, 24)), stamp, 900.0),
+                  'EV1': ('EV', list(ev[step:step + 24] * rng.uniform(0.98, 1.02, 24)), stamp, 50.0),
+                  'BESS1': ('BESS', {'Rbess': 500, 'Cbattery': 1000, 'SoCl': 0.2, 'SoCu': 0.9,
+                                     'SoCend': 0.5, 'SoC': soc}, stamp, 0.0)}
+        problem = buildProblem(reqMap, [1000] * 24, 0, 1, 1)
+        for name, engine in engines.items():
+            sol = engine.solve(problem)
+            totals[name][0] += sol.solveTime
+            totals[name][1] += sol.iterations
+        soc += sol.x[problem.clients.index('BESS1'), 0] / 1000
+    for name, (t, it) in totals.items():
+        print('%s: %.2f ms per round, %.0f iterations per round' % (name, 1e3 * t / 24, it / 24))
@@ -0,0 +1,213 @@
+'''
+Decomposed dispatch for groups of Coordinators
+
+The only constraint that couples the loads in the dispatch problem (see DispatchEngine)
+is the supply constraint Sum_i x(i,j) <= b_j. The problem is split along it with the
+sharing form of ADMM: the leader keeps the coupling and the scaled multipliers, every
+coordinator of the group solves the local problems of the loads assigned to it.
+Each iteration
+    1. the leader broadcasts v = xbar - zbar + u and the penalty rho (one value per time step),
+    2. every local problem is solved
+           x_i = argmin f_i(x_i) + Sum_j rho_j/2 * (x_i(j) - x_i_prev(j) + v_j)^2
+       in closed form for buildings and chargers, and as a projection on the SoC
+       constraints for batteries,
+    3. the leader averages the local solutions and updates
+           zbar = min(u + xbar, b/N),  u = u + xbar - zbar,
+where N is the number of loads. The prices of the supply constraint are rho * u.
+The iterations are over once the residuals are small and the dispatch meets the
+constraints of the problem (DispatchProblem.feasible).
+'''
+import numpy as np
+from DispatchEngine import DispatchProblem, NumpyDispatchEngine
+
+
+class SharingDispatch():
+    '''
+    Leader side of the decomposed dispatch for one round.
+    '''
+    def __init__(self, problem, rhoFloor=0.05, tol=1e-4, maxIter=1000):
+        '''
+        :param problem: the dispatch problem of the round
+        :type problem: DispatchProblem
+        :param rhoFloor: smallest penalty relative to the largest one; the penalty of a
+            time step is the mean weight of the loads at that step
+        :type rhoFloor: float
+        :param tol: tolerance on the residuals relative to the power scale of the problem
+        :type tol: float
+        :param maxIter: maximum number of iterations
+        :type maxIter: int
+        '''
+        self.problem = problem
+        n, K = problem.nLoads, problem.horizon
+        loads = [i for i in range(n) if problem.kinds[i] != 'BESS']
+        rho = problem.weight[loads].mean(axis=0) if loads else np.ones(K)
+        self.rho = np.maximum(rho, rhoFloor * max(float(np.max(rho)), 1e-12))
+        self.u = np.zeros(K)
+        self.zbar = np.zeros(K)
+        self.v = np.zeros(K)
+        self.x = np.zeros((n, K))
+        self.tol = tol * problem.scale()
+        self.maxIter = maxIter
+        self.iteration = 0
+        self.status = 'running'
+        self.assignment = {}
+
+    @property
+    def done(self):
+        return self.status != 'running'
+
+    def assign(self, members):
+        '''
+        Spread the clients over the coordinators round-robin
+        :param members: IDs of the coordinators taking part
+        :type members: list
+        :return: {client: coordinator ID}
+        :rtype: dict
+        '''
+        members = sorted(members)
+        self.assignment = {client: members[idx % len(members)] for idx, client in enumerate(self.problem.clients)}
+        return self.assignment
+
+    def clientsOf(self, member):
+        return [client for client, owner in self.assignment.items() if owner == member]
+
+    def collect(self, local):
+        '''
+        Store local solutions {client: dispatched power}
+        '''
+        for client, values in local.items():
+            self.x[self.problem.clients.index(client)] = values
+
+    def solveLocal(self, local, clients):
+        '''
+        Solve the local problems of clients with the LocalDispatch of the leader
+        :param local: local dispatch of the leader
+        :type local: LocalDispatch
+        :param clients: clients to solve for
+        :type clients: list
+        '''
+        previous = {client: self.x[self.problem.clients.index(client)] for client in clients}
+        self.collect(local.solve(self.problem, clients, self.v, self.rho, previous))
+
+    def update(self):
+        '''
+        Coupling and multiplier update once all local solutions of the iteration are in.
+        :return: True when the iterations are over
+        :rtype: bool
+        '''
+        N = self.problem.nLoads
+        xbar = self.x.mean(axis=0)
+        zold = self.zbar
+        self.zbar = np.minimum(self.u + xbar, self.problem.supply / N)
+        self.u = self.u + xbar - self.zbar
+        self.v = xbar - self.zbar + self.u
+        self.iteration += 1
+        primal = N * np.max(np.abs(xbar - self.zbar))
+        dual = N * np.max(self.rho * np.abs(self.zbar - zold)) / np.max(self.rho)
+        if primal <= self.tol and dual <= self.tol and self.problem.feasible(self.dispatch()):
+            self.status = 'optimal'
+        elif self.iteration >= self.maxIter:
+            self.status = 'max_iter'
+        return self.done
+
+    def prices(self):
+        '''
+        Multipliers of the supply constraint
+        '''
+        return self.rho * self.u
+
+    def dispatch(self):
+        '''
+        Dispatch of the round. Any excess over the supply left by the iterations is
+        taken from the buildings and chargers in proportion to their dispatch.
+        '''
+        x = self.x.copy()
+        loads = np.array([kind != 'BESS' for kind in self.problem.kinds])
+        excess = x.sum(axis=0) - self.problem.supply
+        served = x[loads].sum(axis=0)
+        for j in np.nonzero((excess > 0) & (served > 0))[0]:
+            x[loads, j] *= max(0.0, 1.0 - excess[j] / served[j])
+        return x
+
+
+class LocalDispatch():
+    '''
+    Member side of the decomposed dispatch: solves the local problems of the clients
+    assigned to this coordinator and keeps their last solution.
+    '''
+    def __init__(self):
+        self.x = {}
+        self.engines = {}
+
+    def reset(self):
+        self.x = {}
+
+    def solve(self, problem, clients, v, rho, previous=None):
+        '''
+        :param problem: the dispatch problem of the round
+        :type problem: DispatchProblem
+        :param clients: clients assigned to this coordinator
+        :type clients: list
+        :param v: broadcast correction xbar - zbar + u
+        :param rho: penalty of each time step
+        :param previous: last solution of clients taken over from another coordinator
+        :type previous: dict
+        :return: {client: dispatched power}
+        :rtype: dict
+        '''
+        v = np.asarray(v, dtype=float)
+        rho = np.asarray(rho, dtype=float)
+        K = problem.horizon
+        local = {}
+        for client in clients:
+            i = problem.clients.index(client)
+            if previous is not None and client in previous:
+                self.x[client] = np.asarray(previous[client], dtype=float)
+            center = self.x.get(client, np.zeros(K)) - v
+            if problem.kinds[i] != 'BESS':
+                w, r = problem.weight[i], problem.target[i]
+                x = np.clip((w * r + rho * center) / (w + rho), problem.lb[i], problem.ub[i])
+            else:
+                # projection of the center on the battery constraints
+                batt = [dict(b, row=0) for b in problem.bess if b['row'] == i][0]
+                rating = float(np.max(np.abs(problem.ub[i])))
+                sub = DispatchProblem([client], ['BESS'], [center], [rho], [problem.lb[i]], [problem.ub[i]],
+                                      np.full(K, 2 * rating + 1.0), [batt], problem.start, problem.Ts)
+                if client not in self.engines:
+                    self.engines[client] = NumpyDispatchEngine()
+                x = self.engines[client].solve(sub).x[0]
+            self.x[client] = x
+            local[client] = x.tolist()
+        return local
+
+
+if __name__ == '__main__':
+    # decomposed dispatch over three coordinators against the central numpy engine
+    import time
+    from DispatchEngine import buildProblem
+    rng = np.random.default_rng(0)
+    members = ['AGGRa', 'AGGRb', 'AGGRc']
+    for mode, floor in ((0, 0.05), (1, 1.0)):
+        reqMap = {}
+        for unit in range(4):
+            reqMap['BU%d' % unit] = ('BU', list(rng.uniform(200, 500, 24)), '2019-08-16 00:00:00', 300.0)
+            reqMap['EV%d' % unit] = ('EV', list(rng.uniform(0, 150, 24)), '2019-08-16 00:00:00', 50.0)
+        for unit in range(2):
+            reqMap['BESS%d' % unit] = ('BESS', {'Rbess': 500, 'Cbattery': 1000, 'SoCl': 0.2, 'SoCu': 0.9,
+                                                'SoCend': 0.5, 'SoC': rng.uniform(0.3, 0.8)},
+                                       '2019-08-16 00:00:00', 0.0)
+        supply = [0] * 24 if mode == 1 else list(rng.uniform(1200, 1800, 24))
+        problem = buildProblem(reqMap, supply, mode, 1, 1)
+        ref = NumpyDispatchEngine(persistent=False).solve(problem)
+        sharing = SharingDispatch(problem, floor, maxIter=3000)
+        sharing.assign(members)
+        local = {member: LocalDispatch() for member in members}
+        start = time.time()
+        while not sharing.done:
+            for member in members:
+                sharing.collect(local[member].solve(problem, sharing.clientsOf(member), sharing.v, sharing.rho))
+            sharing.update()
+        x = sharing.dispatch()
+        print('mode %d: central %.4f (%.1f ms) dual %.4f (%s, %d it, %.1f ms) viol %.2e' %
+              (mode, ref.objective, 1e3 * ref.solveTime, problem.objective(x), sharing.status, sharing.iteration,
+               1e3 * (time.time() - start), problem.violation(x)))
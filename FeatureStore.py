@@ -0,0 +1,179 @@
+'''
+Input features of the load predictors
+
+The LSTM models of chargerPredictor and buildingPredictor take the last historyStep
+hours of measurements together with their calendar features, and the calendar
+features of the next futureStep hours. The calendar features of an hour are the
+one-hot day of week (7), a holiday flag (1) and the one-hot hour of day (24).
+
+CalendarTable keeps the day of week, hour and holiday flag of every hour of the
+playback and deployment range, computed from the US federal holiday calendar on its
+first use (pandas is only imported then).
+FeatureStore keeps the inputs in preallocated buffers of twice the window length:
+every row is written at slot i and i + length, so the current window is always the
+contiguous view buffer[i+1:i+1+length] and an update writes two rows in place.
+'''
+from datetime import datetime
+import numpy as np
+
+CALENDAR_FEATURES = 7 + 1 + 24
+
+
+def hourOf(date):
+    '''
+    Hours since the epoch of a date given as a string 'YYYY-MM-DD HH:MM:SS' or a datetime
+    :rtype: int
+    '''
+    if isinstance(date, str):
+        date = date.strip().replace(' ', 'T')
+    elif isinstance(date, datetime):
+        date = date.replace(tzinfo=None)
+    return int(np.datetime64(date, 'h').astype(np.int64))
+
+
+class CalendarTable():
+    '''
+    Calendar of the hours [start, end)
+    dayOfWeek : day of week of every hour (Monday = 0)
+    hour : hour of day of every hour
+    holiday : 1 on the US federal holidays
+    '''
+    def __init__(self, start='2018-01-01', end='2031-01-01'):
+        '''
+        :param start: first day of the range
+        :type start: str
+        :param end: day after the range
+        :type end: str
+        '''
+        self.start = hourOf(start)
+        self.end = hourOf(end)
+        self.first = None
+
+    def build(self, first, last):
+        # the holiday calendar is the only part that needs pandas, it is built once per range
+        from pandas.tseries.holiday import USFederalHolidayCalendar
+        self.first = first
+        hours = np.arange(first, last, dtype=np.int64)
+        days = hours // 24
+        self.dayOfWeek = ((days + 3) % 7).astype(np.int8)
+        self.hour = (hours % 24).astype(np.int8)
+        start = np.datetime64(int(days[0]), 'D')
+        end = np.datetime64(int(days[-1]), 'D')
+        holidays = USFederalHolidayCalendar().holidays(start=str(start), end=str(end))
+        holidays = np.array(holidays.values, dtype='datetime64[D]').astype(np.int64)
+        self.holiday = np.isin(days, holidays).astype(np.int8)
+
+    def index(self, hour):
+        '''
+        Position of an hour (since the epoch) in the table, the range is extended if needed
+        '''
+        if self.first is None:
+            self.build(self.start, self.end)
+        idx = hour - self.first
+        if idx < 0 or idx >= len(self.hour):
+            # out of range: rebuild with a year of margin on either side
+            last = self.first + len(self.hour)
+            self.build(min(self.first, hour - 366 * 24), max(last, hour + 366 * 24))
+            idx = hour - self.first
+        return idx
+
+    def write(self, row, hour):
+        '''
+        Write the calendar features of an hour into row (length CALENDAR_FEATURES) in place
+        '''
+        idx = self.index(hour)
+        row[:] = 0.0
+        row[self.dayOfWeek[idx]] = 1.0
+        row[7] = self.holiday[idx]
+        row[8 + self.hour[idx]] = 1.0
+
+
+class FeatureStore():
+    '''
+    Sliding windows of the predictor inputs
+    history : (1, historyStep, nValues + CALENDAR_FEATURES) measurements and their calendar features
+    future : (1, futureStep, CALENDAR_FEATURES) calendar features of the prediction horizon
+    '''
+    def __init__(self, historyStep, futureStep, nValues, calendar=None):
+        '''
+        :param historyStep: number of past hours in the history window
+        :type historyStep: int
+        :param futureStep: number of hours in the prediction horizon
+        :type futureStep: int
+        :param nValues: number of measurements per hour
+        :type nValues: int
+        :param calendar: calendar table, shared between stores
+        :type calendar: CalendarTable
+        '''
+        self.historyStep = historyStep
+        self.futureStep = futureStep
+        self.nValues = nValues
+        self.calendar = calendar if calendar is not None else CalendarTable()
+        self.historyBuffer = np.zeros((2 * historyStep, nValues + CALENDAR_FEATURES))
+        self.futureBuffer = np.zeros((2 * futureStep, CALENDAR_FEATURES))
+        self.historyPos = 0
+        self.futurePos = 0
+        self.updates = 0
+        self.ini = True
+
+    @property
+    def history(self):
+        return self.historyBuffer[None, self.historyPos:self.historyPos + self.historyStep]
+
+    @property
+    def future(self):
+        return self.futureBuffer[None, self.futurePos:self.futurePos + self.futureStep]
+
+    def start(self, hour):
+        '''
+        Fill the windows around the first hour: zero measurements for the past hours and
+        the calendar of the past and future hours
+        '''
+        h, f = self.historyStep, self.futureStep
+        self.historyBuffer[:] = 0.0
+        for k in range(h):
+            self.calendar.write(self.historyBuffer[k, self.nValues:], hour - h + k)
+        self.historyBuffer[h:] = self.historyBuffer[:h]
+        for k in range(f):
+            self.calendar.write(self.futureBuffer[k], hour + k)
+        self.futureBuffer[f:] = self.futureBuffer[:f]
+        self.historyPos = 0
+        self.futurePos = 0
+        self.ini = False
+
+    def update(self, date, values):
+        '''
+        Add the measurements of the hour date: the history window gets a new row with the
+        measurements and the calendar of the first future hour, the future window moves by
+        one hour.
+        :param date: time of the measurements
+        :type date: str or datetime
+        :param values: the measurements (normalized), length nValues
+        :type values: list
+        '''
+        hour = hourOf(date)
+        if self.ini:
+            self.start(hour)
+        h, f = self.historyStep, self.futureStep
+        slot = self.historyPos
+        row = self.historyBuffer[slot]
+        row[:self.nValues] = values
+        row[self.nValues:] = self.futureBuffer[self.futurePos]
+        self.historyBuffer[slot + h] = row
+        self.historyPos = (slot + 1) % h
+        slot = self.futurePos
+        self.calendar.write(self.futureBuffer[slot], hour + f)
+        self.futureBuffer[slot + f] = self.futureBuffer[slot]
+        self.futurePos = (slot + 1) % f
+        self.updates += 1
+
+    def persistence(self):
+        '''
+        Persistence forecast of the first measurement over the future window: the value of
+        the same hour the day before, the last value for the hours before the first update
+        '''
+        f = min(self.futureStep, self.historyStep)
+        values = self.history[0, -f:, 0].copy()
+        known = min(self.updates, f)
+        values[:f - known] = values[-1]
+        return np.resize(values, self.futureStep)
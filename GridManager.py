@@ -3,6 +3,7 @@ from riaps.run.comp import Component
 import spdlog
 import capnp
 import remapp_capnp
+from Messages import gridPower
 
 # riaps:keep_import:end
 
@@ -12,6 +13,6 @@ class GridManager(Component):
         self.logger.info("GridManager - starting")
         
     def on_setPoint(self):
-        msg = self.setPoint.recv_pyobj()
+        ts, val = self.setPoint.recv_pyobj()
         self.logger.info("forwarding grid set points")
-        self.power.send_pyobj(msg)
\ No newline at end of file
+        self.power.send_capnp(gridPower(ts, val))
\ No newline at end of file
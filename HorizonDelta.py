@@ -0,0 +1,151 @@
+'''
+Delta encoding of the horizons of PowerRequest and PowerDispatched
+
+Consecutive horizons of a load overlap: the horizon of a round is the one of the
+previous round moved by a step, with a new last value and a few revised ones. In
+delta mode a sender does not send the whole horizon every round, but a frame:
+    keyframe : the values of the horizon
+    delta : the number of steps the horizon moved since the frame it is based on (shift),
+            the length of the new horizon and the steps that changed, their values
+            quantized to resolution
+Frames are numbered. A delta names the frame it is based on (base), and a receiver
+that missed that frame drops the deltas until the next keyframe. The sender sends a
+keyframe every keyframe frames, when the horizon can not be encoded as a delta
+(a value that is not finite or too large for the resolution) or when more than half
+of the values changed.
+
+The sender keeps the horizon as the receiver rebuilds it, so the quantization does not
+build up: every value rebuilt by the receiver is within resolution / 2 of the value sent.
+'''
+from collections import namedtuple
+import numpy as np
+
+# seq : number of the frame
+# base : number of the frame the delta is based on, None for a keyframe
+# shift : steps the horizon moved since base
+# length : number of values of the horizon
+# resolution : step of the quantized values
+# indices : steps of the horizon that changed
+# values : the values of a keyframe, or the quantized values of the steps that changed
+HorizonFrame = namedtuple('HorizonFrame', 'seq base shift length resolution indices values')
+
+SEQ_MOD = 1 << 32
+QUANTUM_MAX = (1 << 31) - 1
+
+
+class HorizonEncoder():
+    '''
+    Sender of the frames of a horizon
+    reference : the horizon as the receiver rebuilds it
+    '''
+    def __init__(self, resolution, keyframe=12, maxShift=4):
+        '''
+        :param resolution: step of the quantized values (kW)
+        :type resolution: float
+        :param keyframe: a keyframe is sent at least every keyframe frames
+        :type keyframe: int
+        :param maxShift: largest shift tried for a delta
+        :type maxShift: int
+        '''
+        if resolution <= 0:
+            raise ValueError('resolution of a delta must be positive')
+        self.resolution = float(resolution)
+        self.keyframe = max(1, int(keyframe))
+        self.maxShift = max(0, int(maxShift))
+        self.reference = None
+        self.seq = -1
+        self.sinceKey = 0
+        self.keyframes = 0
+        self.deltas = 0
+
+    def encode(self, values):
+        '''
+        Frame of the next horizon
+        :param values: the horizon
+        :type values: list
+        :rtype: HorizonFrame
+        '''
+        values = np.asarray(values, dtype=float).ravel()
+        base = self.seq
+        self.seq = (self.seq + 1) % SEQ_MOD
+        frame = None
+        if self.reference is not None and self.sinceKey + 1 < self.keyframe and np.all(np.isfinite(values)):
+            frame = self.delta(base, values)
+        if frame is None:
+            self.reference = values.copy()
+            self.sinceKey = 0
+            self.keyframes += 1
+            return HorizonFrame(self.seq, None, 0, len(values), self.resolution, [], values.tolist())
+        self.sinceKey += 1
+        self.deltas += 1
+        return frame
+
+    def delta(self, base, values):
+        '''
+        Delta from the reference, with the shift that changes the fewest values
+        :return: the frame, None if a keyframe is smaller
+        '''
+        n = len(values)
+        best = None
+        for shift in range(min(self.maxShift, len(self.reference)) + 1):
+            rebuilt = np.full(n, np.nan)
+            m = max(0, min(n, len(self.reference) - shift))
+            rebuilt[:m] = self.reference[shift:shift + m]
+            # the steps past the shifted reference are nan, so they are always sent
+            changed = ~(np.abs(values - rebuilt) <= self.resolution / 2)
+            count = int(np.count_nonzero(changed))
+            if best is None or count < best[0]:
+                best = (count, shift, changed, rebuilt)
+        count, shift, changed, rebuilt = best
+        if count > n // 2:
+            return None
+        indices = np.flatnonzero(changed)
+        quanta = np.round(values[indices] / self.resolution)
+        if np.any(np.abs(quanta) > QUANTUM_MAX):
+            return None
+        rebuilt[indices] = quanta * self.resolution
+        self.reference = rebuilt
+        return HorizonFrame(self.seq, base, shift, n, self.resolution, indices.tolist(), quanta.astype(np.int64).tolist())
+
+    def stats(self):
+        return {'keyframes': self.keyframes, 'deltas': self.deltas}
+
+
+class HorizonDecoder():
+    '''
+    Receiver of the frames of a horizon
+    reference : the last horizon rebuilt
+    '''
+    def __init__(self):
+        self.reference = None
+        self.seq = None
+        self.keyframes = 0
+        self.deltas = 0
+        self.missed = 0
+
+    def decode(self, frame):
+        '''
+        Horizon of a frame
+        :type frame: HorizonFrame
+        :return: the horizon, None if the frame the delta is based on was missed
+        :rtype: list
+        '''
+        if frame.base is None:
+            self.reference = np.asarray(frame.values, dtype=float)
+            self.keyframes += 1
+        elif self.reference is None or frame.base != self.seq:
+            self.missed += 1
+            return None
+        else:
+            rebuilt = np.zeros(frame.length)
+            m = max(0, min(frame.length, len(self.reference) - frame.shift))
+            rebuilt[:m] = self.reference[frame.shift:frame.shift + m]
+            rebuilt[np.asarray(frame.indices, dtype=int)] = np.asarray(frame.values, dtype=float) * frame.resolution
+            self.reference = rebuilt
+            self.deltas += 1
+        self.seq = frame.seq
+        return self.reference.tolist()
+
+    def stats(self):
+        return {'keyframes': self.keyframes, 'deltas': self.deltas, 'missed': self.missed}
+
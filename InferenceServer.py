@@ -0,0 +1,61 @@
+'''
+Micro-batching of the requests to the predictive devices
+
+A ChargerPredictive or BuildingPredictive device can run in its own actor and serve the
+managers of every site on the node through the updateAndPredict port (see
+ChargerPredictionServer and BuildingPredictionServer in remapp.riaps), so the node loads
+each model once. The requests of the sites are queued and run through the model in one
+forward pass once max_batch requests are waiting, or max_wait seconds after the first
+one. Every site keeps its own input windows, keyed by the identity of its request.
+'''
+
+
+class RequestBatch():
+    '''
+    Requests waiting for the next forward pass
+    pending : list of (identity, msg)
+    '''
+    def __init__(self, maxBatch=1, maxWait=0.05):
+        '''
+        :param maxBatch: number of requests that triggers a forward pass
+        :type maxBatch: int
+        :param maxWait: seconds a request waits for others before the forward pass
+        :type maxWait: float
+        '''
+        self.maxBatch = max(1, int(maxBatch))
+        self.maxWait = float(maxWait)
+        self.pending = []
+        self.batches = 0
+        self.requests = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, identity):
+        return any(pending[0] == identity for pending in self.pending)
+
+    def add(self, identity, msg):
+        '''
+        Queue a request
+        :return: True if it is the first request of the batch
+        :rtype: bool
+        '''
+        self.pending.append((identity, msg))
+        return len(self.pending) == 1
+
+    def full(self):
+        return len(self.pending) >= self.maxBatch or self.maxWait <= 0
+
+    def take(self):
+        '''
+        Remove and return the queued requests
+        :rtype: list
+        '''
+        pending, self.pending = self.pending, []
+        self.batches += 1
+        self.requests += len(pending)
+        return pending
+
+    def stats(self):
+        return {'batches': self.batches, 'requests': self.requests,
+                'meanBatch': self.requests / self.batches if self.batches > 0 else 0.0}
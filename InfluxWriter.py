@@ -0,0 +1,271 @@
+'''
+Batched background writer of the Logger component
+
+The Logger queues the points of a LogData message, in the line protocol, and returns
+at once. A writer thread takes them from the queue and writes them to InfluxDB in
+batches, once batch_size points are waiting or the oldest one is max_age seconds old.
+The batches are sent gzipped over the pooled session of the InfluxDBClient.
+
+The queue holds at most capacity points. Once it is full the Logger either waits for
+room (policy 'block', at most block_timeout seconds) or the oldest points are dropped
+(policy 'drop').
+
+When a write fails, the database is taken as unreachable and probed with a growing
+delay. Until it answers, the batches are appended to the spool (see LogSpool), or go
+back to the front of the queue if there is no spool. Once the database is back, the
+spool is replayed in batches of replay_batch points, at most replay_rate points per
+second, between the writes of the new points.
+'''
+import time
+import threading
+from collections import deque
+
+BATCH_SIZE = 60
+
+
+class InfluxWriter(threading.Thread):
+    '''
+    Writer thread of the points of the Logger
+    queue : points waiting, with the time they were queued
+    '''
+    def __init__(self, client, batch_size=BATCH_SIZE, max_age=1.0, capacity=10000, policy='drop',
+                 block_timeout=1.0, logger=None, spool=None, setup=None, replay_batch=2000, replay_rate=500.0):
+        '''
+        :param client: client of the database, with gzip enabled
+        :type client: InfluxDBClient
+        :param batch_size: largest number of points of a write
+        :type batch_size: int
+        :param max_age: seconds a point waits for a full batch
+        :type max_age: float
+        :param capacity: largest number of points queued
+        :type capacity: int
+        :param policy: when the queue is full {'block', 'drop'}
+        :type policy: str
+        :param block_timeout: seconds put waits for room with the 'block' policy, then drops
+        :type block_timeout: float
+        :param logger: logger of the component
+        :param spool: spool of the points while the database is unreachable, None to keep them in the queue
+        :type spool: LogSpool
+        :param setup: called when the database is reached, before the writes
+        :param replay_batch: largest number of spooled points of a write
+        :type replay_batch: int
+        :param replay_rate: spooled points replayed per second
+        :type replay_rate: float
+        '''
+        threading.Thread.__init__(self, daemon=True)
+        if policy not in ('block', 'drop'):
+            raise ValueError('unknown queue policy %s' % str(policy))
+        self.client = client
+        self.batchSize = max(1, int(batch_size))
+        self.maxAge = max_age
+        self.capacity = max(self.batchSize, int(capacity))
+        self.policy = policy
+        self.blockTimeout = block_timeout
+        self.logger = logger
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.terminated = False
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.flushTime = 0.0
+        self.flushMax = 0.0
+        self.spool = spool
+        self.setup = setup
+        self.replayBatch = max(1, int(replay_batch))
+        self.replayRate = float(replay_rate)
+        self.online = False
+        self.probes = 0
+        self.nextProbe = 0.0
+        self.nextReplay = 0.0
+
+    def put(self, points):
+        '''
+        Queue points for writing
+        :param points: the points in the line protocol, see LogData.linesOf
+        :type points: list
+        :return: number of points dropped to make room
+        :rtype: int
+        '''
+        now = time.time()
+        with self.cond:
+            if self.policy == 'block':
+                deadline = now + self.blockTimeout
+                while len(self.queue) + len(points) > self.capacity and not self.terminated:
+                    wait = deadline - time.time()
+                    if wait <= 0 or not self.cond.wait(wait):
+                        break
+            dropped = self.trim(len(points))
+            for point in points:
+                self.queue.append((now, point))
+            self.queued += len(points)
+            self.cond.notify_all()
+        return dropped
+
+    def trim(self, room):
+        '''
+        Drop the oldest points until room points fit, with the lock held
+        '''
+        dropped = 0
+        while len(self.queue) > 0 and len(self.queue) + room > self.capacity:
+            self.queue.popleft()
+            dropped += 1
+        self.dropped += dropped
+        return dropped
+
+    def take(self, until=None):
+        '''
+        Wait for a batch, with the lock held
+        :param until: time to give up waiting, None to wait for a batch
+        :return: the batch, empty if until passed or once terminated and flushed
+        :rtype: list
+        '''
+        while not self.terminated:
+            if len(self.queue) >= self.batchSize:
+                break
+            now = time.time()
+            wait = None
+            if len(self.queue) > 0:
+                wait = self.queue[0][0] + self.maxAge - now
+                if wait <= 0:
+                    break
+            if until is not None:
+                if until <= now:
+                    return []
+                wait = until - now if wait is None else min(wait, until - now)
+            self.cond.wait(wait)
+        n = min(self.batchSize, len(self.queue))
+        batch = [self.queue.popleft() for i in range(n)]
+        self.cond.notify_all()
+        return batch
+
+    def write(self, lines):
+        '''
+        Write points in the line protocol. A failure takes the database offline.
+        :return: True if they were written
+        :rtype: bool
+        '''
+        t0 = time.time()
+        try:
+            self.client.write_points(lines, time_precision='n', protocol='line')
+        except Exception as e:
+            self.failed += 1
+            if self.logger is not None:
+                self.logger.error('writing %d points failed: %s' % (len(lines), str(e)))
+            self.offline()
+            return False
+        dt = time.time() - t0
+        self.written += len(lines)
+        self.batches += 1
+        self.flushTime += dt
+        self.flushMax = max(self.flushMax, dt)
+        return True
+
+    def offline(self):
+        self.online = False
+        self.probes += 1
+        self.nextProbe = time.time() + min(0.1 * 2 ** self.probes, 30.0)
+
+    def connect(self):
+        '''
+        Probe the database and run the setup once it answers
+        '''
+        try:
+            self.client.ping()
+            if self.setup is not None:
+                self.setup()
+        except Exception as e:
+            if self.probes == 0 and self.logger is not None:
+                self.logger.error('database connection failed: %s' % str(e))
+            self.offline()
+            return
+        if self.probes > 0 and self.logger is not None:
+            self.logger.info('database reachable after %d probes' % self.probes)
+        self.online = True
+        self.probes = 0
+
+    def store(self, batch, lines):
+        '''
+        Keep a batch that could not be written
+        '''
+        if self.spool is not None:
+            self.spool.append(lines)
+            return
+        # the batch goes back to the front of the queue and waits for the next attempt
+        with self.cond:
+            if self.terminated:
+                self.dropped += len(batch)
+                return
+            keep = batch[max(0, len(batch) - (self.capacity - len(self.queue))):]
+            self.dropped += len(batch) - len(keep)
+            self.queue.extendleft(reversed(keep))
+
+    def replay(self):
+        '''
+        Write a batch of spooled points
+        '''
+        lines = self.spool.read(self.replayBatch)
+        if len(lines) > 0 and self.write(lines):
+            self.spool.commit()
+            self.nextReplay = time.time() + len(lines) / self.replayRate
+
+    def until(self):
+        '''
+        Time of the next probe or replay
+        '''
+        if not self.online:
+            return self.nextProbe
+        if self.spool is not None and self.spool.pending() > 0:
+            return self.nextReplay
+        return None
+
+    def run(self):
+        while True:
+            if not self.online and time.time() >= self.nextProbe:
+                self.connect()
+            if not self.online and self.spool is None:
+                # the points wait in the queue until the database answers
+                with self.cond:
+                    if self.terminated:
+                        self.dropped += len(self.queue)
+                        self.queue.clear()
+                        break
+                    self.cond.wait(max(0.0, self.nextProbe - time.time()))
+                continue
+            with self.cond:
+                batch = self.take(self.until())
+            if len(batch) > 0:
+                lines = [point for stamp, point in batch]
+                if not (self.online and self.write(lines)):
+                    self.store(batch, lines)
+            elif self.terminated:
+                break
+            if self.online and self.spool is not None and self.spool.pending() > 0 and time.time() >= self.nextReplay:
+                self.replay()
+        if self.spool is not None:
+            self.spool.close()
+
+    def stats(self):
+        '''
+        Counters of the writer, the flush latency in ms
+        '''
+        stats = {'queued': self.queued, 'written': self.written, 'dropped': self.dropped,
+                 'failed': self.failed, 'backlog': len(self.queue), 'batches': self.batches,
+                 'flushMean': 1e3 * self.flushTime / max(1, self.batches), 'flushMax': 1e3 * self.flushMax,
+                 'online': self.online}
+        if self.spool is not None:
+            stats.update(self.spool.stats())
+        return stats
+
+    def close(self, timeout=5.0):
+        '''
+        Write the points queued and stop the thread
+        '''
+        with self.cond:
+            self.terminated = True
+            self.cond.notify_all()
+        if self.is_alive():
+            self.join(timeout)
+
@@ -0,0 +1,255 @@
+'''
+Inference paths of the load prediction models
+
+Keras model.predict sets up a data pipeline on every call, which costs far more than
+the LSTM arithmetic for the one sample the predictive devices run every hour. The
+networks in models/ are small, so they are evaluated directly:
+    numpy    - the weights are copied out of the Keras model once and the network is
+               evaluated with NumPy (float32, as in TensorFlow)
+    function - the model is traced once into a tf.function for the input shapes
+    predict  - Keras model.predict, the reference
+Two architectures are supported by the numpy path:
+    SequentialNetwork     - stacked LSTM and Dense layers (LSTM128LSTM64DEN24DEN24.h5,
+                            ev_example_model.h5)
+    EncoderDecoderNetwork - LSTM encoder of the history, then one Dense step per future
+                            hour fed with the encoder state, the previous output and the
+                            calendar of the hour (my_lstm_model.h5)
+compileModel checks the selected path against model.predict at startup, logs the
+single sample latency of both and falls back to model.predict if they disagree.
+'''
+import time
+import numpy as np
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+ACTIVATIONS = {'sigmoid': sigmoid,
+               'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0.0, 1.0),
+               'tanh': np.tanh,
+               'relu': lambda x: np.maximum(x, 0.0),
+               'linear': lambda x: x}
+
+
+def activationOf(name):
+    try:
+        return ACTIVATIONS[name]
+    except KeyError:
+        raise ValueError('unsupported activation %s' % str(name))
+
+
+class LSTMLayer():
+    '''
+    Keras LSTM layer, gates ordered (input, forget, cell, output)
+    '''
+    def __init__(self, kernel, recurrentKernel, bias, activation='tanh', recurrentActivation='sigmoid',
+                 returnSequences=False):
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        self.recurrentKernel = np.asarray(recurrentKernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.units = self.recurrentKernel.shape[0]
+        self.activation = activationOf(activation)
+        self.recurrentActivation = activationOf(recurrentActivation)
+        self.returnSequences = returnSequences
+
+    def run(self, x):
+        '''
+        :param x: input (batch, steps, features)
+        :return: (outputs of every step or None, last hidden state, last cell state)
+        '''
+        batch, steps = x.shape[0], x.shape[1]
+        U = self.units
+        # input projection of all the steps in one product
+        projected = np.dot(x.reshape(batch * steps, -1), self.kernel).reshape(batch, steps, 4 * U) + self.bias
+        h = np.zeros((batch, U), dtype=np.float32)
+        c = np.zeros((batch, U), dtype=np.float32)
+        outputs = np.empty((batch, steps, U), dtype=np.float32) if self.returnSequences else None
+        for t in range(steps):
+            z = projected[:, t] + np.dot(h, self.recurrentKernel)
+            i = self.recurrentActivation(z[:, :U])
+            f = self.recurrentActivation(z[:, U:2 * U])
+            c = f * c + i * self.activation(z[:, 2 * U:3 * U])
+            o = self.recurrentActivation(z[:, 3 * U:])
+            h = o * self.activation(c)
+            if outputs is not None:
+                outputs[:, t] = h
+        return outputs, h, c
+
+    def __call__(self, x):
+        outputs, h, c = self.run(x)
+        return outputs if self.returnSequences else h
+
+
+class DenseLayer():
+    def __init__(self, kernel, bias, activation='linear'):
+        self.kernel = np.asarray(kernel, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+        self.activation = activationOf(activation)
+
+    def __call__(self, x):
+        return self.activation(np.dot(x, self.kernel) + self.bias)
+
+
+class SequentialNetwork():
+    '''
+    Stack of LSTM and Dense layers
+    '''
+    def __init__(self, layers):
+        self.layers = layers
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+class EncoderDecoderNetwork():
+    '''
+    LSTM encoder of the history, the prediction of future hour k is
+        y_k = output(hidden([h, y_k-1, future_k]))
+    with h the last hidden state of the encoder and y_-1 the last value of the first
+    history feature (the measured power).
+    '''
+    def __init__(self, encoder, hidden, output, horizon):
+        self.encoder = encoder
+        self.hidden = hidden
+        self.output = output
+        self.horizon = horizon
+
+    def __call__(self, inputs):
+        history = np.asarray(inputs[0], dtype=np.float32)
+        future = np.asarray(inputs[1], dtype=np.float32)
+        outputs, h, c = self.encoder.run(history)
+        y = history[:, -1, 0:1]
+        prediction = np.empty((history.shape[0], self.horizon), dtype=np.float32)
+        for k in range(self.horizon):
+            y = self.output(self.hidden(np.concatenate([h, y, future[:, k, :]], axis=-1)))
+            prediction[:, k] = y[:, 0]
+        return prediction
+
+
+def layerFromKeras(layer):
+    '''
+    NumPy version of a Keras LSTM or Dense layer
+    '''
+    config = layer.get_config()
+    kind = layer.__class__.__name__
+    weights = layer.get_weights()
+    if kind == 'LSTM':
+        if config.get('go_backwards') or config.get('stateful') or not config.get('use_bias', True):
+            raise ValueError('unsupported LSTM configuration in %s' % layer.name)
+        return LSTMLayer(weights[0], weights[1], weights[2], config['activation'],
+                         config['recurrent_activation'], config['return_sequences'])
+    elif kind == 'Dense':
+        if not config.get('use_bias', True):
+            raise ValueError('unsupported Dense configuration in %s' % layer.name)
+        return DenseLayer(weights[0], weights[1], config['activation'])
+    elif kind in ('InputLayer', 'Dropout'):
+        return None
+    raise ValueError('unsupported layer %s (%s)' % (layer.name, kind))
+
+
+def fromKeras(model):
+    '''
+    NumPy network with the weights of a Keras model
+    :raises ValueError: if the architecture is not one of the supported ones
+    '''
+    inputs = model.inputs if isinstance(model.inputs, list) else [model.inputs]
+    if len(inputs) == 1:
+        layers = [layerFromKeras(layer) for layer in model.layers]
+        return SequentialNetwork([layer for layer in layers if layer is not None])
+    # encoder-decoder: one LSTM with its state and a Dense pair applied once per future hour
+    lstm = [layer for layer in model.layers if layer.__class__.__name__ == 'LSTM']
+    dense = [layer for layer in model.layers if layer.__class__.__name__ == 'Dense']
+    if len(inputs) != 2 or len(lstm) != 1 or len(dense) != 2 or not lstm[0].get_config().get('return_state'):
+        raise ValueError('unsupported model architecture %s' % model.name)
+    horizon = int(model.outputs[0].shape[-1])
+    return EncoderDecoderNetwork(layerFromKeras(lstm[0]), layerFromKeras(dense[0]), layerFromKeras(dense[1]), horizon)
+
+
+def tracedModel(model):
+    '''
+    The Keras model traced into a tf.function
+    '''
+    import tensorflow as tf
+    function = tf.function(lambda x: model(x, training=False))
+    return lambda x: function(x).numpy()
+
+
+def sampleInputs(model, batch=1, seed=0):
+    '''
+    Random inputs with the shapes of the model inputs
+    '''
+    rng = np.random.default_rng(seed)
+    inputs = model.inputs if isinstance(model.inputs, list) else [model.inputs]
+    samples = [rng.uniform(0, 1, (batch,) + tuple(int(d) for d in x.shape[1:])) for x in inputs]
+    return samples if len(samples) > 1 else samples[0]
+
+
+def latency(function, inputs, repeat=20):
+    '''
+    Mean single call latency in seconds, after one warm up call
+    '''
+    function(inputs)
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        function(inputs)
+    return (time.perf_counter() - t0) / repeat
+
+
+def compileModel(model, mode='numpy', logger=None, tol=1e-3, repeat=5):
+    '''
+    Inference function of a Keras model: inputs -> predictions (batch, horizon)
+    :param model: the Keras model
+    :param mode: {'numpy', 'function', 'predict'}
+    :type mode: str
+    :param logger: logger for the latency report
+    :param tol: largest difference from model.predict accepted
+    :type tol: float
+    :param repeat: number of calls timed for the report
+    :type repeat: int
+    '''
+    reference = lambda x: model.predict(x, verbose=0)
+    if mode == 'predict':
+        return reference
+    try:
+        if mode == 'numpy':
+            function = fromKeras(model)
+        elif mode == 'function':
+            function = tracedModel(model)
+        else:
+            raise ValueError('unknown inference mode %s' % str(mode))
+    except ValueError as e:
+        if logger is not None:
+            logger.info('%s, using model.predict' % str(e))
+        return reference
+    inputs = sampleInputs(model)
+    diff = float(np.max(np.abs(np.asarray(function(inputs)) - np.asarray(reference(inputs)))))
+    if logger is not None:
+        logger.info('single sample latency: predict %.2f ms, %s %.2f ms, max difference %.2e' %
+                    (1e3 * latency(reference, inputs, repeat), mode, 1e3 * latency(function, inputs, repeat), diff))
+    if diff > tol:
+        if logger is not None:
+            logger.info('%s inference differs from model.predict, using model.predict' % mode)
+        return reference
+    return function
+
+
+if __name__ == '__main__':
+    # latency and accuracy of the inference paths on the models in models/
+    import sys
+    import tensorflow as tf
+    paths = sys.argv[1:] or ['models/LSTM128LSTM64DEN24DEN24.h5', 'models/my_lstm_model.h5', 'models/ev_example_model.h5']
+    for path in paths:
+        model = tf.keras.models.load_model(path, compile=False)
+        for batch in (1, 8):
+            inputs = sampleInputs(model, batch)
+            predict = lambda x: model.predict(x, verbose=0)
+            reference = np.asarray(predict(inputs))
+            report = ['predict %.2f ms' % (1e3 * latency(predict, inputs))]
+            for mode, function in (('function', tracedModel(model)), ('numpy', fromKeras(model))):
+                diff = float(np.max(np.abs(np.asarray(function(inputs)) - reference)))
+                report.append('%s %.2f ms (max diff %.1e)' % (mode, 1e3 * latency(function, inputs), diff))
+            print('%s batch %d: %s' % (path, batch, ', '.join(report)))
@@ -0,0 +1,90 @@
+'''
+Columnar LogData messages of the Coordinator
+
+A LogData message is a list of series, one per table and load:
+    (tags, measurement, field, start, step, values)
+    tags : {tag column: value}
+    measurement : name of the table
+    field : column of the values
+    start : time stamp of the first value, in seconds since the epoch
+    step : seconds between the values
+    values : the values packed as little-endian float64
+The Logger turns a series into line protocol without building a point per value: the
+measurement, tags and field are escaped once per series and the time stamps are
+computed from start and step. NaN and infinite values can not be stored and are left out.
+'''
+import math
+import calendar
+from datetime import datetime
+import numpy as np
+
+VALUE = np.dtype('<f8')
+
+
+def series(tags, measurement, field, start, step, values):
+    '''
+    A series of a LogData message
+    :param values: the values
+    :type values: list or numpy array
+    :rtype: tuple
+    '''
+    return (tags, measurement, field, float(start), float(step), np.asarray(values, dtype=VALUE).tobytes())
+
+
+def valuesOf(packed):
+    return np.frombuffer(packed, dtype=VALUE)
+
+
+def epochOf(timestamp):
+    '''
+    Nanoseconds of a time stamp of a series. The Coordinator sends the local time of
+    the data, which is stored as UTC.
+    :param timestamp: seconds since the epoch
+    :type timestamp: float
+    :rtype: int
+    '''
+    dt = datetime.fromtimestamp(timestamp)
+    return calendar.timegm(dt.timetuple()) * 1000000000 + dt.microsecond * 1000
+
+
+def escape(key):
+    '''
+    Escape a measurement, tag or field name of the line protocol
+    '''
+    return str(key).replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+
+def timesOf(start, step, n):
+    '''
+    Nanoseconds of the n time stamps of a series. The offset of the local time is
+    taken once unless the series crosses a change of the offset (daylight saving).
+    '''
+    if n == 0:
+        return []
+    first = epochOf(start)
+    last = epochOf(start + (n - 1) * step)
+    ns = int(round(step * 1e9))
+    if last - first == (n - 1) * ns:
+        return list(range(first, first + n * ns, ns)) if ns != 0 else [first] * n
+    return [epochOf(start + i * step) for i in range(n)]
+
+
+def linesOf(message):
+    '''
+    Line protocol of a LogData message
+    :param message: list of series
+    :type message: list
+    :return: one line per value
+    :rtype: list
+    '''
+    lines = []
+    for tags, measurement, field, start, step, packed in message:
+        key = escape(measurement)
+        for tag in sorted(tags):
+            if str(tag) != '' and str(tags[tag]) != '':
+                key += ',%s=%s' % (escape(tag), escape(tags[tag]))
+        key += ' %s=' % escape(field)
+        values = valuesOf(packed)
+        times = timesOf(start, step, len(values))
+        lines += ['%s%r %d' % (key, value, stamp) for value, stamp in zip(values.tolist(), times) if math.isfinite(value)]
+    return lines
@@ -0,0 +1,256 @@
+'''
+Write-ahead spool of the Logger component
+
+The points that can not be written to InfluxDB are appended to segment files in the
+spool folder, one record per batch:
+    header : payload length, CRC-32 of the payload, number of points (3 x uint32)
+    payload : the points in the line protocol, zlib compressed
+A segment is closed once it holds segment_size bytes. The replay reads the records
+in order from a cursor, saved in the folder, and segments are deleted as soon as
+every one of their points is written. A record cut by a crash is truncated when the
+spool is opened.
+
+The spool holds at most max_bytes. Beyond that the oldest segments are dropped to make
+room for new points (policy 'oldest'), or the new points are dropped (policy 'newest').
+
+The spool is used by the writer thread only, it is not thread safe.
+'''
+import os
+import zlib
+import struct
+from collections import OrderedDict
+
+HEADER = struct.Struct('<III')
+
+
+class LogSpool():
+    '''
+    Segments of spooled points
+    segments : {segment number: points after the cursor}
+    sizes : {segment number: bytes}
+    cursor : (segment number, offset) of the first point not replayed
+    '''
+    def __init__(self, path, segment_size=1 << 20, max_bytes=64 << 20, policy='oldest', logger=None):
+        '''
+        :param path: folder of the spool
+        :type path: str
+        :param segment_size: bytes of a segment
+        :type segment_size: int
+        :param max_bytes: bytes of the spool, at least two segments
+        :type max_bytes: int
+        :param policy: what is dropped when the spool is full {'oldest', 'newest'}
+        :type policy: str
+        :param logger: logger of the component
+        '''
+        if policy not in ('oldest', 'newest'):
+            raise ValueError('unknown spool policy %s' % str(policy))
+        self.path = path
+        self.segmentSize = int(segment_size)
+        self.maxBytes = max(int(max_bytes), 2 * self.segmentSize)
+        self.policy = policy
+        self.logger = logger
+        self.segments = OrderedDict()
+        self.sizes = {}
+        self.cursor = (0, 0)
+        self.next = 0
+        self.file = None
+        self.readEnd = None
+        self.readCounts = {}
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        os.makedirs(path, exist_ok=True)
+        self.open()
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+
+    def segmentPath(self, seg):
+        return os.path.join(self.path, '%010d.seg' % seg)
+
+    def cursorPath(self):
+        return os.path.join(self.path, 'cursor')
+
+    def loadCursor(self):
+        try:
+            with open(self.cursorPath(), 'r') as f:
+                seg, offset = f.read().split()
+            return int(seg), int(offset)
+        except (OSError, ValueError):
+            return None
+
+    def saveCursor(self):
+        tmp = self.cursorPath() + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % self.cursor)
+        os.replace(tmp, self.cursorPath())
+
+    def records(self, seg, start=0):
+        '''
+        Records of a segment from an offset
+        :return: (offset after the record, number of points, payload) of every valid record
+        '''
+        with open(self.segmentPath(seg), 'rb') as f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return
+                length, crc, points = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                offset += HEADER.size + length
+                yield offset, points, payload
+
+    def open(self):
+        '''
+        Find the segments left by an earlier run, drop the replayed ones and truncate
+        the records cut by a crash
+        '''
+        segs = sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg') and name[:-4].isdigit())
+        cursor = self.loadCursor()
+        for seg in segs:
+            if cursor is not None and seg < cursor[0]:
+                os.remove(self.segmentPath(seg))
+                continue
+            start = cursor[1] if cursor is not None and seg == cursor[0] else 0
+            points, end = 0, start
+            for end, n, payload in self.records(seg, start):
+                points += n
+            size = os.path.getsize(self.segmentPath(seg))
+            if end < size:
+                self.log('spool segment %d: %d bytes after offset %d dropped' % (seg, size - end, end))
+                with open(self.segmentPath(seg), 'r+b') as f:
+                    f.truncate(end)
+            self.segments[seg] = points
+            self.sizes[seg] = end
+        if len(self.segments) > 0:
+            first = next(iter(self.segments))
+            self.cursor = cursor if cursor is not None and cursor[0] == first else (first, 0)
+            self.next = max(self.segments) + 1
+            self.log('spool %s: %d points in %d segments' % (self.path, self.pending(), len(self.segments)))
+        elif cursor is not None:
+            self.next = cursor[0] + 1
+
+    def pending(self):
+        '''
+        Number of points spooled and not replayed
+        '''
+        return sum(self.segments.values())
+
+    def bytes(self):
+        return sum(self.sizes.values())
+
+    def roll(self):
+        '''
+        Start a new segment
+        '''
+        if self.file is not None:
+            self.file.close()
+        seg = self.next
+        self.next += 1
+        self.file = open(self.segmentPath(seg), 'ab')
+        self.segments[seg] = 0
+        self.sizes[seg] = 0
+        if len(self.segments) == 1:
+            self.cursor = (seg, 0)
+            self.saveCursor()
+
+    def remove(self, seg):
+        '''
+        Delete a segment, the cursor moves to the next one
+        '''
+        if self.file is not None and seg == max(self.segments):
+            self.file.close()
+            self.file = None
+        del self.segments[seg]
+        del self.sizes[seg]
+        os.remove(self.segmentPath(seg))
+        if self.cursor[0] == seg:
+            self.cursor = (next(iter(self.segments)), 0) if len(self.segments) > 0 else (self.next, 0)
+
+    def append(self, lines):
+        '''
+        Spool points
+        :param lines: the points in the line protocol
+        :type lines: list
+        :return: number of points dropped
+        :rtype: int
+        '''
+        payload = zlib.compress('\n'.join(lines).encode('utf-8'))
+        record = HEADER.pack(len(payload), zlib.crc32(payload), len(lines)) + payload
+        dropped = 0
+        if self.bytes() + len(record) > self.maxBytes:
+            if self.policy == 'newest':
+                self.dropped += len(lines)
+                return len(lines)
+            while self.bytes() + len(record) > self.maxBytes and len(self.segments) > 1:
+                seg = next(iter(self.segments))
+                dropped += self.segments[seg]
+                self.remove(seg)
+            self.saveCursor()
+            self.log('spool full, %d points dropped' % dropped)
+        if self.file is None or self.sizes[max(self.segments)] >= self.segmentSize:
+            self.roll()
+        self.file.write(record)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.sizes[max(self.segments)] += len(record)
+        self.segments[max(self.segments)] += len(lines)
+        self.spooled += len(lines)
+        self.dropped += dropped
+        return dropped
+
+    def read(self, n):
+        '''
+        Points from the cursor, in whole records, until there are n of them. They are
+        replayed once commit is called.
+        :return: the points in the line protocol
+        :rtype: list
+        '''
+        lines = []
+        self.readCounts = {}
+        self.readEnd = self.cursor
+        for seg in self.segments:
+            if seg < self.cursor[0]:
+                continue
+            start = self.cursor[1] if seg == self.cursor[0] else 0
+            for end, points, payload in self.records(seg, min(start, self.sizes[seg])):
+                if end > self.sizes[seg]:
+                    break
+                lines += zlib.decompress(payload).decode('utf-8').split('\n')
+                self.readCounts[seg] = self.readCounts.get(seg, 0) + points
+                self.readEnd = (seg, end)
+                if len(lines) >= n:
+                    return lines
+        return lines
+
+    def commit(self):
+        '''
+        Move the cursor after the points of the last read and delete the replayed segments
+        '''
+        if self.readEnd is None:
+            return
+        seg, offset = self.readEnd
+        for s, points in self.readCounts.items():
+            self.segments[s] -= points
+            self.replayed += points
+        self.cursor = (seg, offset)
+        for s in list(self.segments):
+            if s < seg or (s == seg and offset >= self.sizes[s]):
+                self.remove(s)
+        self.readEnd = None
+        self.readCounts = {}
+        self.saveCursor()
+
+    def stats(self):
+        return {'spooled': self.spooled, 'replayed': self.replayed, 'spoolDropped': self.dropped,
+                'spoolPending': self.pending(), 'spoolBytes': self.bytes()}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
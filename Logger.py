@@ -11,8 +11,10 @@ import logging
 from datetime import datetime
 import os
 import yaml
-
-BATCH_SIZE = 60
+from InfluxWriter import InfluxWriter, BATCH_SIZE
+from LogData import linesOf
+from LogSpool import LogSpool
+from Messages import logDataOf
 
 class Logger(Component):
     def __init__(self, configfile):
@@ -25,37 +27,72 @@ class Logger(Component):
                 print(exc)
         self.db_name = db_config['db_name']
         self.db_drop = db_config['db_drop']
-        self.point_values = []
+        # points of a write, seconds a point waits for a full batch, points queued at most,
+        # and what happens when the queue is full {'block', 'drop'} (see InfluxWriter)
+        batch_size, max_age, capacity, policy, block_timeout, timeout = BATCH_SIZE, 1.0, 10000, 'drop', 1.0, 10
+        try: batch_size = int(db_config['log_batch_size'])
+        except KeyError: pass
+        try: max_age = float(db_config['log_max_age'])
+        except KeyError: pass
+        try: capacity = int(db_config['log_queue_size'])
+        except KeyError: pass
+        try: policy = db_config['log_queue_policy']
+        except KeyError: pass
+        try: block_timeout = float(db_config['log_block_timeout'])
+        except KeyError: pass
+        try: timeout = float(db_config['log_timeout'])
+        except KeyError: pass
+        # spool of the points while the database is unreachable (see LogSpool): folder (None disables it),
+        # bytes of a segment and of the spool, what is dropped when it is full {'oldest', 'newest'},
+        # and points of a replay write and replayed per second
+        spool_dir, segment_size, spool_size, spool_policy, replay_batch, replay_rate = 'spool', 1 << 20, 64 << 20, 'oldest', 2000, 500.0
+        try: spool_dir = db_config['spool_dir']
+        except KeyError: pass
+        try: segment_size = int(db_config['spool_segment_size'])
+        except KeyError: pass
+        try: spool_size = int(db_config['spool_size'])
+        except KeyError: pass
+        try: spool_policy = db_config['spool_policy']
+        except KeyError: pass
+        try: replay_batch = int(db_config['replay_batch'])
+        except KeyError: pass
+        try: replay_rate = float(db_config['replay_rate'])
+        except KeyError: pass
+        self.writer = None
         try:
             self.client = InfluxDBClient(host=db_config['db_host'], port=db_config['db_port'],
-                                         database=db_config['db_name'], username=db_config['db_user'], password=db_config['db_password'])
-            self.client.create_database(db_config['db_name'])
-            self.client.switch_database(db_config['db_name'])
+                                         database=db_config['db_name'], username=db_config['db_user'], password=db_config['db_password'],
+                                         timeout=timeout, gzip=True)
         except:
-            self.logger.error('database connection failed')
+            self.logger.error('database client failed')
             self.client = None
+        else:
+            # the database is created by the writer once it is reachable, the points are spooled until then
+            spool = LogSpool(spool_dir, segment_size, spool_size, spool_policy, self.logger) if spool_dir else None
+            self.writer = InfluxWriter(self.client, batch_size, max_age, capacity, policy, block_timeout, self.logger,
+                                       spool, self.setupDatabase, replay_batch, replay_rate)
+            self.writer.start()
+
+    def setupDatabase(self):
+        self.client.create_database(self.db_name)
+        self.client.switch_database(self.db_name)
 
 
     def on_logData(self):
-        datastream = self.logData.recv_pyobj()
-        for point in datastream:
-            tag, measurement, times, values = point
-            assert len(times) == len(values)
-            if self.client == None: return
-            for i in range(len(times)):
-                self.point_values.append({
-                        "time" : datetime.fromtimestamp(times[i]).isoformat()+'Z',
-                        "tags" : tag,
-                        "measurement" : measurement,
-                        "fields" : values[i]
-                    })
-            # if len(self.point_values) >= BATCH_SIZE:
-#             self.logger.info(str(self.point_values))
-            self.client.write_points(self.point_values)
-            self.point_values = []
+        datastream = logDataOf(self.logData.recv_capnp())
+        if self.writer == None: return
+        # the points are written by the writer thread
+        dropped = self.writer.put(linesOf(datastream))
+        if dropped > 0:
+            self.logger.warning('log queue full, %d points dropped' % dropped)
+        self.logger.info('log writer: %s' % str(self.writer.stats()))
 
     def __destroy__(self):
+        if self.writer:
+            self.writer.close()
+            self.logger.info('log writer: %s' % str(self.writer.stats()))
         if self.client and self.db_drop:
-            self.client.drop_database(self.db_name)
+            try: self.client.drop_database(self.db_name)
+            except: self.logger.error('database not dropped')
             
             
\ No newline at end of file
@@ -0,0 +1,375 @@
+'''
+Cap'n Proto encoding of the messages between the components
+
+The messages declared in remapp.capnp are sent as the bytes of a packed Cap'n Proto
+message (send_capnp) instead of a pickled object. A receiver no longer unpickles whatever
+object a sender put on the wire. The numbers travel as little-endian arrays in Data fields
+(horizons, quantities), and the rows of the device answers and the series of LogData as
+columns, with their keys, names and text values once per message, so a message is not
+bigger than its pickle.
+
+Every message has an encoder, named after the message, taking the values the component
+used to send, and a decoder (...Of) returning them as before, so the handlers work on
+the same tuples, lists and dicts:
+    PowerRequest : (reqID, reqKind, reqTime, reqPower, currPower), reqPower is the
+                   horizon or, for a battery, the {attribute: value} of BESSAns
+    PowerDispatched : the dispatch of a round {client: (reqKind, powerGranted)}, a manager
+                      decodes only its own (reqKind, powerGranted, client)
+    GridPower : (time, {'microgridMode', 'gridPowerMode', 'gridPower', 'weightBuilding', 'weightEv'})
+    ChargerAns : [{'stationID', 'portNumber', 'sessionID', 'stationTime', quantity: value}]
+    BuildingAns : [{'Date', quantity: value}]
+    BESSAns : {'Date', 'attr': {attribute: value}}
+    LogData : list of series, see LogData.py
+A quantity that is not a number (e.g. 'NA' for an unknown one) is sent as NaN. In delta
+mode reqPower and powerGranted are the HorizonFrame of the horizon (see HorizonDelta.py),
+rebuilt by the receiver.
+
+Run python Messages.py from the application folder to compare the size and the encode
+and decode time of the messages with pickle.
+'''
+import sys
+import math
+import bisect
+from array import array
+import capnp
+import remapp_capnp
+from HorizonDelta import HorizonFrame
+
+SESSION_KEYS = ('stationID', 'portNumber', 'sessionID', 'stationTime')
+KINDS = {'BU': 'bu', 'EV': 'ev', 'BESS': 'bess'}
+KIND_NAMES = {kind: name for name, kind in KINDS.items()}
+BYTESWAP = sys.byteorder != 'little'
+SEPARATOR = '\x1f'
+
+
+def number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def packed(typecode, values):
+    '''
+    Little-endian bytes of numbers
+    :param typecode: array type code of the numbers: 'd' float64, 'H' uint16, 'I' uint32
+    :type typecode: str
+    :rtype: bytes
+    '''
+    data = array(typecode, values)
+    if BYTESWAP:
+        data.byteswap()
+    return data.tobytes()
+
+
+def unpacked(typecode, data):
+    '''
+    Numbers of little-endian bytes
+    :rtype: list
+    '''
+    values = array(typecode, data)
+    if BYTESWAP:
+        values.byteswap()
+    return values.tolist()
+
+
+def joined(strings):
+    '''
+    Text of the strings of a Table or LogData
+    :type strings: dict
+    '''
+    text = SEPARATOR.join(strings)
+    if text.count(SEPARATOR) != max(0, len(strings) - 1):
+        raise ValueError('a string of the message holds the separator 0x1f')
+    return text
+
+
+def setQuantities(msg, field, quantities):
+    '''
+    Fill Quantities from a dict
+    '''
+    item = msg.init(field)
+    item.names = [str(name) for name in quantities]
+    item.values = packed('d', [number(value) for value in quantities.values()])
+
+
+def quantitiesOf(item):
+    return dict(zip(item.names, unpacked('d', item.values)))
+
+
+def setTable(msg, field, rows, labels):
+    '''
+    Fill a Table from a list of dicts
+    :param labels: keys of the text values, the other keys are quantities
+    :type labels: tuple
+    '''
+    keys = {}
+    for row in rows:
+        for key in row:
+            keys.setdefault(key, None)
+    text = [key for key in keys if key in labels]
+    columns = [key for key in keys if key not in labels]
+    strings = {}
+    table = msg.init(field)
+    table.labels = len(text)
+    table.columns = len(columns)
+    table.text = packed('H', [strings.setdefault(str(key), len(strings)) for key in text + columns] +
+                        [strings.setdefault(str(row.get(key, '')), len(strings)) for row in rows for key in text])
+    table.strings = joined(strings)
+    table.values = packed('d', [number(row.get(key)) for row in rows for key in columns])
+    if any(len(row) != len(keys) for row in rows):
+        table.missing = bytes(int(key not in row) for row in rows for key in text + columns)
+
+
+def tableOf(table):
+    '''
+    Rows of a Table
+    :rtype: list
+    '''
+    strings = table.strings.split(SEPARATOR)
+    nl = table.labels
+    nc = table.columns
+    text = [strings[i] for i in unpacked('H', table.text)]
+    keys = text[:nl + nc]
+    text = text[nl + nc:]
+    values = unpacked('d', table.values)
+    n = len(values) // nc if nc > 0 else len(text) // max(1, nl)
+    rows = [dict(zip(keys, text[i * nl:(i + 1) * nl] + values[i * nc:(i + 1) * nc])) for i in range(n)]
+    missing = table.missing
+    if len(missing) > 0:
+        width = len(keys)
+        for i, row in enumerate(rows):
+            for j in range(width):
+                if missing[i * width + j]:
+                    del row[keys[j]]
+    return rows
+
+
+def setHorizon(msg, field, frame):
+    '''
+    Fill a Horizon from a frame
+    '''
+    horizon = msg.init(field)
+    horizon.seq = frame.seq
+    if frame.base is None:
+        horizon.values = packed('d', frame.values)
+        return
+    delta = horizon.init('delta')
+    delta.base = frame.base
+    delta.shift = frame.shift
+    delta.length = frame.length
+    delta.resolution = frame.resolution
+    delta.indices = frame.indices
+    delta.quanta = frame.values
+
+
+def horizonOf(horizon):
+    if horizon.which() == 'values':
+        values = unpacked('d', horizon.values)
+        return HorizonFrame(horizon.seq, None, 0, len(values), 0.0, [], values)
+    delta = horizon.delta
+    return HorizonFrame(horizon.seq, delta.base, delta.shift, delta.length, delta.resolution,
+                        list(delta.indices), list(delta.quanta))
+
+
+def powerRequest(reqID, reqKind, reqTime, reqPower, currPower):
+    '''
+    :param reqPower: predicted power over the horizon, its frame, or the attributes of a battery
+    :type reqPower: list, HorizonFrame or dict
+    :rtype: bytes
+    '''
+    msg = remapp_capnp.PowerRequest.new_message(reqID=str(reqID), reqKind=KINDS[reqKind], reqTime=str(reqTime),
+                                                currPower=number(currPower))
+    if isinstance(reqPower, dict):
+        setQuantities(msg, 'attributes', reqPower)
+    elif isinstance(reqPower, HorizonFrame):
+        setHorizon(msg, 'horizon', reqPower)
+    else:
+        msg.reqPower = packed('d', reqPower)
+    return msg.to_bytes_packed()
+
+
+def powerRequestOf(data):
+    msg = remapp_capnp.PowerRequest.from_bytes_packed(data)
+    which = msg.which()
+    if which == 'attributes':
+        reqPower = quantitiesOf(msg.attributes)
+    elif which == 'horizon':
+        reqPower = horizonOf(msg.horizon)
+    else:
+        reqPower = unpacked('d', msg.reqPower)
+    return (msg.reqID, KIND_NAMES[msg.reqKind], msg.reqTime, reqPower, msg.currPower)
+
+
+def powerDispatched(dspMap):
+    '''
+    One message with the dispatch of every client, indexed by client
+    :param dspMap: {client: (reqKind, powerGranted)}, powerGranted is the dispatched power
+                   over the horizon or its frame
+    :type dspMap: dict
+    :rtype: bytes
+    '''
+    clients = sorted(str(client) for client in dspMap)
+    msg = remapp_capnp.PowerDispatched.new_message(clients=clients)
+    items = msg.init('dispatches', len(clients))
+    byName = {str(client): values for client, values in dspMap.items()}
+    for item, client in zip(items, clients):
+        reqKind, powerGranted = byName[client]
+        item.reqKind = KINDS[reqKind]
+        if isinstance(powerGranted, HorizonFrame):
+            setHorizon(item, 'horizon', powerGranted)
+        else:
+            item.powerGranted = packed('d', powerGranted)
+    return msg.to_bytes_packed()
+
+
+def powerDispatchedOf(data, client):
+    '''
+    Dispatch of a client, the entries of the other clients are not read
+    :return: (reqKind, powerGranted, client), None if the message has no dispatch for client
+    :rtype: tuple
+    '''
+    msg = remapp_capnp.PowerDispatched.from_bytes_packed(data)
+    clients = msg.clients
+    i = bisect.bisect_left(clients, client)
+    if i == len(clients) or clients[i] != client:
+        return None
+    item = msg.dispatches[i]
+    powerGranted = horizonOf(item.horizon) if item._has('horizon') else unpacked('d', item.powerGranted)
+    return (KIND_NAMES[item.reqKind], powerGranted, client)
+
+
+def gridPower(time, val):
+    msg = remapp_capnp.GridPower.new_message(time=float(time), microgridMode=int(val['microgridMode']),
+                                             gridPowerMode=int(val['gridPowerMode']), gridPower=number(val['gridPower']),
+                                             weightBuilding=number(val['weightBuilding']), weightEv=number(val['weightEv']))
+    return msg.to_bytes_packed()
+
+
+def gridPowerOf(data):
+    msg = remapp_capnp.GridPower.from_bytes_packed(data)
+    return (msg.time, {'microgridMode': msg.microgridMode, 'gridPowerMode': msg.gridPowerMode,
+                       'gridPower': msg.gridPower, 'weightBuilding': msg.weightBuilding,
+                       'weightEv': msg.weightEv})
+
+
+def chargerAns(sessions):
+    msg = remapp_capnp.ChargerAns.new_message()
+    setTable(msg, 'sessions', sessions, SESSION_KEYS)
+    return msg.to_bytes_packed()
+
+
+def chargerAnsOf(data):
+    return tableOf(remapp_capnp.ChargerAns.from_bytes_packed(data).sessions)
+
+
+def buildingAns(rows):
+    msg = remapp_capnp.BuildingAns.new_message()
+    setTable(msg, 'rows', rows, ('Date',))
+    return msg.to_bytes_packed()
+
+
+def buildingAnsOf(data):
+    return tableOf(remapp_capnp.BuildingAns.from_bytes_packed(data).rows)
+
+
+def bessAns(ans):
+    msg = remapp_capnp.BESSAns.new_message(date=str(ans['Date']))
+    setQuantities(msg, 'attributes', ans['attr'])
+    return msg.to_bytes_packed()
+
+
+def bessAnsOf(data):
+    msg = remapp_capnp.BESSAns.from_bytes_packed(data)
+    return {'Date': msg.date, 'attr': quantitiesOf(msg.attributes)}
+
+
+def logData(datastream):
+    '''
+    :param datastream: list of series, see LogData.series
+    :rtype: bytes
+    '''
+    strings = {}
+    keys = []
+    lengths = []
+    times = []
+    for tags, measurement, field, start, step, values in datastream:
+        keys += [strings.setdefault(str(measurement), len(strings)), strings.setdefault(str(field), len(strings))]
+        for name, value in tags.items():
+            keys += [strings.setdefault(str(name), len(strings)), strings.setdefault(str(value), len(strings))]
+        lengths += [len(values) // 8, len(tags)]
+        times += [start, step]
+    msg = remapp_capnp.LogData.new_message(strings=joined(strings), keys=packed('H', keys), lengths=packed('I', lengths),
+                                           times=packed('d', times), values=b''.join(series[5] for series in datastream))
+    return msg.to_bytes_packed()
+
+
+def logDataOf(data):
+    msg = remapp_capnp.LogData.from_bytes_packed(data)
+    strings = msg.strings.split(SEPARATOR)
+    words = [strings[i] for i in unpacked('H', msg.keys)]
+    lengths = unpacked('I', msg.lengths)
+    times = unpacked('d', msg.times)
+    values = msg.values
+    datastream = []
+    k = 0
+    offset = 0
+    for i in range(0, len(lengths), 2):
+        end = offset + 8 * lengths[i]
+        tags = k + 2 + 2 * lengths[i + 1]
+        datastream.append((dict(zip(words[k + 2:tags:2], words[k + 3:tags:2])), words[k], words[k + 1],
+                           times[i], times[i + 1], values[offset:end]))
+        k = tags
+        offset = end
+    return datastream
+
+
+if __name__ == '__main__':
+    import timeit
+    import pickle
+    from LogData import series
+
+    horizon = [700.0 + 0.25 * i for i in range(24)]
+    attr = {'Rbess': 100, 'Cbattery': 400, 'SoCl': 0.2, 'SoCu': 0.9, 'SoCend': 0.5, 'SoC': 0.6}
+    val = {'microgridMode': 0, 'gridPowerMode': 1, 'gridPower': 1000, 'weightBuilding': 1, 'weightEv': 1}
+    sessions = [{'stationID': '1:%d' % i, 'portNumber': '1', 'sessionID': str(1000 + i), 'stationTime': '2019-08-16 00:00:00',
+                 'energyConsumed': 2.5, 'peakPower': 6.6, 'rollingPowerAvg': 6.1} for i in range(10)]
+    rows = [{'Date': '2019-08-16 00:00:00', 'HT_TotalPower': 812.5, 'OutsideAirTemp': 72.0,
+             'HT_HTG_M10:RTU3_HVACPower': 12.5, 'HT_HTE_AvgTemp1': 71.0}]
+    datastream = [series({'type': 'BU', 'ID': 'BU%d' % i}, 'Predicted Power', 'power', 1565913600, 3600, horizon) for i in range(9)]
+    datastream += [series({'type': 'BU', 'ID': 'BU%d' % i}, 'Actual Power', 'power', 1565913600, 3600, [5.0]) for i in range(9)]
+    messages = [('PowerRequest', ('BU1', 'BU', '2019-08-16 00:00:00', horizon, 812.5), powerRequest, powerRequestOf),
+                ('PowerRequest BESS', ('BESS1', 'BESS', '2019-08-16 00:00:00', attr, 0.0), powerRequest, powerRequestOf),
+                ('PowerDispatched', ({'BU1': ('BU', horizon)},), powerDispatched, lambda data: powerDispatchedOf(data, 'BU1')),
+                ('GridPower', (1565913600.0, val), gridPower, gridPowerOf),
+                ('ChargerAns', (sessions,), chargerAns, chargerAnsOf),
+                ('BuildingAns', (rows,), buildingAns, buildingAnsOf),
+                ('BESSAns', ({'Date': '2019-08-16 00:00:00', 'attr': attr},), bessAns, bessAnsOf),
+                ('LogData', (datastream,), logData, logDataOf)]
+    print('%-18s %8s %8s %10s %10s %10s %10s' % ('message', 'pickle', 'capnp', 'pickle enc', 'capnp enc', 'pickle dec', 'capnp dec'))
+    for name, args, encode, decode in messages:
+        obj = args if len(args) > 1 else args[0]
+        pickled = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        data = encode(*args)
+        n = 2000
+        times = [1e6 * min(timeit.repeat(f, number=n, repeat=5)) / n for f in (lambda: pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL),
+                                                                 lambda: encode(*args),
+                                                                 lambda: pickle.loads(pickled),
+                                                                 lambda: decode(data))]
+        print('%-18s %7dB %7dB %8.1fus %8.1fus %8.1fus %8.1fus' % ((name, len(pickled), len(data)) + tuple(times)))
+
+    # fan-out of the dispatch of a round to n managers: one message per client, decoded
+    # by every manager, against one message with every client, where a manager reads its own
+    def everyDispatchOf(data):
+        msg = remapp_capnp.PowerDispatched.from_bytes_packed(data)
+        return [(KIND_NAMES[item.reqKind], unpacked('d', item.powerGranted)) for item in msg.dispatches]
+
+    print('%-18s %10s %10s %12s %12s' % ('clients', 'messages', 'deliveries', 'bytes/mgr', 'decode/round'))
+    for n in (10, 100, 1000):
+        dspMap = {'BU%d' % i: ('BU', horizon) for i in range(n)}
+        single = [powerDispatched({client: values}) for client, values in dspMap.items()]
+        t = timeit.timeit(lambda: [everyDispatchOf(data) for data in single], number=3) / 3
+        print('%-18s %10d %10d %11dB %10.1fms' % ('%d one per client' % n, n, n * n, sum(len(data) for data in single), 1e3 * t * n))
+        frame = powerDispatched(dspMap)
+        t = timeit.timeit(lambda: [powerDispatchedOf(frame, client) for client in dspMap], number=3) / 3
+        print('%-18s %10d %10d %11dB %10.1fms' % ('%d indexed frame' % n, 1, n, len(frame), 1e3 * t))
@@ -0,0 +1,131 @@
+'''
+Power request aggregation for the Coordinator component
+
+The Coordinator collects one power request per manager in every dispatch round.
+The set of managers is discovered from the requests themselves and kept by type
+and ID. A round is ready to be dispatched once a quorum of the managers known from
+the previous rounds has reported; the Coordinator dispatches whatever has arrived
+when the deadline of the round passes. Managers that miss more than expiry rounds
+are forgotten. The sums of the predicted and current power of each type are kept
+up to date as requests arrive. A round is taken out of the aggregator when its
+dispatch starts, so requests arriving while it is solved go to the next round.
+'''
+import numpy as np
+
+
+class RequestAggregator():
+    '''
+    Requests of the current dispatch round
+    reqMap : {client: (reqKind, reqPower, reqTime, currPower)}
+    clients : {reqKind: {client: last closed round the client reported in}}
+    predSum : {reqKind: sum of the predicted power over the horizon}, BESS excluded
+    currSum : {reqKind: sum of the current power}
+    '''
+    def __init__(self, horizon=24, quorum=1.0, deadline=60.0, expiry=3):
+        '''
+        :param horizon: number of future time steps
+        :type horizon: int
+        :param quorum: fraction of the known managers needed to start a dispatch
+        :type quorum: float
+        :param deadline: seconds after the first request of a round to dispatch anyway
+        :type deadline: float
+        :param expiry: number of missed rounds after which a manager is forgotten
+        :type expiry: int
+        '''
+        self.horizon = horizon
+        self.quorum = quorum
+        self.deadline = deadline
+        self.expiry = expiry
+        self.reqMap = {}
+        self.clients = {}
+        self.predSum = {}
+        self.currSum = {}
+        self.round = 0
+
+    def add(self, client, reqKind, reqPower, reqTime, currPower):
+        '''
+        Add a request to the current round, replacing an earlier one from the same client.
+        :return: True if this is the first request of the round
+        :rtype: bool
+        '''
+        first = len(self.reqMap) == 0
+        if client in self.reqMap:
+            self.discount(client)
+        self.reqMap[client] = (reqKind, reqPower, reqTime, currPower)
+        if reqKind != 'BESS':
+            if reqKind not in self.predSum:
+                self.predSum[reqKind] = np.zeros(self.horizon)
+            self.predSum[reqKind] += self.horizonOf(reqPower)
+        self.currSum[reqKind] = self.currSum.get(reqKind, 0.0) + float(currPower)
+        return first
+
+    def discount(self, client):
+        '''
+        Remove the contribution of the current request of client from the sums
+        '''
+        reqKind, reqPower, reqTime, currPower = self.reqMap[client]
+        if reqKind != 'BESS':
+            self.predSum[reqKind] -= self.horizonOf(reqPower)
+        self.currSum[reqKind] -= float(currPower)
+
+    def horizonOf(self, reqPower):
+        values = np.zeros(self.horizon)
+        reqPower = np.asarray(reqPower, dtype=float)[:self.horizon]
+        values[:len(reqPower)] = reqPower
+        return values
+
+    def known(self):
+        '''
+        Managers expected in this round, the ones that reported in the previous rounds
+        '''
+        return [client for members in self.clients.values() for client in members]
+
+    def ready(self):
+        '''
+        True once the quorum of the known managers has reported. Managers discovered
+        in this round are dispatched but only count in the quorum from the next round.
+        '''
+        known = self.known()
+        reported = sum(1 for client in known if client in self.reqMap)
+        return len(known) > 0 and reported >= self.quorum * len(known)
+
+    def loadSum(self):
+        '''
+        Total predicted power of the loads (all types except BESS) over the horizon
+        '''
+        total = np.zeros(self.horizon)
+        for values in self.predSum.values():
+            total += values
+        return total
+
+    def clear(self):
+        '''
+        Close the round: record the managers that reported, forget the ones that
+        missed more than expiry rounds and reset the requests and sums.
+        '''
+        for client, request in self.reqMap.items():
+            for kind, members in self.clients.items():
+                members.pop(client, None)
+            self.clients.setdefault(request[0], {})[client] = self.round
+        self.round += 1
+        for kind in self.clients:
+            self.clients[kind] = {client: seen for client, seen in self.clients[kind].items()
+                                  if self.round - 1 - seen <= self.expiry}
+        self.reqMap.clear()
+        self.predSum = {}
+        self.currSum = {}
+
+    def take(self):
+        '''
+        Close the round and return its requests, the requests received from now on
+        belong to the next round.
+        :return: the requests and sums of the closed round
+        :rtype: RequestAggregator
+        '''
+        taken = RequestAggregator(self.horizon, self.quorum, self.deadline, self.expiry)
+        taken.reqMap = dict(self.reqMap)
+        taken.predSum = self.predSum
+        taken.currSum = self.currSum
+        taken.round = self.round
+        self.clear()
+        return taken
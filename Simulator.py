@@ -0,0 +1,407 @@
+'''
+Headless fast-forward simulation of the REMApp pipeline
+
+The playback devices (BuildingInterfaceThread, ChargerInterfaceThread and the BESS
+model), the predictors and the dispatch of the Coordinator are run in one process on
+a virtual clock, as fast as the models and the dispatch engine allow. A round is one
+time step of the Coordinator (an hour of data):
+    - every site polls its device as its manager does, once per Ts of the device,
+    - the predictions of the round are run in one batch per model,
+    - the requests are dispatched at once, without the timers, the votes and the
+      deadline of the deployment,
+    - the batteries apply the first step of their dispatch.
+The Coordinator sends the same datastreams as Coordinator.log, to a sink in place of
+its logData port. The dispatch cache lives on the virtual clock, so its entries expire
+after the same number of rounds as in the deployment.
+
+The sites of a simulation are given in a yaml file (see config/sim_config.yaml).
+Run it from the application folder:
+    python Simulator.py [config] [hours]
+'''
+import sys
+import time
+import pickle
+import logging
+from datetime import datetime, timedelta
+import yaml
+import numpy as np
+from Coordinator import Coordinator
+from Messages import logDataOf
+from BESS import BESS
+from BuildingInterface import BuildingInterfaceThread
+from ChargerInterface import ChargerInterfaceThread
+from BuildingPredictive import buildingPredictor
+from ChargerPredictive import chargerPredictor
+
+BESS_ATTRS = ['Rbess', 'Cbattery', 'SoCl', 'SoCu', 'SoCend', 'SoC']
+
+
+def pollsPerRound(Ts, step):
+    '''
+    Number of device polls in a round
+    :param Ts: sample time of the device in minutes
+    :param step: length of the round
+    :type step: timedelta
+    '''
+    return max(1, int(round(step / timedelta(minutes=Ts))))
+
+
+class VirtualClock():
+    '''
+    Simulated time: it only moves when a round is over
+    '''
+    def __init__(self, start, step):
+        '''
+        :param start: start of the simulation 'YYYY-MM-DD HH:mm:ss'
+        :type start: str
+        :param step: length of a round
+        :type step: timedelta
+        '''
+        self.fmt = '%Y-%m-%d %H:%M:%S'
+        self.now = datetime.strptime(start, self.fmt)
+        self.step = step
+        self.rounds = 0
+
+    def time(self):
+        '''
+        Seconds since the epoch, in place of time.time()
+        '''
+        return self.now.timestamp()
+
+    def advance(self):
+        self.now += self.step
+        self.rounds += 1
+
+
+class LogSink():
+    '''
+    Datastreams of the Coordinator, in place of its logData port
+    datastreams : list of the datastreams sent, see Coordinator.log
+    '''
+    def __init__(self, callback=None):
+        '''
+        :param callback: called with every datastream, None to keep them in datastreams
+        '''
+        self.callback = callback
+        self.datastreams = []
+
+    def send_capnp(self, data):
+        datastream = logDataOf(data)
+        if self.callback is not None:
+            self.callback(datastream)
+        else:
+            self.datastreams.append(datastream)
+
+
+class SimulatedCoordinator(Coordinator):
+    '''
+    Dispatch of the Coordinator without its ports, timers and groups
+    '''
+    def __init__(self, table_config, clock, sink, logger):
+        '''
+        :param table_config: contents of the coordinator configuration file
+        :type table_config: dict
+        :param clock: the virtual clock
+        :type clock: VirtualClock
+        :param sink: receives the datastreams of log
+        :type sink: LogSink
+        :param logger: logger of the simulation
+        '''
+        self.logger = logger
+        self.configure(table_config)
+        self.cache.clock = clock.time
+        self.logData = sink
+        self.ID = 'SIM'
+        self.groups = {}
+
+    def dispatch(self):
+        '''
+        Purchase power for the end of the horizon and dispatch the requests of the round
+        :return: the dispatched power {client: (reqKind, list of power values)}
+        :rtype: dict
+        '''
+        self.roundRequests = self.requests.take()
+        self.purchasedPower.append(float(self.roundRequests.loadSum()[-1]))
+        self.purchasedPower.pop(0)
+        problem = self.roundProblem()
+        if not self.cachedDispatch(problem):
+            self.predictiveDispatchQP(problem)
+        return self.dspMap
+
+
+class SimulatedBESS(BESS):
+    '''
+    The BESS model without its ports
+    '''
+    def __init__(self, Rbess, Cbattery, SoCl, SoCu, SoC0, SoCend, tStart, Ts, logger):
+        self.logger = logger
+        self.fmt = '%Y-%m-%d %H:%M:%S'
+        self.Rbess, self.Cbattery, self.SoCl, self.SoCu, self.SoC, self.SoCend = Rbess, Cbattery, SoCl, SoCu, SoC0, SoCend
+        self.currTime = tStart
+        self.Ts = Ts
+        self.step = 0
+
+    def query(self, qty):
+        '''
+        Answer of a request, see BESS.on_request
+        '''
+        qryMap = {}
+        for item in qty:
+            try: qryMap[item] = getattr(self, item)
+            except:
+                self.logger.error("attribute %s not found" % item)
+                qryMap[item] = 'NA'
+        self.updateTime()
+        return {'Date': self.currTime, 'attr': qryMap}
+
+
+class SimulatedBuilding():
+    '''
+    A building site: BuildingManager polling a BuildingInterfaceThread
+    '''
+    kind = 'BU'
+
+    def __init__(self, ID, configfile, predictor, step, logger):
+        self.ID = ID
+        self.predictor = predictor
+        self.device = BuildingInterfaceThread(configfile, None, logger)
+        self.polls = pollsPerRound(self.device.Ts, step)
+        self.msgTime = None
+        self.currentPower = 0
+
+    def poll(self):
+        '''
+        Poll the device for a round
+        :return: the messages for the predictor, the last one is the request of the round
+        :rtype: list
+        '''
+        msgs = []
+        for i in range(self.polls):
+            msg = self.device.handleQry(['TotalPower', 'HVAC', 'Temp'])[1]
+            self.msgTime = msg[0]['Date']
+            self.currentPower = msg[0].get('HT_TotalPower', 0)
+            msgs.append(msg[0])
+        return msgs
+
+    def request(self, prediction):
+        return (self.ID, self.kind, self.msgTime, prediction, self.currentPower)
+
+
+class SimulatedCharger():
+    '''
+    A charger site: ChargerManager polling a ChargerInterfaceThread in playback
+    '''
+    kind = 'EV'
+
+    def __init__(self, ID, configfile, predictor, step, logger):
+        self.ID = ID
+        self.predictor = predictor
+        self.device = ChargerInterfaceThread(configfile, None, logger)
+        if self.device.mode == 'realtime':
+            raise ValueError('%s: the realtime mode of %s can not be simulated' % (ID, configfile))
+        self.polls = pollsPerRound(self.device.Ts, step)
+        self.msgTime = None
+        self.aggregatedPower = 0
+
+    def poll(self):
+        '''
+        Poll the device for a round. Only the data on the hour is predicted.
+        :return: the messages for the predictor, the last one is the request of the round
+        :rtype: list
+        '''
+        msgs = []
+        for i in range(self.polls):
+            sessions = self.device.handleQry(['all'])[1]
+            # a poll without sessions has no time stamp, the manager skips it
+            if len(sessions) == 0:
+                continue
+            self.aggregatedPower = 0
+            for chargingSession in sessions:
+                self.aggregatedPower += chargingSession['rollingPowerAvg']
+            self.msgTime = sessions[0]['stationTime']
+            date = self.msgTime
+            if date[14:16] == '00' and date[17:19] == '00':
+                msgs.append({'Date': date, 'aggregatedPower': self.aggregatedPower})
+        return msgs
+
+    def request(self, prediction):
+        return (self.ID, self.kind, self.msgTime, prediction, self.aggregatedPower)
+
+
+class SimulatedBattery():
+    '''
+    A battery site: BESSManager polling the BESS model
+    '''
+    kind = 'BESS'
+    predictor = None
+
+    def __init__(self, ID, Rbess, Cbattery, SoCl, SoCu, SoC0, SoCend, tStart, step, logger, Ts=60):
+        self.ID = ID
+        self.device = SimulatedBESS(Rbess, Cbattery, SoCl, SoCu, SoC0, SoCend, tStart, Ts, logger)
+        self.polls = pollsPerRound(Ts, step)
+        self.msgTime = None
+        self.attrMap = {}
+        self.currentPower = 0
+
+    def poll(self):
+        for i in range(self.polls):
+            msg = self.device.query(BESS_ATTRS)
+        self.msgTime = msg['Date']
+        self.attrMap = msg['attr']
+        return []
+
+    def request(self, prediction=None):
+        return (self.ID, self.kind, self.msgTime, self.attrMap, self.currentPower)
+
+    def actuate(self, powerGranted):
+        '''
+        Apply the first step of the dispatch, see BESSManager.on_dspPower
+        '''
+        self.currentPower = powerGranted[0]
+        self.device.updateSoC(powerGranted[0])
+
+
+class Simulator():
+    '''
+    The pipeline of a set of sites on a virtual clock
+    sites : the simulated sites, in the order of the configuration
+    predictors : {(kind, model_path): predictor} shared by the sites of a model
+    '''
+    def __init__(self, sim_config, sink=None, logger=None, predictors=None):
+        '''
+        :param sim_config: contents of the simulation configuration file
+        :type sim_config: dict
+        :param sink: receives the datastreams of the Coordinator, a LogSink if None
+        :param logger: logger of the simulation
+        :param predictors: predictors of an earlier simulation to reuse, their input windows are cleared
+        :type predictors: dict
+        '''
+        self.logger = logger if logger is not None else logging.getLogger('Simulator')
+        self.sink = sink if sink is not None else LogSink()
+        try:
+            self.models = bool(sim_config['models'])
+        except KeyError:
+            self.models = True
+        try:
+            self.inference = sim_config['inference']
+        except KeyError:
+            self.inference = 'numpy'
+        with open('config/' + sim_config['coordinator'], 'r') as stream:
+            table_config = yaml.safe_load(stream)
+        tStart = sim_config['tStart']
+        self.clock = VirtualClock(tStart, timedelta(hours=1))
+        self.coordinator = SimulatedCoordinator(table_config, self.clock, self.sink, self.logger)
+        # a round is a time step of the Coordinator
+        self.clock.step = timedelta(seconds=self.coordinator.Ts)
+        self.predictors = predictors if predictors is not None else {}
+        for predictor in self.predictors.values():
+            predictor.sites = {}
+            predictor.features = predictor.featuresOf(None)
+        self.sites = []
+        for site in sim_config['sites']:
+            kind = site['kind']
+            if kind == 'BU':
+                predictor = self.predictorOf(kind, site['model_path'])
+                self.sites.append(SimulatedBuilding(site['id'], site['configfile'], predictor, self.clock.step, self.logger))
+            elif kind == 'EV':
+                predictor = self.predictorOf(kind, site['model_path'])
+                self.sites.append(SimulatedCharger(site['id'], site['configfile'], predictor, self.clock.step, self.logger))
+            elif kind == 'BESS':
+                self.sites.append(SimulatedBattery(site['id'], site['Rbess'], site['Cbattery'], site['SoCl'], site['SoCu'],
+                                                   site['SoC0'], site['SoCend'], site.get('tStart', tStart),
+                                                   self.clock.step, self.logger, site.get('Ts', 60)))
+            else:
+                raise ValueError('unknown kind of site %s' % str(kind))
+        self.solveTime = 0
+        self.dispatchTime = 0
+
+    def predictorOf(self, kind, model_path):
+        '''
+        Predictor of a model, shared by the sites that use it like a prediction server
+        '''
+        if (kind, model_path) not in self.predictors:
+            model = buildingPredictor if kind == 'BU' else chargerPredictor
+            self.predictors[(kind, model_path)] = model(self.logger, model_path, self.inference, load=self.models)
+        return self.predictors[(kind, model_path)]
+
+    def step(self):
+        '''
+        Run a round
+        :return: the dispatched power of the round {client: (reqKind, list of power values)}
+        :rtype: dict
+        '''
+        requests = []
+        batches = {}
+        self.dispatchTime = 0
+        for site in self.sites:
+            msgs = site.poll()
+            if site.predictor is None:
+                requests.append(site.request())
+            elif len(msgs) > 0:
+                # the polls before the last one only move the input windows of the site
+                for msg in msgs[:-1]:
+                    site.predictor.UpdateInput(msg, site.ID)
+                batches.setdefault(id(site.predictor), (site.predictor, []))[1].append((site, msgs[-1]))
+        for predictor, batch in batches.values():
+            predictions = predictor.runBatch([(site.ID, msg) for site, msg in batch])
+            for (site, msg), prediction in zip(batch, predictions):
+                prediction = np.clip(np.squeeze(prediction), a_min=0, a_max=None)
+                requests.append(site.request(prediction.tolist()))
+        dspMap = {}
+        if len(requests) > 0:
+            for (reqID, reqKind, reqTime, reqPower, currPower) in requests:
+                self.coordinator.requests.add(reqID[:-1], reqKind, reqPower, reqTime, currPower)
+            t0 = time.perf_counter()
+            dspMap = self.coordinator.dispatch()
+            self.dispatchTime = time.perf_counter() - t0
+            self.solveTime += self.dispatchTime
+            for site in self.sites:
+                if site.kind == 'BESS' and site.ID[:-1] in dspMap:
+                    site.actuate(dspMap[site.ID[:-1]][1])
+        self.clock.advance()
+        return dspMap
+
+    def run(self, rounds):
+        '''
+        Run a number of rounds
+        :return: the datastreams kept by the sink
+        :rtype: list
+        '''
+        for i in range(rounds):
+            self.step()
+        return self.sink.datastreams
+
+    def close(self):
+        for predictor in self.predictors.values():
+            predictor.close()
+
+
+if __name__ == '__main__':
+    configfile = sys.argv[1] if len(sys.argv) > 1 else 'sim_config.yaml'
+    with open('config/' + configfile, 'r') as stream:
+        sim_config = yaml.safe_load(stream)
+    try:
+        hours = int(sys.argv[2]) if len(sys.argv) > 2 else int(sim_config['hours'])
+    except KeyError:
+        hours = 24
+    logging.basicConfig(level=logging.WARNING)
+    t0 = time.time()
+    sim = Simulator(sim_config)
+    t1 = time.time()
+    datastreams = sim.run(hours)
+    t2 = time.time()
+    print('%d rounds (%s to %s) in %.2f s after %.2f s of setup, %.1f ms per round, dispatch %.1f ms per round'
+          % (sim.clock.rounds, sim_config['tStart'], sim.clock.now, t2 - t1, t1 - t0,
+             1e3 * (t2 - t1) / max(1, sim.clock.rounds), 1e3 * sim.solveTime / max(1, sim.clock.rounds)))
+    for site in sim.sites:
+        if site.kind == 'BESS':
+            print('%s final SoC %.4f' % (site.ID, site.device.SoC))
+    try:
+        output = sim_config['output']
+    except KeyError:
+        output = None
+    if output is not None:
+        with open(output, 'wb') as f:
+            pickle.dump(datastreams, f)
+        print('%d datastreams written to %s' % (len(datastreams), output))
+    sim.close()
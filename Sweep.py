@@ -0,0 +1,192 @@
+'''
+Parallel scenario sweep of the dispatch
+
+A sweep runs the fast-forward simulation (Simulator.py) once for every combination of
+the parameter values of its grid. The scenarios are independent, so they are spread
+over a pool of processes, one per core by default. The parameters are
+    - grid settings of the Coordinator: microgridMode, gridPowerMode, gridPower,
+      weightBuilding, weightEv
+    - parameters of every battery site: Rbess, Cbattery, SoCl, SoCu, SoC0, SoCend
+The metrics of each scenario are taken from the Coordinator after every round:
+    unservedEnergy : energy requested by the loads in the first time step and not dispatched (kWh)
+    peakGridPower : largest total dispatch of a first time step (kW)
+    socViolations : rounds that end with a battery outside [SoCl, SoCu]
+    socMin, socMax : range of the battery SoC
+    solveTimeMean, solveTimeMax : dispatch time of a round (ms)
+The results are saved as one array per column (parameters, then metrics) in a .npz file.
+
+Run it from the application folder:
+    python Sweep.py [config] [workers]
+'''
+import os
+import sys
+import time
+import itertools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+import numpy as np
+
+COORDINATOR_PARAMS = ('microgridMode', 'gridPowerMode', 'gridPower', 'weightBuilding', 'weightEv')
+BESS_PARAMS = ('Rbess', 'Cbattery', 'SoCl', 'SoCu', 'SoC0', 'SoCend')
+METRICS = ('rounds', 'unservedEnergy', 'peakGridPower', 'socViolations', 'socMin', 'socMax',
+           'solveTimeMean', 'solveTimeMax', 'wallTime')
+
+# predictors kept by a worker process between its scenarios
+_predictors = {}
+
+
+def scenarios(grid):
+    '''
+    Every combination of the values of the grid
+    :param grid: {parameter: list of values}
+    :type grid: dict
+    :return: list of {parameter: value}
+    :rtype: list
+    '''
+    names = list(grid)
+    for name in names:
+        if name not in COORDINATOR_PARAMS and name not in BESS_PARAMS:
+            raise ValueError('unknown sweep parameter %s' % name)
+    values = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def scenarioConfig(sim_config, params):
+    '''
+    Simulation configuration of a scenario: the battery parameters replace those of every battery site
+    '''
+    config = dict(sim_config)
+    config['sites'] = []
+    for site in sim_config['sites']:
+        site = dict(site)
+        if site['kind'] == 'BESS':
+            for name in BESS_PARAMS:
+                if name in params:
+                    site[name] = params[name]
+        config['sites'].append(site)
+    return config
+
+
+def runScenario(sim_config, params, hours):
+    '''
+    Simulate a scenario
+    :return: the metrics of the scenario and None, or None and the error
+    :rtype: (dict, str)
+    '''
+    from Simulator import Simulator
+    t0 = time.time()
+    try:
+        sim = Simulator(scenarioConfig(sim_config, params), predictors=_predictors)
+        coordinator = sim.coordinator
+        for name in COORDINATOR_PARAMS:
+            if name in params:
+                setattr(coordinator, name, params[name])
+        batteries = [site for site in sim.sites if site.kind == 'BESS']
+        Th = coordinator.Ts / 3600
+        unserved, peak, violations, solveTimes = 0.0, 0.0, 0, []
+        socs = [site.device.SoC for site in batteries]
+        for i in range(hours):
+            dspMap = sim.step()
+            if len(dspMap) == 0:
+                continue
+            solveTimes.append(sim.dispatchTime)
+            for pred, disp in ((coordinator.Pred_building, coordinator.Disp_building), (coordinator.Pred_ev, coordinator.Disp_ev)):
+                if len(disp) > 0:
+                    unserved += max(0.0, float(pred[0]) - float(disp[0])) * Th
+            peak = max(peak, float(coordinator.totalDispatch[0]))
+            for site in batteries:
+                bess = site.device
+                socs.append(bess.SoC)
+                if bess.SoC < bess.SoCl - 1e-6 or bess.SoC > bess.SoCu + 1e-6:
+                    violations += 1
+    except Exception as e:
+        return None, '%s: %s' % (type(e).__name__, str(e))
+    metrics = {'rounds': sim.clock.rounds,
+               'unservedEnergy': unserved,
+               'peakGridPower': peak,
+               'socViolations': violations,
+               'socMin': min(socs) if socs else np.nan,
+               'socMax': max(socs) if socs else np.nan,
+               'solveTimeMean': 1e3 * float(np.mean(solveTimes)) if solveTimes else np.nan,
+               'solveTimeMax': 1e3 * float(np.max(solveTimes)) if solveTimes else np.nan,
+               'wallTime': time.time() - t0}
+    return metrics, None
+
+
+def initWorker():
+    logging.basicConfig(level=logging.WARNING)
+
+
+def sweep(sim_config, grid, hours, workers=None):
+    '''
+    Run the scenarios of the grid over a process pool
+    :param sim_config: contents of the simulation configuration file
+    :type sim_config: dict
+    :param grid: {parameter: list of values}
+    :type grid: dict
+    :param hours: number of rounds of each scenario
+    :type hours: int
+    :param workers: number of processes, the number of cores if None or 0
+    :type workers: int
+    :return: the columns of the results {name: array}
+    :rtype: dict
+    '''
+    todo = scenarios(grid)
+    workers = min(workers or os.cpu_count() or 1, len(todo)) or 1
+    # TensorFlow does not survive a fork, the workers are started fresh
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initWorker) as pool:
+        futures = [pool.submit(runScenario, sim_config, params, hours) for params in todo]
+        results = [future.result() for future in futures]
+    columns = {}
+    for name in grid:
+        columns[name] = np.array([params[name] for params in todo], dtype=float)
+    for name in METRICS:
+        columns[name] = np.array([metrics[name] if metrics is not None else np.nan for metrics, error in results], dtype=float)
+    columns['error'] = np.array([error or '' for metrics, error in results])
+    return columns
+
+
+def saveResults(columns, path):
+    '''
+    Save the columns of a sweep, written under a temporary name first
+    '''
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **columns)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    configfile = sys.argv[1] if len(sys.argv) > 1 else 'sweep_config.yaml'
+    with open('config/' + configfile, 'r') as stream:
+        sweep_config = yaml.safe_load(stream)
+    with open('config/' + sweep_config['simulation'], 'r') as stream:
+        sim_config = yaml.safe_load(stream)
+    try:
+        sim_config['models'] = bool(sweep_config['models'])
+    except KeyError:
+        pass
+    try:
+        hours = int(sweep_config['hours'])
+    except KeyError:
+        hours = int(sim_config['hours'])
+    try:
+        workers = int(sys.argv[2]) if len(sys.argv) > 2 else int(sweep_config['workers'])
+    except KeyError:
+        workers = 0
+    try:
+        output = sweep_config['output']
+    except KeyError:
+        output = 'sweep_results.npz'
+    t0 = time.time()
+    columns = sweep(sim_config, sweep_config['grid'], hours, workers)
+    n = len(columns['error'])
+    print('%d scenarios of %d rounds in %.1f s' % (n, hours, time.time() - t0))
+    names = list(sweep_config['grid']) + list(METRICS)
+    print(' '.join('%14s' % name for name in names))
+    for i in range(n):
+        print(' '.join('%14.4g' % columns[name][i] for name in names), columns['error'][i])
+    saveResults(columns, output)
+    print('results written to %s' % output)
@@ -0,0 +1,203 @@
+'''
+Tolerance votes of the replicas of a manager
+
+The replicas vote on their whole PowerRequest: (reqID, reqKind, reqTime, reqPower, currPower),
+where reqPower is the predicted horizon, or the attributes of a battery. A request is
+turned into a vector:
+    [currPower, horizon...]  or  [currPower, attributes sorted by name...]
+and compared with the vector of the replica with one of the metrics:
+    maxrel : every value is within tolerance of the value of the replica, relative to it
+    band : as maxrel, with a tolerance per step of the horizon (bands), the last band
+           holding for the steps past the bands; the current power and the attributes
+           use tolerance
+    l2 : the L2 distance of the vectors is within tolerance of the norm of the vector
+         of the replica
+The relative tolerances of the powers (current power and horizon) are taken of at least
+floor kW, so values close to 0 do not need to match exactly. The attributes, of other
+units (e.g. the SoC), are taken of at least attribute_floor, 0 by default: they are
+compared relative to their value only. Requests of different shapes (horizon length, attribute names)
+never agree.
+
+The votes are kept per RFC: a request voted on again with the same data of the replica
+is not compared again.
+'''
+from collections import OrderedDict
+import numpy as np
+
+METRICS = ('maxrel', 'band', 'l2')
+
+
+class ToleranceVote():
+    '''
+    Vote of a replica on the requests of the other replicas of a group
+    cache : {rfcId: (data, vote)} the votes, with the data of the replica they were taken on
+    '''
+    def __init__(self, metric='maxrel', tolerance=0.05, bands=None, floor=1.0, attribute_floor=0.0, cache=64):
+        '''
+        :param metric: distance of the requests {'maxrel', 'band', 'l2'}
+        :type metric: str
+        :param tolerance: relative tolerance of the values
+        :type tolerance: float
+        :param bands: relative tolerance of each step of the horizon, for the band metric
+        :type bands: list
+        :param floor: smallest value (kW) the relative tolerances of the powers are taken of
+        :type floor: float
+        :param attribute_floor: smallest value the relative tolerances of the attributes are taken of
+        :type attribute_floor: float
+        :param cache: largest number of votes kept
+        :type cache: int
+        '''
+        if metric not in METRICS:
+            raise ValueError('unknown vote metric %s' % str(metric))
+        if metric == 'band' and (bands is None or len(bands) == 0):
+            raise ValueError('the band metric needs bands')
+        self.metric = metric
+        self.tolerance = float(tolerance)
+        self.bands = np.asarray(bands if bands is not None else [tolerance], dtype=float)
+        self.floor = float(floor)
+        self.attributeFloor = float(attribute_floor)
+        self.cacheSize = max(1, int(cache))
+        self.cache = OrderedDict()
+        self.own = (None, None)
+        self.tolerances = {}
+        self.floors = {}
+        self.evaluated = 0
+        self.hits = 0
+
+    @classmethod
+    def fromConfig(cls, cfg):
+        '''
+        Vote of the settings of a group
+        :param cfg: {'metric', 'tolerance', 'bands', 'floor', 'attribute_floor', 'cache'}, the missing ones are defaulted
+        :type cfg: dict
+        '''
+        keys = ('metric', 'tolerance', 'bands', 'floor', 'attribute_floor', 'cache')
+        return cls(**{key: cfg[key] for key in keys if key in cfg})
+
+    def vectorOf(self, req):
+        '''
+        Values of a request and the names of its attributes
+        :param req: (reqID, reqKind, reqTime, reqPower, currPower)
+        :type req: tuple
+        :rtype: (numpy array, tuple)
+        '''
+        reqPower, currPower = req[3], req[4]
+        if isinstance(reqPower, dict):
+            names = tuple(sorted(reqPower))
+            values = [reqPower[name] for name in names]
+        else:
+            names = None
+            values = reqPower
+        vector = np.empty(len(values) + 1)
+        vector[0] = currPower
+        vector[1:] = values
+        return vector, names
+
+    def tolerancesOf(self, n, horizon):
+        '''
+        Relative tolerance of each value of a vector of n values
+        '''
+        key = (n, horizon)
+        tol = self.tolerances.get(key)
+        if tol is None:
+            tol = np.full(n, self.tolerance)
+            if self.metric == 'band' and horizon:
+                steps = np.minimum(np.arange(n - 1), len(self.bands) - 1)
+                tol[1:] = self.bands[steps]
+            self.tolerances[key] = tol
+        return tol
+
+    def floorsOf(self, n, horizon):
+        '''
+        Smallest value each value of a vector of n values is taken of: floor for the powers,
+        attribute_floor for the attributes
+        '''
+        key = (n, horizon)
+        floor = self.floors.get(key)
+        if floor is None:
+            floor = np.full(n, self.floor if horizon else self.attributeFloor)
+            floor[0] = self.floor
+            self.floors[key] = floor
+        return floor
+
+    def compare(self, msg, data):
+        '''
+        Vote on a request
+        :param msg: the request of another replica
+        :param data: the request of the replica
+        :rtype: bool
+        '''
+        if self.own[0] is not data:
+            self.own = (data, self.vectorOf(data))
+        mine, names = self.own[1]
+        theirs, theirNames = self.vectorOf(msg)
+        if theirNames != names or len(theirs) != len(mine):
+            return False
+        if not np.all(np.isfinite(theirs)):
+            return False
+        diff = np.abs(theirs - mine)
+        if self.metric == 'l2':
+            return bool(np.linalg.norm(diff) <= self.tolerance * max(np.linalg.norm(mine), self.floor))
+        tol = self.tolerancesOf(len(mine), names is None)
+        return bool(np.all(diff <= tol * np.maximum(np.abs(mine), self.floorsOf(len(mine), names is None))))
+
+    def agree(self, rfcId, msg, data):
+        '''
+        Vote on the request of an RFC, kept until the data of the replica changes
+        :rtype: bool
+        '''
+        cached = self.cache.get(rfcId)
+        if cached is not None and cached[0] is data:
+            self.hits += 1
+            return cached[1]
+        vote = self.compare(msg, data)
+        self.evaluated += 1
+        self.cache[rfcId] = (data, vote)
+        self.cache.move_to_end(rfcId)
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return vote
+
+    def stats(self):
+        return {'evaluated': self.evaluated, 'hits': self.hits}
+
+
+def votesOf(cfg, groups):
+    '''
+    Vote of each group
+    :param cfg: settings of the votes, {'default': settings, group name: settings}
+    :type cfg: dict
+    :param groups: names of the groups
+    :type groups: list
+    :rtype: dict
+    '''
+    votes = {}
+    for name in groups:
+        settings = dict(cfg.get('default') or {})
+        settings.update(cfg.get(name) or {})
+        votes[name] = ToleranceVote.fromConfig(settings)
+    return votes
+
+
+if __name__ == '__main__':
+    # the votes of three replicas on a day of horizons, with and without the horizon compared
+    import time
+    rng = np.random.default_rng(1)
+    base = 500.0 + 200.0 * np.sin(np.arange(24) * np.pi / 12)
+    same = ('BU1a', 'BU', '', (base + rng.normal(0, 5, 24)).tolist(), 700.0)
+    drift = ('BU1b', 'BU', '', (base * np.linspace(1.0, 1.6, 24)).tolist(), 702.0)
+    mine = ('BU1c', 'BU', '', base.tolist(), 700.0)
+    print('%-8s %-10s %-10s' % ('metric', 'close', 'drifting'))
+    print('%-8s %-10s %-10s' % ('scalar', abs(same[4] - mine[4]) / mine[4] <= 0.05, abs(drift[4] - mine[4]) / mine[4] <= 0.05))
+    for vote in (ToleranceVote('maxrel'), ToleranceVote('band', bands=[0.05, 0.1, 0.2]), ToleranceVote('l2')):
+        print('%-8s %-10s %-10s' % (vote.metric, vote.agree('a', same, mine), vote.agree('b', drift, mine)))
+    vote = ToleranceVote('band', bands=np.linspace(0.05, 0.3, 24).tolist(), cache=1024)
+    n = 10000
+    t0 = time.time()
+    for i in range(n):
+        vote.agree(i, same, mine)
+    t1 = time.time()
+    for i in range(n):
+        vote.agree(i % 1000, same, mine)
+    t2 = time.time()
+    print('%d votes: %.1f us each, %.1f us cached, %s' % (n, 1e6 * (t1 - t0) / n, 1e6 * (t2 - t1) / n, str(vote.stats())))
@@ -0,0 +1,248 @@
+'''
+Consensus of the replicas of a manager
+
+The replicas of a load (e.g. BU1a, BU1b) join the same group and poll their own
+device. Before the data of a round is acted on (sent to the predictor or the
+Coordinator), each replica asks the group to vote on it, the members compare it with
+their own data, and the leader picks one replica whose data was agreed on to send it.
+
+The engine runs on the events of the component instead of polling timers:
+    - new device data starts the vote at once if the group has a leader, or once it
+      is elected, and answers the vote requests that were waiting for it,
+    - a vote request is answered at once if the member has data of the round of the
+      request (its reqTime) or a later one; otherwise it waits for the data of that
+      round until its deadline, then it is voted down,
+    - a vote of the replica that has no result by its deadline is given up,
+    - the results kept by the leader expire.
+The requests waiting for data are bounded: beyond max_pending the oldest one is voted
+down. The deadlines are kept by a single sporadic timer of the component, armed through
+the arm callback with the delay to the next deadline.
+
+The metrics (stats) count the votes requested, cast, timed out and lost (votes of the
+replica that had no choice of the leader by their deadline), and the round trip of the
+votes of the replica, from the request to its result.
+'''
+import time
+from collections import OrderedDict
+from operator import itemgetter
+
+
+class VoteEngine():
+    '''
+    Votes of a manager in its groups
+    data : the device data of the last round
+    leaders : groups with a leader
+    waiting : groups where the data waits for a leader to be voted on
+    mine : {group: (rfcId, time of the request, deadline)} vote of the replica in the group
+    pending : {rfcId: (group, msg, deadline)} vote requests waiting for the data of their round
+    results : {rfcId: (group, vote, time)} results seen by the replica
+    '''
+    def __init__(self, send, arm, event=None, timeout=15.0, max_pending=16, expiry=60.0, clock=time.time,
+                 roundOf=itemgetter(2)):
+        '''
+        :param send: send(data) acts on the data agreed on
+        :param arm: arm(delay) launches the deadline timer in delay sec, or halts it if delay is None
+        :param event: event(name, group, who) reports the steps of a vote
+        :param timeout: seconds a vote request waits for data; the vote of the replica waits twice as long
+        :type timeout: float
+        :param max_pending: largest number of vote requests waiting for data
+        :type max_pending: int
+        :param expiry: seconds the results are kept
+        :type expiry: float
+        :param clock: time of the deadlines
+        :param roundOf: roundOf(data) the round of the data, the reqTime of a PowerRequest
+        '''
+        self.send = send
+        self.arm = arm
+        self.event = event
+        self.timeout = float(timeout)
+        self.maxPending = max(1, int(max_pending))
+        self.expiry = float(expiry)
+        self.clock = clock
+        self.roundOf = roundOf
+        self.groups = []
+        self.agree = {}
+        self.data = None
+        self.leaders = set()
+        self.waiting = set()
+        self.mine = {}
+        self.pending = OrderedDict()
+        self.results = OrderedDict()
+        self.requested = 0
+        self.cast = 0
+        self.late = 0
+        self.timedOut = 0
+        self.overflow = 0
+        self.lost = 0
+        self.rounds = 0
+        self.latencyTime = 0.0
+        self.latencyMax = 0.0
+
+    def report(self, name, group, who):
+        if self.event is not None:
+            self.event(name, group, who)
+
+    def join(self, group, agree):
+        '''
+        :param agree: agree(rfcId, msg, data) is True if the data of a vote request matches the data of the replica
+        '''
+        self.groups.append(group)
+        self.agree[group] = agree
+
+    def update(self, data):
+        '''
+        New device data: answer the requests waiting for its round and vote on it in every group
+        '''
+        self.data = data
+        for rfcId in list(self.pending):
+            group, msg, deadline = self.pending[rfcId]
+            if self.ahead(msg):
+                continue
+            del self.pending[rfcId]
+            self.vote(group, rfcId, self.agree[group](rfcId, msg, data))
+            self.late += 1
+        for group in self.groups:
+            self.start(group)
+        self.rearm()
+
+    def start(self, group):
+        '''
+        Vote on the data in a group, or send it if the replica is alone
+        '''
+        self.waiting.discard(group)
+        if group in self.leaders:
+            now = self.clock()
+            rfcId = group.requestVote_pyobj(self.data)
+            self.mine[group] = (rfcId, now, now + 2 * self.timeout)
+            self.requested += 1
+            self.report('VoteBegin', group, rfcId)
+        elif group.groupSize() <= 2:
+            self.report('SendReqPower', group, None)
+            self.send(self.data)
+        else:
+            # started once the leader is elected
+            self.waiting.add(group)
+
+    def leaderElected(self, group):
+        self.leaders.add(group)
+        if group in self.waiting and self.data is not None:
+            self.start(group)
+            self.rearm()
+
+    def leaderExited(self, group):
+        self.leaders.discard(group)
+
+    def ahead(self, msg):
+        '''
+        True if the data of a vote request is of a later round than the data of the replica
+        '''
+        if self.data is None:
+            return True
+        try:
+            return self.roundOf(msg) > self.roundOf(self.data)
+        except TypeError:
+            # rounds that do not compare (no reqTime) are voted on at once
+            return False
+
+    def vote(self, group, rfcId, vote):
+        group.sendVote(rfcId, bool(vote))
+        self.cast += 1
+
+    def voteRequest(self, group, rfcId, msg):
+        '''
+        Vote on the data of another replica, once the replica has data of the same round
+        '''
+        if not self.ahead(msg):
+            self.vote(group, rfcId, self.agree[group](rfcId, msg, self.data))
+            return
+        if len(self.pending) >= self.maxPending:
+            oldest = next(iter(self.pending))
+            old, msg0, deadline = self.pending.pop(oldest)
+            self.vote(old, oldest, False)
+            self.overflow += 1
+        self.pending[rfcId] = (group, msg, self.clock() + self.timeout)
+        self.rearm()
+
+    def voteResult(self, group, rfcId, vote):
+        '''
+        Result of a vote. Once the results of the round are in, its own included, the
+        leader picks the replica that sends its data: itself if its data was agreed on, else another
+        replica whose data was agreed on.
+        '''
+        now = self.clock()
+        own = self.mine.get(group)
+        if own is not None and own[0] == rfcId:
+            latency = now - own[1]
+            self.rounds += 1
+            self.latencyTime += latency
+            self.latencyMax = max(self.latencyMax, latency)
+            self.report('VoteEnd', group, rfcId)
+        self.results[rfcId] = (group, str(vote), now)
+        results = {rfc: vote for rfc, (g, vote, t) in self.results.items() if g is group}
+        myrfcId = own[0] if own is not None else None
+        if group.isLeader() and len(results) >= group.groupSize() - 1 and (myrfcId is None or myrfcId in results):
+            chosen = myrfcId
+            if results.get(myrfcId) != 'yes':
+                agreed = [rfc for rfc, vote in results.items() if rfc != myrfcId and vote == 'yes']
+                if len(agreed) > 0:
+                    chosen = agreed[0]
+            if chosen is not None:
+                group.send_pyobj(chosen)
+            if chosen != myrfcId:
+                self.mine.pop(group, None)
+            self.clearResults(group)
+            self.rearm()
+
+    def groupMessage(self, group, msg):
+        '''
+        Choice of the leader: send the data if it is the one of the replica. The vote of
+        the replica is over whichever data was chosen.
+        '''
+        own = self.mine.pop(group, None)
+        if own is not None and msg == own[0]:
+            self.report('SendReqPower', group, None)
+            self.send(self.data)
+        self.clearResults(group)
+        self.rearm()
+
+    def clearResults(self, group):
+        for rfcId in [rfc for rfc, (g, vote, t) in self.results.items() if g is group]:
+            del self.results[rfcId]
+
+    def expire(self):
+        '''
+        Deadline timer: vote down the requests that waited too long for data, give up
+        the votes of the replica without a result and drop the old results
+        '''
+        now = self.clock()
+        for rfcId in [rfc for rfc, (g, msg, deadline) in self.pending.items() if deadline <= now]:
+            group, msg, deadline = self.pending.pop(rfcId)
+            self.vote(group, rfcId, False)
+            self.timedOut += 1
+        for group in [g for g, (rfc, t, deadline) in self.mine.items() if deadline <= now]:
+            del self.mine[group]
+            self.lost += 1
+        for rfcId in [rfc for rfc, (g, vote, t) in self.results.items() if t + self.expiry <= now]:
+            del self.results[rfcId]
+        self.rearm()
+
+    def rearm(self):
+        '''
+        Arm the timer for the next deadline
+        '''
+        deadlines = [deadline for g, msg, deadline in self.pending.values()]
+        deadlines += [deadline for rfc, t, deadline in self.mine.values()]
+        if len(self.results) > 0:
+            deadlines.append(min(t for g, vote, t in self.results.values()) + self.expiry)
+        if len(deadlines) == 0:
+            self.arm(None)
+        else:
+            self.arm(max(0.0, min(deadlines) - self.clock()))
+
+    def stats(self):
+        '''
+        Counters of the votes, the round trip of the votes of the replica in ms
+        '''
+        return {'requested': self.requested, 'cast': self.cast, 'late': self.late, 'timedOut': self.timedOut,
+                'overflow': self.overflow, 'lost': self.lost, 'pending': len(self.pending),
+                'latencyMean': 1e3 * self.latencyTime / max(1, self.rounds), 'latencyMax': 1e3 * self.latencyMax}
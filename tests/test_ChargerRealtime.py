@@ -0,0 +1,258 @@
+'''
+Tests of the realtime fetch engine against a ChargePoint stub
+
+The stub serves a minimal WSDL of getChargingSessionData and
+get15minChargingSessionData from a local http.server, and records the calls
+it receives. Run from the top of the repository with python -m pytest.
+'''
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from ChargerRealtime import RealtimeFetcher
+
+NS = 'urn:dictionary:com.chargepoint.webservices'
+
+WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="%(ns)s" targetNamespace="%(ns)s">
+  <types>
+    <xsd:schema targetNamespace="%(ns)s" elementFormDefault="unqualified">
+      <xsd:element name="getChargingSessionData">
+        <xsd:complexType><xsd:sequence>
+          <xsd:element name="searchQuery"><xsd:complexType><xsd:sequence>
+            <xsd:element name="fromTimeStamp" type="xsd:dateTime" minOccurs="0"/>
+            <xsd:element name="toTimeStamp" type="xsd:dateTime" minOccurs="0"/>
+          </xsd:sequence></xsd:complexType></xsd:element>
+        </xsd:sequence></xsd:complexType>
+      </xsd:element>
+      <xsd:element name="getChargingSessionDataResponse">
+        <xsd:complexType><xsd:sequence>
+          <xsd:element name="responseCode" type="xsd:string"/>
+          <xsd:element name="ChargingSessionData" minOccurs="0" maxOccurs="unbounded"><xsd:complexType><xsd:sequence>
+            <xsd:element name="sessionID" type="xsd:long"/>
+            <xsd:element name="stationID" type="xsd:string"/>
+            <xsd:element name="portNumber" type="xsd:string"/>
+            <xsd:element name="startTime" type="xsd:dateTime"/>
+            <xsd:element name="endTime" type="xsd:dateTime" minOccurs="0"/>
+          </xsd:sequence></xsd:complexType></xsd:element>
+        </xsd:sequence></xsd:complexType>
+      </xsd:element>
+      <xsd:element name="get15minChargingSessionData">
+        <xsd:complexType><xsd:sequence>
+          <xsd:element name="sessionID" type="xsd:long"/>
+        </xsd:sequence></xsd:complexType>
+      </xsd:element>
+      <xsd:element name="get15minChargingSessionDataResponse">
+        <xsd:complexType><xsd:sequence>
+          <xsd:element name="responseCode" type="xsd:string"/>
+          <xsd:element name="stationID" type="xsd:string"/>
+          <xsd:element name="portNumber" type="xsd:string"/>
+          <xsd:element name="sessionID" type="xsd:long"/>
+          <xsd:element name="fifteenminData" minOccurs="0" maxOccurs="unbounded"><xsd:complexType><xsd:sequence>
+            <xsd:element name="stationTime" type="xsd:dateTime"/>
+            <xsd:element name="energyConsumed" type="xsd:double"/>
+            <xsd:element name="peakPower" type="xsd:double"/>
+            <xsd:element name="rollingPowerAvg" type="xsd:double"/>
+          </xsd:sequence></xsd:complexType></xsd:element>
+        </xsd:sequence></xsd:complexType>
+      </xsd:element>
+    </xsd:schema>
+  </types>
+  <message name="getChargingSessionDataInput"><part name="parameters" element="tns:getChargingSessionData"/></message>
+  <message name="getChargingSessionDataOutput"><part name="parameters" element="tns:getChargingSessionDataResponse"/></message>
+  <message name="get15minChargingSessionDataInput"><part name="parameters" element="tns:get15minChargingSessionData"/></message>
+  <message name="get15minChargingSessionDataOutput"><part name="parameters" element="tns:get15minChargingSessionDataResponse"/></message>
+  <portType name="chargepointservicesPortType">
+    <operation name="getChargingSessionData">
+      <input message="tns:getChargingSessionDataInput"/><output message="tns:getChargingSessionDataOutput"/>
+    </operation>
+    <operation name="get15minChargingSessionData">
+      <input message="tns:get15minChargingSessionDataInput"/><output message="tns:get15minChargingSessionDataOutput"/>
+    </operation>
+  </portType>
+  <binding name="chargepointservicesBinding" type="tns:chargepointservicesPortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="getChargingSessionData">
+      <soap:operation soapAction="urn:provider/interface/chargepointservices/getChargingSessionData"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>
+    </operation>
+    <operation name="get15minChargingSessionData">
+      <soap:operation soapAction="urn:provider/interface/chargepointservices/get15minChargingSessionData"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="chargepointservices">
+    <port name="chargepointservicesPort" binding="tns:chargepointservicesBinding">
+      <soap:address location="%(url)s"/>
+    </port>
+  </service>
+</definitions>
+'''
+
+ENVELOPE = '''<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<ns:%s xmlns:ns="%s">%s</ns:%s>
+</soap:Body></soap:Envelope>'''
+
+FMT = '%Y-%m-%dT%H:%M:%S'
+
+
+class ChargePointStub():
+    '''
+    Sessions served by the stub and the calls it received
+    sessions : {sessionID: (endTime or None, list of interval times)}
+    failing : sessions whose data is answered with a server error
+    '''
+    def __init__(self, sessions, delay=0.5):
+        self.sessions = sessions
+        self.delay = delay
+        self.failing = set()
+        self.lock = threading.Lock()
+        self.searches = []
+        self.fetches = {}
+        self.inFlight = 0
+        self.maxInFlight = 0
+
+    def search(self, body):
+        query = body.find('searchQuery')
+        self.searches.append((query.findtext('fromTimeStamp'), query.findtext('toTimeStamp')))
+        rows = ''
+        for sessionID, (endTime, intervals) in self.sessions.items():
+            end = '<endTime>%s</endTime>' % endTime.strftime(FMT) if endTime is not None else ''
+            rows += ('<ChargingSessionData><sessionID>%d</sessionID><stationID>1:1</stationID><portNumber>1</portNumber>'
+                     '<startTime>%s</startTime>%s</ChargingSessionData>' % (sessionID, intervals[0].strftime(FMT), end))
+        return '<responseCode>100</responseCode>' + rows
+
+    def sessionData(self, body):
+        sessionID = int(body.findtext('sessionID'))
+        with self.lock:
+            self.fetches[sessionID] = self.fetches.get(sessionID, 0) + 1
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.inFlight -= 1
+        if sessionID in self.failing:
+            return None
+        rows = ''
+        for stationTime in self.sessions[sessionID][1]:
+            rows += ('<fifteenminData><stationTime>%s</stationTime><energyConsumed>1.5</energyConsumed>'
+                     '<peakPower>6.6</peakPower><rollingPowerAvg>6.0</rollingPowerAvg></fifteenminData>' % stationTime.strftime(FMT))
+        return ('<responseCode>100</responseCode><stationID>1:1</stationID><portNumber>1</portNumber>'
+                '<sessionID>%d</sessionID>' % sessionID + rows)
+
+    def handlerOf(self, wsdl):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, body, contentType, code=200):
+                body = body.encode()
+                self.send_response(code)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.reply(wsdl(), 'text/xml')
+
+            def do_POST(self):
+                envelope = ET.fromstring(self.rfile.read(int(self.headers['Content-Length'])))
+                body = envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')[0]
+                operation = body.tag.split('}')[-1]
+                payload = stub.search(body) if operation == 'getChargingSessionData' else stub.sessionData(body)
+                if payload is None:
+                    return self.reply('', 'text/plain', 500)
+                response = operation + 'Response'
+                self.reply(ENVELOPE % (response, NS, payload, response), 'text/xml; charset=utf-8')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class RealtimeFetcherTest(unittest.TestCase):
+    def setUp(self):
+        t0 = datetime(2024, 5, 1, 8, 0)
+        every = [t0 + timedelta(minutes=15 * k) for k in range(9)]
+        # session 1 ended at 9:00, the others are running with an interval at 10:00
+        self.stub = ChargePointStub({1: (datetime(2024, 5, 1, 9, 0), every[:4]),
+                                     2: (None, every),
+                                     3: (None, every[2:]),
+                                     4: (None, every[4:])})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), None)
+        url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.server.RequestHandlerClass = self.stub.handlerOf(lambda: WSDL % {'ns': NS, 'url': url})
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.cacheDir = tempfile.mkdtemp()
+        self.fetcher = RealtimeFetcher(url + '?wsdl', 'user', 'password', workers=8, timeout=10,
+                                       wsdl_cache=self.cacheDir + '/wsdl.db')
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cacheDir)
+
+    def test_concurrent_session_calls(self):
+        t0 = time.time()
+        rows = self.fetcher.fetch(['all'], now=datetime(2024, 5, 1, 10, 7))
+        elapsed = time.time() - t0
+        self.assertEqual(self.stub.fetches, {1: 1, 2: 1, 3: 1, 4: 1})
+        self.assertEqual(self.stub.maxInFlight, 4)
+        self.assertLess(elapsed, 4 * self.stub.delay)
+        # only the 10:00 interval of the running sessions is in the window 10:00 - 10:07
+        self.assertEqual(sorted(row['sessionID'] for row in rows), [2, 3, 4])
+        self.assertTrue(all(row['stationTime'] == datetime(2024, 5, 1, 10, 0) for row in rows))
+        self.assertEqual(rows[0]['peakPower'], 6.6)
+
+    def test_completed_sessions_not_fetched_again(self):
+        self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 7))
+        rows = self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 12))
+        self.assertEqual(self.stub.fetches, {1: 1, 2: 2, 3: 2, 4: 2})
+        self.assertEqual(self.fetcher.calls, 7)
+        self.assertEqual(len(rows), 3)
+        # the first poll looks back 8 hours, the next one from the previous poll less the overlap
+        self.assertEqual(self.stub.searches, [('2024-05-01T02:07:00', '2024-05-01T10:07:00'),
+                                              ('2024-05-01T09:52:00', '2024-05-01T10:12:00')])
+
+    def test_idle_running_session_kept(self):
+        self.stub.delay = 0.0
+        self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 7))
+        # no new interval for 50 minutes, the running sessions are still polled
+        self.assertEqual(self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 50)), [])
+        self.assertEqual(sorted(self.fetcher.tracker.sessions), [2, 3, 4])
+        self.stub.sessions[2][1].append(datetime(2024, 5, 1, 11, 0))
+        rows = self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 11, 5))
+        self.assertEqual([(row['sessionID'], row['stationTime']) for row in rows], [(2, datetime(2024, 5, 1, 11, 0))])
+        self.assertEqual(self.stub.fetches, {1: 1, 2: 3, 3: 3, 4: 3})
+
+    def test_idle_and_failing_sessions_given_up(self):
+        self.stub.delay = 0.0
+        self.fetcher.tracker.idle = timedelta(hours=1)
+        self.fetcher.tracker.maxFailures = 2
+        self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 7))
+        # the data of session 3 cannot be fetched any more, it is given up after 2 polls
+        self.stub.failing.add(3)
+        self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 22))
+        self.assertEqual(sorted(self.fetcher.tracker.sessions), [2, 3, 4])
+        self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 10, 37))
+        self.assertEqual(sorted(self.fetcher.tracker.sessions), [2, 4])
+        # session 4 has no interval after 10:00 and is never seen to end, session 2 goes on
+        self.stub.sessions[2][1].extend(datetime(2024, 5, 1, 10, 15) + timedelta(minutes=15 * k) for k in range(5))
+        rows = self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 11, 22))
+        self.assertEqual([(row['sessionID'], row['stationTime']) for row in rows], [(2, datetime(2024, 5, 1, 11, 15))])
+        self.assertEqual(sorted(self.fetcher.tracker.sessions), [2])
+        self.fetcher.fetch(['peakPower'], now=datetime(2024, 5, 1, 11, 37))
+        self.assertEqual(self.stub.fetches, {1: 1, 2: 5, 3: 3, 4: 4})
+
+
+if __name__ == '__main__':
+    unittest.main()
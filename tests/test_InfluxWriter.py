@@ -0,0 +1,204 @@
+'''
+Tests of the batched writer of the Logger against a fake InfluxDB
+
+The fake database records the line protocol bodies it receives and answers 503
+while it is down. Run from the top of the repository with python -m pytest.
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from influxdb import InfluxDBClient
+from InfluxWriter import InfluxWriter
+from LogData import series, linesOf
+from LogSpool import LogSpool
+
+
+def roundOf(k, loads=3):
+    '''
+    Points of a dispatch round: 24 predicted values of each load and its actual power
+    '''
+    start = 1565913600 + 3600 * k
+    datastream = [series({'type': 'BU', 'ID': 'BU%d' % i}, 'Predicted Power', 'power', start, 3600,
+                         [700.0 + j for j in range(24)]) for i in range(loads)]
+    datastream += [series({'type': 'BU', 'ID': 'BU%d' % i}, 'Actual Power', 'power', start, 3600, [5.0])
+                   for i in range(loads)]
+    return linesOf(datastream)
+
+
+def waitFor(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeInflux():
+    '''
+    The writes received by the fake database
+    batches : (time, number of lines, gzipped) of each write
+    '''
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.down = threading.Event()
+        self.lock = threading.Lock()
+        self.received = []
+        self.batches = []
+        self.refused = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def answer(self, code):
+                self.send_response(code)
+                self.send_header('X-Influxdb-Version', 'fake')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                self.answer(503 if fake.down.is_set() else 204)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if fake.down.is_set():
+                    with fake.lock:
+                        fake.refused += 1
+                    return self.answer(503)
+                zipped = self.headers.get('Content-Encoding') == 'gzip' and body[:2] == b'\x1f\x8b'
+                if zipped:
+                    body = gzip.decompress(body)
+                time.sleep(fake.delay)
+                lines = body.decode('utf-8').splitlines()
+                with fake.lock:
+                    fake.received.extend(lines)
+                    fake.batches.append((time.time(), len(lines), zipped))
+                self.answer(204)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def client(self):
+        return InfluxDBClient(host='127.0.0.1', port=self.server.server_address[1], database='riapsdb', gzip=True, retries=1)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class InfluxWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.influx = FakeInflux()
+        self.writer = None
+
+    def tearDown(self):
+        if self.writer is not None:
+            self.writer.close(10)
+        self.influx.close()
+
+    def test_batch_size_flush(self):
+        self.writer = InfluxWriter(self.influx.client(), batch_size=50, max_age=30.0)
+        self.writer.start()
+        points = roundOf(0) + roundOf(1)
+        self.writer.put(points[:120])
+        self.assertTrue(waitFor(lambda: len(self.influx.received) == 100))
+        time.sleep(0.2)
+        # the last 20 points wait for a full batch or their age
+        self.assertEqual([n for t, n, zipped in self.influx.batches], [50, 50])
+        self.assertEqual(self.writer.stats()['backlog'], 20)
+        self.writer.close(10)
+        self.assertEqual([n for t, n, zipped in self.influx.batches], [50, 50, 20])
+        self.assertEqual(self.influx.received, points[:120])
+
+    def test_age_flush(self):
+        self.writer = InfluxWriter(self.influx.client(), batch_size=1000, max_age=0.3)
+        self.writer.start()
+        t0 = time.time()
+        self.writer.put(roundOf(0))
+        self.assertTrue(waitFor(lambda: len(self.influx.batches) == 1))
+        self.assertGreaterEqual(self.influx.batches[0][0] - t0, 0.3)
+        self.assertEqual(self.influx.received, roundOf(0))
+        self.assertEqual(self.writer.stats()['written'], len(roundOf(0)))
+
+    def test_gzip_bodies(self):
+        self.writer = InfluxWriter(self.influx.client(), batch_size=40, max_age=0.05)
+        self.writer.start()
+        for k in range(3):
+            self.writer.put(roundOf(k))
+        self.writer.close(10)
+        self.assertGreater(len(self.influx.batches), 1)
+        self.assertTrue(all(zipped for t, n, zipped in self.influx.batches))
+        self.assertEqual(self.influx.received, roundOf(0) + roundOf(1) + roundOf(2))
+
+    def test_drop_oldest(self):
+        # the thread is not started, so nothing leaves the queue
+        self.writer = InfluxWriter(self.influx.client(), batch_size=10, capacity=100, policy='drop')
+        points = roundOf(0) + roundOf(1)
+        self.assertEqual(self.writer.put(points[:60]), 0)
+        self.assertEqual(self.writer.put(points[60:120]), 20)
+        stats = self.writer.stats()
+        self.assertEqual((stats['queued'], stats['dropped'], stats['backlog']), (120, 20, 100))
+        self.writer.start()
+        self.writer.close(10)
+        self.assertEqual(self.influx.received, points[20:120])
+        self.assertEqual(self.writer.stats()['written'], 100)
+
+    def test_block_timeout(self):
+        self.writer = InfluxWriter(self.influx.client(), batch_size=10, capacity=100, policy='block', block_timeout=0.3)
+        points = roundOf(0) + roundOf(1)
+        self.writer.put(points[:100])
+        t0 = time.time()
+        # no room is made, the put gives up after block_timeout and drops the oldest points
+        self.assertEqual(self.writer.put(points[100:110]), 10)
+        self.assertGreaterEqual(time.time() - t0, 0.3)
+        self.assertEqual(self.writer.stats()['dropped'], 10)
+
+    def test_block_waits_for_room(self):
+        self.influx.delay = 0.02
+        self.writer = InfluxWriter(self.influx.client(), batch_size=50, capacity=100, policy='block', block_timeout=10.0)
+        self.writer.start()
+        points = [line for k in range(4) for line in roundOf(k)]
+        for i in range(0, len(points), 50):
+            self.assertEqual(self.writer.put(points[i:i + 50]), 0)
+        self.writer.close(10)
+        stats = self.writer.stats()
+        self.assertEqual((stats['queued'], stats['written'], stats['dropped']), (len(points), len(points), 0))
+        self.assertEqual(self.influx.received, points)
+
+    def test_spool_replay_after_outage(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.influx.down.set()
+            spool = LogSpool(path, 1 << 12)
+            self.writer = InfluxWriter(self.influx.client(), batch_size=50, max_age=0.05, spool=spool,
+                                       replay_batch=100, replay_rate=5000.0)
+            self.writer.start()
+            points = []
+            for k in range(5):
+                points += roundOf(k)
+                self.writer.put(roundOf(k))
+            self.assertTrue(waitFor(lambda: spool.pending() == len(points) and len(self.writer.queue) == 0))
+            self.assertEqual(self.influx.received, [])
+            self.assertFalse(self.writer.stats()['online'])
+            # the database is back: the spooled points are replayed once, then new points are written
+            self.influx.down.clear()
+            self.assertTrue(waitFor(lambda: spool.pending() == 0 and len(self.influx.received) == len(points)))
+            self.writer.put(roundOf(5))
+            self.writer.close(10)
+            self.assertEqual(sorted(self.influx.received), sorted(points + roundOf(5)))
+            self.assertEqual(self.influx.received[-len(roundOf(5)):], roundOf(5))
+            stats = self.writer.stats()
+            self.assertEqual((stats['spooled'], stats['replayed'], stats['spoolPending']), (len(points), len(points), 0))
+            self.assertTrue(all(n <= 100 for t, n, zipped in self.influx.batches))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()